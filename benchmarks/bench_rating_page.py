@@ -0,0 +1,64 @@
+"""
+Сборка страницы рейтинга на python без postgres и redis.
+
+    python -m benchmarks.bench_rating_page --users 10000 --calls 20000 [--json results.json]
+
+rating page - LeaderboardService._build_rating: страница (100 мест) из очков и профилей,
+как после ZREVRANGE/HMGET. Задержки - чистая стоимость python (pydantic, json).
+Начисление тапов и регистрация выполняются запросами к postgres, их меряют
+load_test (tap) и bench_signup.
+"""
+import argparse
+import asyncio
+import json
+import random
+import uuid
+
+from src.game_api.services.leaderboard_service import LeaderboardService
+
+from benchmarks.common import measure, print_report
+
+RATING_PAGE_SIZE = 100
+
+
+async def build_rating_page(entries: list, profiles: list, offset: int) -> None:
+    LeaderboardService._build_rating(entries, profiles, first_position=offset + 1)
+
+
+async def main(users: int, calls: int, seed_value: int, json_path: str | None) -> None:
+    rng = random.Random(seed_value)
+    scores = sorted((rng.randint(0, 10 ** 7) for _ in range(users)), reverse=True)
+    entries = [(str(uuid.UUID(int=rng.getrandbits(128))).encode(), float(score)) for score in scores]
+    profiles = [
+        json.dumps(dict(
+            username=f'user{i}',
+            first_name='bench',
+            last_name='rating',
+            tg_id=str(i),
+            country_image_url=None,
+        )).encode()
+        for i in range(users)
+    ]
+    page_args = []
+    for _ in range(calls):
+        offset = rng.randrange(0, max(users - RATING_PAGE_SIZE, 1))
+        page_args.append((
+            entries[offset:offset + RATING_PAGE_SIZE],
+            profiles[offset:offset + RATING_PAGE_SIZE],
+            offset,
+        ))
+
+    results = {
+        'rating page': await measure(build_rating_page, page_args, count_queries=False),
+    }
+    print_report(f'rating page assembly, {users} users, {calls} calls', results, json_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', dest='json_path', default=None)
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.calls, args.seed, args.json_path))
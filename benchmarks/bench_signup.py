@@ -0,0 +1,118 @@
+"""
+Регистрация юзера (/start по реферальной ссылке): signups/sec до и после перевода в одну транзакцию.
+
+    python -m benchmarks.bench_signup --signups 200 --depth 10 [--json results.json]
+
+Все новые юзеры приглашены последним юзером цепочки глубиной depth, т.е. каждая регистрация
+пишет полную реферальную цепочку. "before" повторяет прежнюю реализацию
+UserService.create_or_update_user_by_telegram_id: коммит после каждого предприятия и каждой
+реферальной записи и запрос к предприятиям и пригласившим по одному.
+Созданные бенчмарком юзеры (tg_id bench-signup-*) удаляются в конце.
+"""
+import argparse
+import asyncio
+import uuid
+
+from sqlalchemy import delete, select
+
+from src.core.database import db_helper as db
+from src.core.models import UserModel, UserEnterpriseModel
+from src.game_api.dao import UserDAO, UserStateDAO, UserEnterpriseDAO, UserReferralDAO, EnterpriseDAO
+from src.game_api.schemas.enterprise_schemas import UserEnterpriseCreate
+from src.game_api.schemas.user_referral_schemas import UserReferralCreate
+from src.game_api.schemas.user_schemas import UserCreate
+from src.game_api.services.user_service import UserService
+
+from benchmarks.common import measure, print_report
+
+TG_ID_PREFIX = 'bench-signup-'
+
+
+def new_user(owner: UserModel | None) -> UserCreate:
+    tg_id = f'{TG_ID_PREFIX}{uuid.uuid4().hex[:16]}'
+    return UserCreate(
+        username=tg_id,
+        first_name='bench',
+        last_name='signup',
+        tg_id=tg_id,
+        tg_url=f'https://t.me/{tg_id}',
+        tg_chat_id=tg_id,
+        is_bot=False,
+        referrer_id=str(owner.id) if owner else None,
+    )
+
+
+async def legacy_signup(owner: UserModel) -> None:
+    async with db.session_factory() as ses:
+        user = new_user(owner)
+        db_user = await UserDAO.add(ses, user)
+        total_capacity = 0
+        for i in range(1, 4):
+            await UserEnterpriseDAO.add(ses, UserEnterpriseCreate(tg_id=user.tg_id, enterprise_id=i))
+            current_ent = await EnterpriseDAO.find_one_or_none(ses, id=i)
+            total_capacity += current_ent.capacity
+            await ses.commit()
+        await UserStateDAO.add(ses, dict(user_id=db_user.id, total_capacity=total_capacity))
+        await ses.commit()
+
+        level = 1
+        current_referrer_id = owner.referrer_id
+        while level <= 10:
+            if current_referrer_id is None:
+                await UserReferralDAO.add(
+                    ses, UserReferralCreate(owner_id=owner.id, referral_id=db_user.id, level_id=1))
+                await ses.commit()
+                break
+            next_owner = await UserDAO.find_one_or_none(ses, id=current_referrer_id)
+            if next_owner is None:
+                break
+            level += 1
+            await UserReferralDAO.add(
+                ses, UserReferralCreate(owner_id=next_owner.id, referral_id=db_user.id, level_id=level))
+            await ses.commit()
+            current_referrer_id = next_owner.referrer_id
+
+
+async def signup(owner: UserModel) -> None:
+    async with db.session_factory() as ses:
+        await UserService._onboard_user(ses, new_user(owner), owner)
+
+
+async def build_chain(depth: int) -> UserModel:
+    owner = None
+    for _ in range(depth):
+        async with db.session_factory() as ses:
+            owner = await UserService._onboard_user(ses, new_user(owner), owner)
+    return owner
+
+
+async def cleanup() -> None:
+    async with db.session_factory() as ses:
+        bench_users = select(UserModel.tg_id).where(UserModel.tg_id.startswith(TG_ID_PREFIX))
+        await ses.execute(delete(UserEnterpriseModel).where(UserEnterpriseModel.tg_id.in_(bench_users)))
+        await ses.execute(delete(UserModel).where(UserModel.tg_id.startswith(TG_ID_PREFIX)))
+        await ses.commit()
+
+
+async def main(signups: int, depth: int, json_path: str | None) -> None:
+    try:
+        owner = await build_chain(depth)
+        args_list = [(owner,)] * signups
+
+        results = {
+            'before (per-row commits)': await measure(legacy_signup, args_list),
+            'after (one transaction)': await measure(signup, args_list),
+        }
+        print_report(f'signup, {signups} users, referral chain depth {depth}', results, json_path)
+    finally:
+        await cleanup()
+        await db.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--signups', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=10)
+    parser.add_argument('--json', dest='json_path', default=None)
+    args = parser.parse_args()
+    asyncio.run(main(args.signups, args.depth, args.json_path))
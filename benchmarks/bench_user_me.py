@@ -0,0 +1,49 @@
+"""
+/user/me: кол-во запросов и задержка до и после объединения в один запрос.
+
+    python -m benchmarks.bench_user_me --users 200 --rounds 5 [--json results.json]
+
+"before" повторяет прежнюю реализацию UserService.get_user_by_telegram_id:
+юзер, страна, регион и два запроса к таблицам рейтингов по отдельности.
+"""
+import argparse
+import asyncio
+
+from src.core.database import db_helper as db
+from src.game_api.dao import UserDAO, CountryDAO, RegionDAO, GdpUserRatingDAO, CapacityUserRatingDAO
+from src.game_api.services.user_service import UserService
+
+from benchmarks.common import measure, sample_tg_ids, print_report
+
+
+async def legacy_get_user_by_telegram_id(tg_id: str) -> None:
+    async with db.session_factory() as ses:
+        db_user = await UserDAO.find_one_or_none(ses, tg_id=tg_id)
+        await CountryDAO.find_first(ses, id=db_user.country_id)
+        await RegionDAO.find_first(ses, id=db_user.region_id)
+        await GdpUserRatingDAO.find_one_or_none(ses, user_id=db_user.id)
+        await CapacityUserRatingDAO.find_one_or_none(ses, user_id=db_user.id)
+
+
+async def main(users: int, rounds: int, json_path: str | None) -> None:
+    tg_ids = await sample_tg_ids(users)
+    args_list = [(tg_id,) for tg_id in tg_ids] * rounds
+
+    # прогрев пула соединений и кэша планов
+    await measure(UserService.get_user_by_telegram_id, args_list[:10])
+
+    results = {
+        'before (5 queries)': await measure(legacy_get_user_by_telegram_id, args_list),
+        'after (joined)': await measure(UserService.get_user_by_telegram_id, args_list),
+    }
+    print_report(f'/user/me, {len(tg_ids)} users x {rounds} rounds', results, json_path)
+    await db.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--json', dest='json_path', default=None)
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.rounds, args.json_path))
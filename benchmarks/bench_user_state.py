@@ -0,0 +1,147 @@
+"""
+Обновление счетчиков юзера (тапы, сброс тапов, комиссии): пропускная способность и распухание таблицы
+до и после переноса счетчиков из users в узкую таблицу user_state.
+
+    python -m benchmarks.bench_user_state --rows 10000 --rounds 200 --batch 500 [--json results.json]
+
+Бенчмарк копирует rows случайных юзеров в две временные таблицы: bench_users_wide - строка users
+со всеми индексами и счетчиками в ней (схема до переноса), bench_user_state - копия user_state
+(fillfactor 70). В каждой rounds раз обновляются счетчики batch случайных юзеров тем же UPDATE,
+что выполняет сброс тапов. Кроме задержек сравниваются объем WAL, рост таблицы с индексами
+и доля HOT-обновлений (по pg_stat_user_tables, статистика обновляется с задержкой до секунды).
+Временные таблицы удаляются в конце.
+"""
+import argparse
+import asyncio
+import random
+from typing import Any
+
+from sqlalchemy import text
+
+from src.core.database import db_helper as db
+
+from benchmarks.common import measure, print_report
+
+WIDE_TABLE = 'bench_users_wide'
+NARROW_TABLE = 'bench_user_state'
+KEY_COLUMNS = {WIDE_TABLE: 'id', NARROW_TABLE: 'user_id'}
+
+
+async def execute_autocommit(*statements: str, **params: Any) -> None:
+    # VACUUM нельзя выполнять внутри транзакции
+    async with db.engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+        for statement in statements:
+            await conn.execute(text(statement), params)
+
+
+async def setup(rows: int) -> list[str]:
+    await cleanup()
+    await execute_autocommit(
+        f'CREATE TABLE {WIDE_TABLE} (LIKE users INCLUDING ALL, LIKE user_state INCLUDING DEFAULTS)',
+        f'CREATE TABLE {NARROW_TABLE} (LIKE user_state INCLUDING ALL) WITH (fillfactor = 70)',
+        f'INSERT INTO {WIDE_TABLE} SELECT users.*, user_state.* FROM users '
+        f'JOIN user_state ON user_state.user_id = users.id ORDER BY random() LIMIT :rows',
+        f'INSERT INTO {NARROW_TABLE} SELECT user_state.* FROM user_state '
+        f'JOIN {WIDE_TABLE} ON {WIDE_TABLE}.id = user_state.user_id',
+        f'VACUUM ANALYZE {WIDE_TABLE}',
+        f'VACUUM ANALYZE {NARROW_TABLE}',
+        rows=rows,
+    )
+    async with db.session_factory() as ses:
+        result = await ses.execute(text(f'SELECT id::text FROM {WIDE_TABLE}'))
+        return list(result.scalars().all())
+
+
+async def update_batch(table: str, data: list[dict[str, Any]]) -> None:
+    async with db.session_factory() as ses:
+        await ses.execute(
+            text(
+                f'UPDATE {table} SET game_balance = game_balance + :b_balance, energy = :b_energy, '
+                f'last_accrued_at = now(), last_energy_update = now(), tap_flush_seq = tap_flush_seq + 1 '
+                f'WHERE {KEY_COLUMNS[table]} = CAST(:b_id AS uuid)'
+            ),
+            data,
+        )
+        await ses.commit()
+
+
+async def table_stats(table: str) -> dict[str, int]:
+    async with db.session_factory() as ses:
+        await ses.execute(text('SELECT pg_stat_clear_snapshot()'))
+        row = (await ses.execute(
+            text(
+                'SELECT pg_current_wal_lsn()::text AS lsn, pg_total_relation_size(relid) AS size, '
+                'n_tup_upd, n_tup_hot_upd, n_dead_tup FROM pg_stat_user_tables WHERE relname = :table'
+            ),
+            dict(table=table),
+        )).one()
+        return row._asdict()
+
+
+async def wal_bytes_since(lsn: str) -> int:
+    async with db.session_factory() as ses:
+        return int(await ses.scalar(
+            text('SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), CAST(:lsn AS pg_lsn))'), dict(lsn=lsn)))
+
+
+async def run(table: str, args_list: list[tuple]) -> dict[str, Any]:
+    before = await table_stats(table)
+    result = await measure(update_batch, [(table, data) for data, in args_list])
+    wal_bytes = await wal_bytes_since(before['lsn'])
+    # статистика таблиц отправляется в pg_stat асинхронно
+    await asyncio.sleep(1.5)
+    after = await table_stats(table)
+
+    updates = after['n_tup_upd'] - before['n_tup_upd']
+    rows = sum(len(data) for data, in args_list)
+    elapsed = result['count'] / result['ops_per_sec'] if result['ops_per_sec'] else 0.0
+    result.update(
+        rows_per_sec=round(rows / elapsed, 1) if elapsed else 0.0,
+        wal_bytes_per_row=round(wal_bytes / rows, 1) if rows else 0.0,
+        size_growth_kb=round((after['size'] - before['size']) / 1024, 1),
+        hot_update_pct=round((after['n_tup_hot_upd'] - before['n_tup_hot_upd']) / updates * 100, 1)
+        if updates else 0.0,
+        dead_tuples=after['n_dead_tup'],
+    )
+    return result
+
+
+async def cleanup() -> None:
+    await execute_autocommit(f'DROP TABLE IF EXISTS {WIDE_TABLE}', f'DROP TABLE IF EXISTS {NARROW_TABLE}')
+
+
+async def main(rows: int, rounds: int, batch: int, json_path: str | None) -> None:
+    try:
+        user_ids = await setup(rows)
+        if not user_ids:
+            print('No users in the database, nothing to benchmark')
+            return
+        # одинаковая нагрузка для обеих таблиц
+        args_list = [
+            ([
+                dict(b_id=user_id, b_balance=random.randint(1, 500), b_energy=random.randint(0, 1000))
+                for user_id in random.sample(user_ids, min(batch, len(user_ids)))
+            ],)
+            for _ in range(rounds)
+        ]
+
+        results = {
+            'before (users row)': await run(WIDE_TABLE, args_list),
+            'after (user_state)': await run(NARROW_TABLE, args_list),
+        }
+        print_report(
+            f'counter updates, {len(user_ids)} users, {rounds} batches of {batch}', results, json_path)
+    finally:
+        await cleanup()
+        await db.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--json', dest='json_path', default=None)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.rounds, args.batch, args.json_path))
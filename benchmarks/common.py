@@ -0,0 +1,104 @@
+"""
+Общие инструменты бенчмарков.
+
+Бенчмарки запускаются из корня репозитория против базы и redis из настроек (src/.dev.env):
+    python -m benchmarks.<имя_бенчмарка> --help
+"""
+import json
+import statistics
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Awaitable, Callable, Iterator
+
+from sqlalchemy import event, select, func
+
+from src.core.database import db_helper as db
+from src.core.models import UserModel
+
+
+class QueryCounter:
+    """
+    Считает SQL-запросы, выполненные движком db_helper внутри блока with
+    """
+    def __init__(self) -> None:
+        self.count = 0
+
+    def _on_execute(self, *args: Any) -> None:
+        self.count += 1
+
+    @contextmanager
+    def track(self) -> Iterator['QueryCounter']:
+        engine = db.engine.sync_engine
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+        try:
+            yield self
+        finally:
+            event.remove(engine, 'before_cursor_execute', self._on_execute)
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    """
+    Сводка по задержкам в миллисекундах
+    """
+    return dict(
+        count=len(samples),
+        mean_ms=round(statistics.fmean(samples) * 1000, 3) if samples else 0.0,
+        p50_ms=round(percentile(samples, 50) * 1000, 3),
+        p95_ms=round(percentile(samples, 95) * 1000, 3),
+        p99_ms=round(percentile(samples, 99) * 1000, 3),
+    )
+
+
+async def measure(
+        fn: Callable[..., Awaitable[Any]],
+        args_list: list[tuple],
+        count_queries: bool = True,
+) -> dict[str, Any]:
+    """
+    Последовательно вызывает fn для каждого набора аргументов,
+    возвращает задержки, пропускную способность и кол-во SQL-запросов на вызов
+    (count_queries=False - без подсчета запросов, для кода без обращений к базе)
+    """
+    samples = []
+    counter = QueryCounter()
+    started = time.perf_counter()
+    with counter.track() if count_queries else nullcontext():
+        for args in args_list:
+            call_started = time.perf_counter()
+            await fn(*args)
+            samples.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+
+    result = dict(
+        **summarize(samples),
+        ops_per_sec=round(len(samples) / elapsed, 1) if elapsed else 0.0,
+    )
+    if count_queries:
+        result['queries_per_call'] = round(counter.count / len(samples), 2) if samples else 0.0
+    return result
+
+
+async def sample_tg_ids(n: int) -> list[str]:
+    async with db.session_factory() as ses:
+        result = await ses.execute(select(UserModel.tg_id).order_by(func.random()).limit(n))
+        return list(result.scalars().all())
+
+
+def print_report(title: str, results: dict[str, dict[str, Any]], json_path: str | None = None) -> None:
+    print(f'\n{title}')
+    columns = sorted({key for row in results.values() for key in row})
+    print(f"{'':<24}" + ''.join(f'{column:>18}' for column in columns))
+    for name, row in results.items():
+        print(f'{name:<24}' + ''.join(f'{row.get(column, ""):>18}' for column in columns))
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(dict(title=title, results=results), f, indent=2)
@@ -0,0 +1,293 @@
+"""
+Нагрузочный тест игрового API на локальных postgres и redis.
+
+    python -m benchmarks.load_test --users 10000 --concurrency 64 --duration 60 [--json results.json]
+
+Поднимает postgres и redis (см. benchmarks.local_stack), создает схему, заполняет базу
+users юзерами с реферальными цепочками, запускает приложение в uvicorn (--workers) и в течение
+duration секунд гоняет concurrency виртуальных юзеров по смеси эндпоинтов
+(--mix me=40,tap=40,rating=10,referral_stats=10, веса в процентах). Перед замером идет прогрев.
+
+По каждому эндпоинту выводятся запросы в секунду, ошибки и задержки p50/p95/p99 (на стороне клиента).
+В json кроме результатов пишутся коммит и параметры запуска, чтобы сравнивать прогоны между коммитами.
+При одинаковом --seed генерируются те же данные.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+import httpx
+
+from benchmarks.local_stack import local_stack, free_port, wait_for_port
+
+TG_ID_PREFIX = 'load-'
+SEED_CHUNK_SIZE = 5000
+REFERRED_SHARE = 0.7
+MAX_REFERRAL_LEVEL = 10
+
+DEFAULT_MIX = 'me=40,tap=40,rating=10,referral_stats=10'
+
+
+def build_request(
+        endpoint: str,
+        tg_id: str,
+        taps: dict[str, int],
+        energy_limit: int,
+        rng: random.Random,
+) -> tuple[str, str, dict]:
+    if endpoint == 'me':
+        return 'GET', '/user/me', dict(tg_id=tg_id)
+    if endpoint == 'tap':
+        # клиент присылает растущий счетчик тапов, пока не кончится энергия
+        taps[tg_id] = min(taps.get(tg_id, 0) + rng.randint(1, 20), energy_limit)
+        return 'POST', '/user/updateGameBalance', dict(tg_id=tg_id, current_tap_count=taps[tg_id])
+    if endpoint == 'rating':
+        return 'GET', '/user/rating', dict(rating_type=rng.choice(('gdp', 'capacity')), limit=100)
+    if endpoint == 'referral_stats':
+        return 'GET', '/user/getReferralStats', dict(tg_id=tg_id)
+    raise ValueError(f'Unknown endpoint {endpoint}')
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+    for item in mix.split(','):
+        endpoint, weight = item.split('=')
+        weights[endpoint.strip()] = int(weight)
+    return weights
+
+
+async def setup_schema() -> None:
+    from sqlalchemy import text
+
+    from src.core import models  # noqa: F401 регистрация моделей в Base.metadata
+    from src.core.database import Base, db_helper as db
+    from src.game_api.db_functions import effective_game_balance, user_state_fillfactor, country_rating_deltas
+
+    async with db.engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(text(effective_game_balance))
+        await conn.execute(text(user_state_fillfactor))
+        await conn.execute(text(country_rating_deltas))
+
+
+async def seed(users: int, rng: random.Random) -> list[str]:
+    """
+    Юзеры со случайными балансами, у REFERRED_SHARE из них есть пригласивший
+    среди созданных раньше, реферальные записи и счетчики - как при регистрации
+    """
+    from sqlalchemy import insert
+
+    from src.core.database import db_helper as db
+    from src.core.models import (
+        UserModel, UserStateModel, ReferralModel, ReferralCountModel, ReferralLevelModel
+    )
+    from src.settings import get_settings
+
+    energy_limit = get_settings().energy_limit
+
+    ids, paths, tg_ids = [], [], []
+    async with db.session_factory() as ses:
+        await ses.execute(insert(ReferralLevelModel), [
+            dict(id=level, level=level, commision_rate=round(0.1 / level, 4))
+            for level in range(1, MAX_REFERRAL_LEVEL + 1)
+        ])
+
+        for start in range(0, users, SEED_CHUNK_SIZE):
+            user_rows, state_rows, referral_rows = [], [], []
+            for i in range(start, min(start + SEED_CHUNK_SIZE, users)):
+                user_id = uuid.UUID(int=rng.getrandbits(128), version=4)
+                path = []
+                if ids and rng.random() < REFERRED_SHARE:
+                    owner = rng.randrange(len(ids))
+                    path = [ids[owner], *paths[owner]][:MAX_REFERRAL_LEVEL]
+                tg_id = f'{TG_ID_PREFIX}{i}'
+                ids.append(user_id)
+                paths.append(path)
+                tg_ids.append(tg_id)
+
+                user_rows.append(dict(
+                    id=user_id, tg_id=tg_id, username=tg_id, first_name='load', last_name='test',
+                    referrer_id=path[0] if path else None, referral_path=path,
+                ))
+                state_rows.append(dict(
+                    user_id=user_id,
+                    total_capacity=rng.randint(100, 5000),
+                    game_balance=rng.randint(0, 10 ** 7),
+                    energy=energy_limit,
+                ))
+                referral_rows.extend(
+                    dict(owner_id=owner_id, referral_id=user_id, level_id=level)
+                    for level, owner_id in enumerate(path, start=1)
+                )
+            await ses.execute(insert(UserModel), user_rows)
+            await ses.execute(insert(UserStateModel), state_rows)
+            if referral_rows:
+                await ses.execute(insert(ReferralModel), referral_rows)
+
+        counts = defaultdict(int)
+        for path in paths:
+            for level, owner_id in enumerate(path, start=1):
+                counts[owner_id, level] += 1
+        count_rows = [dict(owner_id=owner_id, level=level, count=count) for (owner_id, level), count in counts.items()]
+        for start in range(0, len(count_rows), SEED_CHUNK_SIZE):
+            await ses.execute(insert(ReferralCountModel), count_rows[start:start + SEED_CHUNK_SIZE])
+        await ses.commit()
+
+    await db.dispose()
+    return tg_ids
+
+
+def start_server(env: dict[str, str], port: int, workers: int) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [
+            sys.executable, '-m', 'uvicorn', 'src.main:app', '--host', '127.0.0.1', '--port', str(port),
+            '--workers', str(workers), '--no-access-log', '--log-level', 'warning',
+        ],
+        env=env,
+    )
+    wait_for_port(port, timeout=60)
+    return server
+
+
+async def run_phase(
+        base_url: str,
+        duration: float,
+        concurrency: int,
+        tg_ids: list[str],
+        weights: dict[str, int],
+        taps: dict[str, int],
+        energy_limit: int,
+        rng: random.Random,
+        record: Callable[[str, float, bool], None],
+) -> None:
+    """
+    taps - счетчики тапов клиентов, общие для прогрева и замера: иначе в замере юзеры,
+    тапавшие при прогреве, присылали бы счетчик меньше серверного и шли по дешевому пути "тапов нет"
+    """
+    endpoints, endpoint_weights = list(weights), list(weights.values())
+    deadline = time.perf_counter() + duration
+
+    async def virtual_user(vu_rng: random.Random) -> None:
+        while time.perf_counter() < deadline:
+            endpoint = vu_rng.choices(endpoints, endpoint_weights)[0]
+            method, url, params = build_request(endpoint, vu_rng.choice(tg_ids), taps, energy_limit, vu_rng)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, url, params=params)
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            record(endpoint, time.perf_counter() - started, ok)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        await asyncio.gather(*[virtual_user(random.Random(rng.random())) for _ in range(concurrency)])
+
+
+async def load(args: argparse.Namespace, env: dict[str, str]) -> tuple[int, dict[str, dict[str, Any]]]:
+    from benchmarks.common import summarize
+    from src.settings import get_settings
+
+    rng = random.Random(args.seed)
+    weights = parse_mix(args.mix)
+    energy_limit = get_settings().energy_limit
+    taps: dict[str, int] = {}
+
+    await setup_schema()
+    tg_ids = await seed(args.users, rng)
+
+    port = free_port()
+    server = start_server(env, port, args.workers)
+    try:
+        base_url = f'http://127.0.0.1:{port}'
+        await run_phase(
+            base_url, args.warmup, args.concurrency, tg_ids, weights, taps, energy_limit, rng, lambda *_: None)
+
+        samples = defaultdict(list)
+        errors = defaultdict(int)
+
+        def record(endpoint: str, elapsed: float, ok: bool) -> None:
+            samples[endpoint].append(elapsed)
+            if not ok:
+                errors[endpoint] += 1
+
+        started = time.perf_counter()
+        await run_phase(base_url, args.duration, args.concurrency, tg_ids, weights, taps, energy_limit, rng, record)
+        elapsed = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait()
+
+    results = {}
+    all_samples = []
+    for endpoint in weights:
+        results[endpoint] = dict(
+            **summarize(samples[endpoint]),
+            rps=round(len(samples[endpoint]) / elapsed, 1),
+            errors=errors[endpoint],
+        )
+        all_samples.extend(samples[endpoint])
+    results['total'] = dict(
+        **summarize(all_samples),
+        rps=round(len(all_samples) / elapsed, 1),
+        errors=sum(errors.values()),
+    )
+    return len(tg_ids), results
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args: argparse.Namespace) -> None:
+    with local_stack(args.pg_bin) as stack_env:
+        # настройки приложения читаются при первом импорте src, поэтому модули src
+        # импортируются только после того, как окружение указывает на локальные базы
+        env = dict(os.environ, RUN_TYPE='dev', DEBUG='false', DB_ECHO='false', **stack_env)
+        os.environ.update(env)
+        started_at = datetime.now(timezone.utc).isoformat()
+        users, results = asyncio.run(load(args, env))
+
+    from benchmarks.common import print_report
+
+    title = (f'load test, {users} users, {args.concurrency} virtual users, '
+             f'{args.duration} sec, {args.workers} workers, mix {args.mix}')
+    print_report(title, results)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(dict(
+                title=title,
+                commit=git_commit(),
+                started_at=started_at,
+                config=dict(
+                    users=args.users, concurrency=args.concurrency, duration=args.duration,
+                    warmup=args.warmup, workers=args.workers, mix=parse_mix(args.mix), seed=args.seed,
+                ),
+                results=results,
+            ), f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--warmup', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--pg-bin', default=None)
+    parser.add_argument('--json', dest='json_path', default=None)
+    main(parser.parse_args())
@@ -0,0 +1,102 @@
+"""
+Локальные postgres и redis для нагрузочного теста (без docker).
+
+Процессы запускаются из установленных бинарников (initdb/pg_ctl и redis-server) во временной
+директории на свободных портах и удаляются при выходе. Директорию с бинарниками postgres
+можно указать явно (--pg-bin), иначе она ищется в PATH и через pg_config --bindir.
+postgres не запускается от root.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'Port {port} is not accepting connections after {timeout} sec')
+
+
+def find_pg_bin(pg_bin: Optional[str] = None) -> str:
+    if pg_bin:
+        return pg_bin
+    pg_ctl = shutil.which('pg_ctl')
+    if pg_ctl:
+        return os.path.dirname(pg_ctl)
+    pg_config = shutil.which('pg_config')
+    if pg_config:
+        return subprocess.check_output([pg_config, '--bindir'], text=True).strip()
+    raise RuntimeError('Postgres binaries not found, pass --pg-bin')
+
+
+@contextmanager
+def local_stack(pg_bin: Optional[str] = None) -> Iterator[dict[str, str]]:
+    """
+    Запускает postgres и redis, возвращает переменные окружения для настроек приложения
+    """
+    pg_bin = find_pg_bin(pg_bin)
+    redis_server = shutil.which('redis-server')
+    if redis_server is None:
+        raise RuntimeError('redis-server not found in PATH')
+
+    workdir = tempfile.mkdtemp(prefix='clicker-loadtest-')
+    pg_data = os.path.join(workdir, 'pg')
+    pg_port, redis_port = free_port(), free_port()
+    redis_proc = None
+    pg_started = False
+    try:
+        subprocess.run(
+            [os.path.join(pg_bin, 'initdb'), '-D', pg_data, '-U', 'postgres', '--auth=trust', '--no-sync'],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        subprocess.run(
+            [
+                os.path.join(pg_bin, 'pg_ctl'), '-D', pg_data, '-l', os.path.join(workdir, 'pg.log'), '-w',
+                '-o', f'-p {pg_port} -k {workdir} -c listen_addresses=127.0.0.1 -c max_connections=300',
+                'start',
+            ],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        pg_started = True
+
+        redis_proc = subprocess.Popen(
+            [
+                redis_server, '--port', str(redis_port), '--bind', '127.0.0.1',
+                '--save', '', '--appendonly', 'no', '--dir', workdir,
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+        wait_for_port(redis_port)
+
+        redis_url = f'redis://127.0.0.1:{redis_port}/0'
+        yield dict(
+            DB_URL=f'postgresql+asyncpg://postgres@127.0.0.1:{pg_port}/postgres',
+            REDIS_BROKER_URL=redis_url,
+            AIOREDIS_URL=redis_url,
+        )
+    finally:
+        if redis_proc is not None:
+            redis_proc.terminate()
+            redis_proc.wait()
+        if pg_started:
+            subprocess.run(
+                [os.path.join(pg_bin, 'pg_ctl'), '-D', pg_data, '-m', 'fast', '-w', 'stop'],
+                stdout=subprocess.DEVNULL,
+            )
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -1,7 +1,14 @@
+import base64
+import decimal
+import json
+import uuid
+from datetime import datetime
+
 from src.core.enums import SortType
-from typing import Any, Dict, Generic, List, Optional, TypeVar, Union
+from src.core.exceptions import InvalidCursorException
+from typing import Any, Dict, Generic, List, Optional, Tuple, TypeVar, Union
 
-from sqlalchemy import select, insert, update, delete, text, desc, asc
+from sqlalchemy import select, insert, update, delete, text, desc, asc, tuple_, literal
 from sqlalchemy.sql import func
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -16,6 +23,43 @@ CreateSchemaType = TypeVar("CreateSchemaType", bound=BaseModel)
 UpdateSchemaType = TypeVar("UpdateSchemaType", bound=BaseModel)
 
 
+def encode_cursor(values: List[Any]) -> str:
+    """
+    Непрозрачный курсор для keyset-пагинации из значений ключа сортировки последней записи
+    """
+    raw = json.dumps(values, default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidCursorException
+    if not isinstance(values, list):
+        raise InvalidCursorException
+    return values
+
+
+def _cursor_value(value: Any, column) -> Any:
+    # json хранит uuid, datetime и decimal строками, возвращаем им тип столбца
+    if value is None:
+        return None
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    try:
+        if python_type is datetime:
+            return datetime.fromisoformat(value)
+        if python_type in (uuid.UUID, decimal.Decimal):
+            return python_type(value)
+    except (ValueError, TypeError, decimal.InvalidOperation):
+        raise InvalidCursorException
+    return value
+
+
 class BaseDAO(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
     model = None
 
@@ -64,6 +108,55 @@ class BaseDAO(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         return result.scalars().all()
 
 
+    @classmethod
+    async def find_page(
+        cls,
+        session: AsyncSession,
+        *filter,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+        order_by: str = 'id',
+        sort_type: str = SortType.ASC,
+        **filter_by
+    ) -> Tuple[List[ModelType], Optional[str]]:
+        """
+        Keyset-пагинация: вместо OFFSET записи отбираются по условию (order_by, id) > курсора,
+        поэтому стоимость страницы не зависит от ее номера.\n
+        order_by - NOT NULL столбец модели, id добавляется к сортировке для однозначности.
+        Возвращает записи и курсор следующей страницы (None, если страница последняя)
+        """
+        pk = cls.model.id
+        sort_column = getattr(cls.model, order_by)
+        keys = [pk] if order_by == 'id' else [sort_column, pk]
+
+        stmt = select(cls.model).filter(*filter).filter_by(**filter_by)
+        if cursor is not None:
+            values = decode_cursor(cursor)
+            if len(values) != len(keys):
+                raise InvalidCursorException
+            last_key = tuple_(*[
+                literal(_cursor_value(value, column), column.type)
+                for value, column in zip(values, keys)
+            ])
+            if sort_type == SortType.ASC:
+                stmt = stmt.where(tuple_(*keys) > last_key)
+            else:
+                stmt = stmt.where(tuple_(*keys) < last_key)
+
+        if sort_type == SortType.ASC:
+            stmt = stmt.order_by(*[asc(column) for column in keys])
+        else:
+            stmt = stmt.order_by(*[desc(column) for column in keys])
+
+        result = await session.execute(stmt.limit(limit + 1))
+        items = result.scalars().all()
+
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = encode_cursor([getattr(items[-1], column.key) for column in keys])
+        return items, next_cursor
+
     @classmethod
     async def find_by_id(cls, session: AsyncSession, id: Any) -> Optional[ModelType]:
         stmt = select(cls.model).where(cls.model.id == id)
@@ -163,10 +256,20 @@ class BaseDAO(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
             return None
 
     @classmethod
-    async def update_bulk(cls, session: AsyncSession, data: List[Dict[str, Any]]):
+    async def update_bulk(cls, session: AsyncSession, data: List[Dict[str, Any]], *where, **values):
+        """
+        Без where/values - ORM bulk update по первичному ключу (в каждом словаре data должен быть id).
+        С where/values - один UPDATE с bindparam, выполняемый как executemany,
+        так в values можно передавать выражения (например инкременты столбцов)
+        """
         try:
-            stmt = update(cls.model)
-            await session.execute(update(cls.model), data)
+            if where or values:
+                stmt = update(cls.model).where(*where).values(**values)
+                conn = await session.connection()
+                await conn.execute(stmt, data)
+            else:
+                await session.execute(update(cls.model), data)
+            return True
         except (SQLAlchemyError, Exception) as e:
             msg = ''
             if isinstance(e, SQLAlchemyError):
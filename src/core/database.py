@@ -7,6 +7,8 @@ from sqlalchemy import String, MetaData
 
 from src.settings import get_settings
 from src.core.constants import DB_NAMING_CONVENTION
+from src.core.metrics import MeteredQueuePool, instrument_engine
+from src.core.query_profiler import profile_queries
 
 cfg = get_settings()
 
@@ -49,7 +51,10 @@ class DatabaseHelper:
             pool_size=pool_size,
             pool_pre_ping=pool_pre_ping,
             max_overflow=max_overflow,
+            poolclass=MeteredQueuePool,
         )
+        instrument_engine(self.engine)
+        profile_queries(self.engine)
         self.session_factory: async_sessionmaker[AsyncSession] = async_sessionmaker(
             bind=self.engine,
             autoflush=False,
@@ -9,3 +9,8 @@ class SortType(str, Enum):
 class RatingType(str, Enum):
     gdp = 'gdp'
     capacity = 'capacity'
+
+
+class EnergyRestorePolicy(str, Enum):
+    midnight = 'midnight'  # полное восстановление в полночь по часовому поясу юзера
+    interval = 'interval'  # полное восстановление через energy_restore_interval_hours после прошлого
@@ -13,4 +13,9 @@ class TokenExpiredException(HTTPException):
 
 class InvalidCredentialsException(HTTPException):
     def __init__(self):
-        super().__init__(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid telegram_id")
\ No newline at end of file
+        super().__init__(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid telegram_id")
+
+
+class InvalidCursorException(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
@@ -0,0 +1,214 @@
+import os
+import time
+
+from src.settings import get_settings
+
+cfg = get_settings()
+
+if cfg.metrics_multiproc_dir:
+    # prometheus_client выбирает хранение значений в файлах по этой переменной при импорте
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', cfg.metrics_multiproc_dir)
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+    start_http_server,
+)
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+UNMATCHED_ROUTE = '<unmatched>'
+
+HTTP_REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds',
+    'Время обработки HTTP-запроса по шаблону маршрута',
+    ['method', 'route', 'status'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0),
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    'http_requests_in_flight',
+    'HTTP-запросы в обработке',
+    ['method'],
+    multiprocess_mode='livesum',
+)
+
+HTTP_REQUEST_DB_QUERIES = Histogram(
+    'http_request_db_queries',
+    'SQL-запросы за один HTTP-запрос по шаблону маршрута',
+    ['route'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100),
+)
+HTTP_REQUEST_DB_DURATION = Histogram(
+    'http_request_db_duration_seconds',
+    'Суммарное время SQL-запросов за один HTTP-запрос по шаблону маршрута',
+    ['route'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+HTTP_REQUEST_N_PLUS_ONE = Counter(
+    'http_request_n_plus_one',
+    'HTTP-запросы с повторяющимися одинаковыми SQL-запросами (вероятный N+1)',
+    ['route'],
+)
+
+TAP_SETTLEMENTS = Counter(
+    'tap_settlements',
+    'Запросы на начисление тапов по результату',
+    ['mode', 'result'],
+)
+SIGNUPS = Counter(
+    'user_signups',
+    'Регистрации юзеров',
+    ['referred'],
+)
+
+TELEGRAM_DUPLICATE_UPDATES = Counter(
+    'telegram_duplicate_updates',
+    'Повторные доставки обновлений telegram, отброшенные по update_id',
+)
+
+BOT_API_REQUEST_DURATION = Histogram(
+    'bot_api_request_duration_seconds',
+    'Время запроса к Bot API по методу и результату',
+    ['method', 'result'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+BOT_API_REQUESTS_IN_FLIGHT = Gauge(
+    'bot_api_requests_in_flight',
+    'Запросы к Bot API в обработке, включая ожидающие свободного слота',
+    multiprocess_mode='livesum',
+)
+BOT_API_CIRCUIT_OPENED = Counter(
+    'bot_api_circuit_opened',
+    'Размыкания цепи запросов к Bot API после серии ошибок',
+)
+
+BROADCAST_MESSAGES = Counter(
+    'broadcast_messages',
+    'Сообщения рассылок по результату отправки',
+    ['result'],
+)
+
+DB_POOL_SIZE = Gauge(
+    'db_pool_size',
+    'Постоянные соединения пула SQLAlchemy',
+    multiprocess_mode='livesum',
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    'db_pool_checked_out_connections',
+    'Соединения пула, выданные сессиям',
+    multiprocess_mode='livesum',
+)
+DB_POOL_OVERFLOW = Gauge(
+    'db_pool_overflow_connections',
+    'Соединения сверх pool_size (max_overflow)',
+    multiprocess_mode='livesum',
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    'db_pool_checkout_wait_seconds',
+    'Ожидание соединения из пула (включая открытие нового соединения)',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+
+
+class MeteredQueuePool(AsyncAdaptedQueuePool):
+    """
+    Пул соединений, замеряющий время ожидания соединения
+    """
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """
+    Обновляет метрики пула при каждой выдаче и возврате соединения.
+    Событие checkin приходит до того, как пул принял соединение обратно (pool.checkedout()
+    его еще считает), поэтому выданные соединения считаются по событиям, а не читаются из пула
+    """
+    pool = engine.sync_engine.pool
+
+    def on_checkout(*args) -> None:
+        DB_POOL_CHECKED_OUT.inc()
+        DB_POOL_OVERFLOW.set(max(pool.overflow(), 0))
+
+    def on_checkin(*args) -> None:
+        DB_POOL_CHECKED_OUT.dec()
+        # в заполненный пул соединение не вернется: оно закроется, и overflow уменьшится
+        overflow = pool.overflow() - 1 if pool.checkedin() >= pool.size() else pool.overflow()
+        DB_POOL_OVERFLOW.set(max(overflow, 0))
+
+    DB_POOL_SIZE.set(pool.size())
+    event.listen(pool, 'checkout', on_checkout)
+    event.listen(pool, 'checkin', on_checkin)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware: время обработки запросов по шаблону маршрута (/user/{tg_id}, а не сам путь)
+    и кол-во запросов в обработке. Маршрут известен только после роутинга,
+    fastapi записывает его в scope['route']
+    """
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        method = scope['method']
+        in_flight = HTTP_REQUESTS_IN_FLIGHT.labels(method)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_flight.dec()
+            route = getattr(scope.get('route'), 'path', UNMATCHED_ROUTE)
+            HTTP_REQUEST_DURATION.labels(method, route, str(status_code)).observe(time.perf_counter() - started)
+
+
+def _registry() -> CollectorRegistry:
+    """
+    При нескольких процессах (PROMETHEUS_MULTIPROC_DIR) значения собираются из файлов всех процессов
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def metrics_response() -> Response:
+    """
+    Метрики в формате prometheus
+    """
+    return Response(generate_latest(_registry()), media_type=CONTENT_TYPE_LATEST)
+
+
+def start_metrics_server(port: int) -> None:
+    """
+    Отдельный http-сервер метрик для процессов без fastapi (воркер telegram)
+    """
+    start_http_server(port, addr='0.0.0.0', registry=_registry())
+
+
+def mark_process_dead() -> None:
+    """
+    Убирает livesum-метрики остановленного процесса из общих значений
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
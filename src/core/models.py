@@ -2,10 +2,11 @@ import uuid
 import decimal
 from datetime import datetime
 
-from sqlalchemy import ForeignKey, TIMESTAMP, UUID, func, String
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import ForeignKey, TIMESTAMP, UUID, func, String, BigInteger
+from sqlalchemy.dialects.postgresql import JSONB, ARRAY
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy.schema import CheckConstraint
+from sqlalchemy.ext.associationproxy import association_proxy, AssociationProxy
+from sqlalchemy.schema import CheckConstraint, Index
 from typing_extensions import List, Any
 
 from src.core.database import Base
@@ -48,13 +49,27 @@ class UserModel(Base):
         uselist=False,
     )
 
-    total_capacity: Mapped[int] = mapped_column(default=0)
-    total_boost_value: Mapped[int] = mapped_column(default=0, server_default='0')
+    # часто меняющиеся счетчики живут в узкой таблице user_state (см. UserStateModel),
+    # прокси оставляют их доступными как атрибуты юзера для чтения и записи через ORM,
+    # в SQL-выражениях нужно использовать столбцы UserStateModel
+    state: Mapped["UserStateModel"] = relationship(
+        back_populates="user",
+        uselist=False,
+        lazy='joined',
+        innerjoin=True,
+        cascade='all, delete-orphan',
+    )
+    total_capacity: AssociationProxy[int] = association_proxy('state', 'total_capacity')
+    total_boost_value: AssociationProxy[int] = association_proxy('state', 'total_boost_value')
+    energy: AssociationProxy[int] = association_proxy('state', 'energy')
+    last_energy_update: AssociationProxy[datetime] = association_proxy('state', 'last_energy_update')
+    game_balance: AssociationProxy[int] = association_proxy('state', 'game_balance')
+    last_accrued_at: AssociationProxy[datetime] = association_proxy('state', 'last_accrued_at')
 
     users_rating_position: Mapped[int] = mapped_column(nullable=True)
     capacity_rating_position: Mapped[int] = mapped_column(nullable=True)
 
-    energy: Mapped[int] = mapped_column(default=cfg.energy_limit)
+    timezone: Mapped[str] = mapped_column(String(50), default='UTC', server_default='UTC')
     boosts: Mapped[List["UserBoostModel"]] = relationship(
         back_populates="user",
         uselist=True
@@ -69,7 +84,6 @@ class UserModel(Base):
         uselist=True,
     )
 
-    game_balance: Mapped[int] = mapped_column(default=0)  # это ВВП
     donate_balance: Mapped[int] = mapped_column(default=0)
     token_balance: Mapped[decimal.Decimal] = mapped_column(default=0.0)
 
@@ -86,6 +100,11 @@ class UserModel(Base):
         ForeignKey('users.id', onupdate='CASCADE', ondelete='SET NULL'),
         nullable=True
     )
+    # пригласившие юзера вверх по цепочке: [пригласивший, его пригласивший, ...],
+    # не длиннее MAX_REFERRAL_LEVEL, индекс в массиве (с 1) - уровень реферала
+    referral_path: Mapped[List[uuid.UUID]] = mapped_column(
+        ARRAY(UUID), default=list, server_default='{}', nullable=False
+    )
     referrals = relationship(
         'ReferralModel',
         back_populates='owner',
@@ -105,15 +124,58 @@ class UserModel(Base):
     is_superuser: Mapped[bool] = mapped_column(default=False, nullable=False)
     is_verified: Mapped[bool] = mapped_column(default=False, nullable=False)
     is_active: Mapped[bool] = mapped_column(default=True, nullable=False)
+    # юзер заблокировал бота (telegram ответил 403 при рассылке), снимается при /start
+    bot_blocked_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=True)
 
     __table_args__ = (
         CheckConstraint(
             f'enterprises_slots <= {cfg.enterprises_max_slots}',
             name='check_enterprises_slots_max_value'
         ),
+        # поиск всех рефералов юзера на любом уровне: referral_path @> ARRAY[user_id]
+        Index('users_referral_path_idx', 'referral_path', postgresql_using='gin'),
     )
 
 
+class UserStateModel(Base):
+    """
+    Счетчики юзера, которые меняются при каждом тапе. Узкая строка без вторичных индексов:
+    обновления не переписывают широкую строку users и остаются HOT-обновлениями
+    (fillfactor=70, см. db_functions.user_state_fillfactor)
+    """
+    __tablename__ = 'user_state'
+
+    user_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey('users.id', onupdate='CASCADE', ondelete='CASCADE'),
+        primary_key=True
+    )
+    user: Mapped["UserModel"] = relationship(back_populates="state")
+
+    total_capacity: Mapped[int] = mapped_column(default=0, server_default='0')
+    total_boost_value: Mapped[int] = mapped_column(default=0, server_default='0')
+
+    energy: Mapped[int] = mapped_column(default=cfg.energy_limit, server_default=str(cfg.energy_limit))
+    # энергия восстанавливается лениво при чтении/тапах, см. economy.restored_energy
+    last_energy_update: Mapped[datetime] = mapped_column(
+        TIMESTAMP(timezone=True),
+        server_default=func.now()
+    )
+
+    game_balance: Mapped[int] = mapped_column(default=0, server_default='0')  # это ВВП
+    # пассивный доход (total_capacity в час) начисляется лениво, см. economy.passive_income
+    last_accrued_at: Mapped[datetime] = mapped_column(
+        TIMESTAMP(timezone=True),
+        server_default=func.now()
+    )
+
+    # последний примененный сброс тапов из redis (tap write-behind),
+    # нужен, чтобы повторный сброс после падения воркера не начислил баланс дважды
+    tap_flush_seq: Mapped[int] = mapped_column(BigInteger, default=0, server_default='0')
+    # ВВП юзера, с которого уже начислены комиссии пригласившим (см. CommissionService),
+    # комиссии, полученные самим юзером, сдвигают его сразу и заработком не считаются
+    commission_watermark: Mapped[int] = mapped_column(BigInteger, default=0, server_default='0')
+
+
 class RefreshSessionModel(Base):
     __tablename__ = 'refresh_session'
 
@@ -268,3 +330,17 @@ class ReferralModel(Base):
         back_populates='referrals',
         foreign_keys=[owner_id]
     )
+
+
+class ReferralCountModel(Base):
+    """
+    Кол-во рефералов юзера по уровням, обновляется в той же транзакции, что и user_referrals
+    """
+    __tablename__ = 'referral_counts'
+
+    owner_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey('users.id', onupdate="CASCADE", ondelete="CASCADE"),
+        primary_key=True
+    )
+    level: Mapped[int] = mapped_column(primary_key=True)
+    count: Mapped[int] = mapped_column(default=0, server_default='0', nullable=False)
@@ -0,0 +1,113 @@
+import time
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.core.metrics import (
+    UNMATCHED_ROUTE, HTTP_REQUEST_DB_QUERIES, HTTP_REQUEST_DB_DURATION, HTTP_REQUEST_N_PLUS_ONE
+)
+from src.settings import get_settings
+from loguru import logger as log
+
+cfg = get_settings()
+
+_START_TIMES_KEY = 'query_profiler_started'
+
+
+@dataclass
+class QueryProfile:
+    """
+    SQL-запросы одного HTTP-запроса. Вид запроса - текст SQL с плейсхолдерами
+    (значения параметров не входят), поэтому одинаковые запросы с разными аргументами совпадают
+    """
+    count: int = 0
+    duration: float = 0.0
+    shapes: Counter = field(default_factory=Counter)
+
+    def repeated(self) -> dict[str, int]:
+        """
+        Виды запросов, выполненные не меньше cfg.sql_n_plus_one_threshold раз
+        """
+        return {
+            statement: count for statement, count in self.shapes.items()
+            if count >= cfg.sql_n_plus_one_threshold
+        }
+
+
+# sqlalchemy переносит контекст задачи в greenlet, где выполняются события курсора
+_current_profile: ContextVar[Optional[QueryProfile]] = ContextVar('query_profile', default=None)
+
+
+def profile_queries(engine: AsyncEngine) -> None:
+    """
+    Подписывается на события курсора движка: запросы, выполненные внутри
+    QueryProfilerMiddleware, учитываются в профиле текущего HTTP-запроса
+    """
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault(_START_TIMES_KEY, []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        started = conn.info[_START_TIMES_KEY].pop()
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.count += 1
+            profile.duration += time.perf_counter() - started
+            profile.shapes[statement] += 1
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def handle_error(exception_context) -> None:
+        # after_cursor_execute не вызывается для упавшего запроса
+        conn = exception_context.connection
+        if conn is not None and conn.info.get(_START_TIMES_KEY):
+            conn.info[_START_TIMES_KEY].pop()
+
+
+class QueryProfilerMiddleware:
+    """
+    ASGI middleware: кол-во и суммарное время SQL-запросов за HTTP-запрос.\n
+    В debug режиме значения отдаются в заголовках ответа (X-DB-Queries, X-DB-Time-Ms,
+    X-DB-Repeated-Queries), а повторяющиеся запросы логируются. Всегда пишутся
+    метрики по шаблону маршрута, включая счетчик запросов с вероятным N+1
+    """
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or not cfg.sql_profiling_enabled:
+            await self.app(scope, receive, send)
+            return
+
+        profile = QueryProfile()
+
+        async def send_with_headers(message: Message) -> None:
+            if cfg.debug and message['type'] == 'http.response.start':
+                headers = MutableHeaders(scope=message)
+                headers['X-DB-Queries'] = str(profile.count)
+                headers['X-DB-Time-Ms'] = f'{profile.duration * 1000:.2f}'
+                headers['X-DB-Repeated-Queries'] = str(len(profile.repeated()))
+            await send(message)
+
+        token = _current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            _current_profile.reset(token)
+            route = getattr(scope.get('route'), 'path', UNMATCHED_ROUTE)
+            HTTP_REQUEST_DB_QUERIES.labels(route).observe(profile.count)
+            HTTP_REQUEST_DB_DURATION.labels(route).observe(profile.duration)
+            repeated = profile.repeated()
+            if repeated:
+                HTTP_REQUEST_N_PLUS_ONE.labels(route).inc()
+                if cfg.debug:
+                    for statement, count in repeated.items():
+                        log.warning(f'Probable N+1 in {scope["method"]} {route}: {count}x {statement[:300]}')
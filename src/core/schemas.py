@@ -1,11 +1,29 @@
+from typing import Generic, Optional, TypeVar
+
 from pydantic import BaseModel, Field
 
+T = TypeVar('T')
+
 
 class Pagination(BaseModel):
     offset: int = Field(default=0)
     limit: int = Field(default=100, gt=0, le=200)
 
 
+class CursorPagination(BaseModel):
+    cursor: Optional[str] = Field(default=None)
+    limit: int = Field(default=100, gt=0, le=200)
+
+
+class Page(BaseModel, Generic[T]):
+    items: list[T]
+    next_cursor: Optional[str] = None
+
+
 class StarsTransactionPagination(BaseModel):
     offset: int = Field(default=0)
     limit: int = Field(default=100, gt=0, le=100)
+
+
+class RatingWindow(BaseModel):
+    size: int = Field(default=10, gt=0, le=50)
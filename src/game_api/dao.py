@@ -1,4 +1,4 @@
-from src.core.models import (UserModel, ReferralModel, StarsPaymentModel,
+from src.core.models import (UserModel, UserStateModel, ReferralModel, ReferralCountModel, StarsPaymentModel,
                              CountryModel, RegionModel, EnterpriseModel,
                              EnterpriseTypeModel, UserEnterpriseModel,
                              BoostModel, UserBoostModel, CaseModel, GdpUserRatingModel, CapacityUserRatingModel,
@@ -25,10 +25,18 @@ class UserDAO(BaseDAO[UserModel, UserCreate, UserUpdate]):
     model = UserModel
 
 
+class UserStateDAO(BaseDAO[UserStateModel, None, None]):
+    model = UserStateModel
+
+
 class UserReferralDAO(BaseDAO[ReferralModel, UserReferralCreate, UserReferralUpdate]):
     model = ReferralModel
 
 
+class ReferralCountDAO(BaseDAO[ReferralCountModel, None, None]):
+    model = ReferralCountModel
+
+
 class GdpUserRatingDAO(BaseDAO[GdpUserRatingModel, None, None]):
     model = GdpUserRatingModel
 
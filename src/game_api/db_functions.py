@@ -1,76 +1,183 @@
+from src.settings import get_settings
+
+cfg = get_settings()
+
 # ШАБЛОН - Запуск каждую минуту
 # SELECT cron.schedule('* * * * *', 'SELECT function_name()');
 
 # CREATE EXTENSION pg_cron;
 
-# вызов каждый час
-# SELECT cron.schedule('0 * * * *', 'SELECT update_game_balance()');
-# SELECT cron.schedule('0 * * * *', 'SELECT update_country_ratings()');
-
-# вызов каждые 24 часа
-# SELECT cron.schedule('0 0 * * *', 'SELECT recharge_user_energy()');
-# SELECT cron.schedule('0 0 * * *', 'SELECT calculate_and_append_referral_commissions()');
-
-
-
 
-# восстановление энергии юзера
-# вызывается раз в 24 часа
-recharge_user_energy = """
-BEGIN
-    UPDATE users
-    SET energy = 500;
-END
-"""
+# восстановление энергии юзера больше не выполняется по расписанию:
+# энергия восстанавливается лениво при чтении и тапах (см. economy.restored_energy).
+# Задачу pg_cron для recharge_user_energy() нужно снять (SELECT cron.unschedule(jobid)),
+# а саму функцию удалить: DROP FUNCTION recharge_user_energy();
 
-# обновление рейтинга по странам
-# вызывается каждый час
-update_country_ratings = """
-BEGIN
-    DELETE FROM country_ratings;
-    INSERT INTO country_ratings
+# рейтинг по странам больше не пересобирается функцией pg_cron: он ведется инкрементально
+# (см. CountryRatingService), а раз в час сверяется этим запросом в транзакции REPEATABLE READ
+# (CountryRatingService.run_reconciler в воркерах api или
+# python -m src.game_api.repeat_tasks reconcile_country_ratings).
+# Задачу pg_cron для update_country_ratings() нужно снять, а функцию удалить:
+# DROP FUNCTION update_country_ratings();
+# Пересчет - один запрос (вставка/обновление изменившихся стран и удаление пропавших),
+# поэтому читатели никогда не видят пустую или частично заполненную таблицу
+reconcile_country_ratings = """
+WITH fresh AS (
     SELECT
         countries.id AS country_id,
         COUNT(users.id) AS user_count,
-        SUM(users.game_balance) AS total_balance
+        COALESCE(SUM(effective_game_balance(user_state)), 0) AS total_balance
     FROM
         users
+    JOIN
+        user_state ON user_state.user_id = users.id
     JOIN
         countries ON users.country_id = countries.id
     GROUP BY
-        countries.id;
-END;
+        countries.id
+), upserted AS (
+    INSERT INTO country_ratings (country_id, user_count, total_balance)
+    SELECT country_id, user_count, total_balance FROM fresh
+    ON CONFLICT (country_id) DO UPDATE
+    SET user_count = EXCLUDED.user_count, total_balance = EXCLUDED.total_balance
+    WHERE (country_ratings.user_count, country_ratings.total_balance)
+        IS DISTINCT FROM (EXCLUDED.user_count, EXCLUDED.total_balance)
+)
+DELETE FROM country_ratings
+WHERE country_id NOT IN (SELECT country_id FROM fresh);
+"""
+
+# изменения ВВП стран от тапов и комиссий: строка пишется в той же транзакции, что и изменение
+# баланса, и периодически сворачивается в country_ratings (flush_country_rating_deltas).
+# Только вставки, без горячей строки страны. UNLOGGED: после падения postgres таблица пуста,
+# потерянные изменения восстанавливает ближайшая сверка reconcile_country_ratings
+country_rating_deltas = """
+CREATE UNLOGGED TABLE IF NOT EXISTS country_rating_deltas (
+    country_id integer NOT NULL,
+    delta bigint NOT NULL
+);
+"""
+
+# забирает накопленные изменения и применяет их одним запросом
+flush_country_rating_deltas = """
+WITH claimed AS (
+    DELETE FROM country_rating_deltas RETURNING country_id, delta
+), summed AS (
+    SELECT country_id, SUM(delta) AS delta FROM claimed GROUP BY country_id
+)
+UPDATE country_ratings
+SET total_balance = country_ratings.total_balance + summed.delta
+FROM summed
+WHERE country_ratings.country_id = summed.country_id AND summed.delta <> 0;
 """
 
 # начисление игровой валюты в размере текущей производительности пользователя
-# вызывается каждый час
-update_game_balance = """
-BEGIN
-    UPDATE users
-    SET game_balance = game_balance + total_capacity;
-END;
+# больше не выполняется по расписанию: доход начисляется лениво при изменении баланса
+# (см. economy.passive_income), задачу pg_cron для update_game_balance() нужно снять,
+# а функцию удалить: DROP FUNCTION update_game_balance();
+
+# ВВП юзера с учетом еще не начисленного пассивного дохода,
+# нужно использовать везде, где баланс читается в SQL.
+# После переноса счетчиков в user_state прежнюю версию нужно удалить
+# до удаления столбцов из users: DROP FUNCTION effective_game_balance(users);
+effective_game_balance = """
+CREATE OR REPLACE FUNCTION effective_game_balance(s user_state) RETURNS bigint
+LANGUAGE sql STABLE AS $$
+    SELECT s.game_balance + s.total_capacity::bigint * GREATEST(
+        floor(extract(epoch FROM now()) / 3600) - floor(extract(epoch FROM s.last_accrued_at) / 3600),
+        0
+    )::bigint
+$$;
+"""
+
+# перенос часто меняющихся счетчиков из users в user_state (см. UserStateModel).
+# Ревизий alembic в репозитории нет, миграция применяется вручную при остановленном приложении
+# (python -m src.game_api.repeat_tasks split_user_state), в одной транзакции, по порядку:
+#   1. create_user_state
+#   2. split_user_state
+#   3. user_state_fillfactor
+#   4. DROP FUNCTION effective_game_balance(users); затем effective_game_balance
+#   5. drop_user_counters
+# Старая версия приложения после шага 4 уже не работает. Повторный запуск шагов 1-3 ничего не дублирует
+create_user_state = f"""
+CREATE TABLE IF NOT EXISTS user_state (
+    user_id uuid NOT NULL,
+    total_capacity integer DEFAULT 0 NOT NULL,
+    total_boost_value integer DEFAULT 0 NOT NULL,
+    energy integer DEFAULT {cfg.energy_limit} NOT NULL,
+    last_energy_update timestamp with time zone DEFAULT now() NOT NULL,
+    game_balance integer DEFAULT 0 NOT NULL,
+    last_accrued_at timestamp with time zone DEFAULT now() NOT NULL,
+    tap_flush_seq bigint DEFAULT 0 NOT NULL,
+    commission_watermark bigint DEFAULT 0 NOT NULL,
+    CONSTRAINT user_state_pkey PRIMARY KEY (user_id),
+    CONSTRAINT user_state_user_id_fkey FOREIGN KEY (user_id)
+        REFERENCES users (id) ON UPDATE CASCADE ON DELETE CASCADE
+);
+"""
+
+split_user_state = """
+INSERT INTO user_state (
+    user_id, total_capacity, total_boost_value, energy, last_energy_update,
+    game_balance, last_accrued_at, tap_flush_seq, commission_watermark
+)
+SELECT
+    id, total_capacity, total_boost_value, energy, last_energy_update,
+    game_balance, last_accrued_at, tap_flush_seq, commission_watermark
+FROM users
+ON CONFLICT (user_id) DO NOTHING;
+"""
+
+# запас места на странице, чтобы обновления счетчиков оставались HOT-обновлениями
+# (новая версия строки на той же странице, без записи в индекс первичного ключа)
+user_state_fillfactor = """
+ALTER TABLE user_state SET (fillfactor = 70);
+"""
+
+drop_user_counters = """
+ALTER TABLE users
+    DROP COLUMN total_capacity,
+    DROP COLUMN total_boost_value,
+    DROP COLUMN energy,
+    DROP COLUMN last_energy_update,
+    DROP COLUMN game_balance,
+    DROP COLUMN last_accrued_at,
+    DROP COLUMN tap_flush_seq,
+    DROP COLUMN commission_watermark;
+"""
+
+# заполнение users.referral_path для юзеров, созданных до его появления (разовая миграция данных
+# после добавления столбца), см. RepeatTasksService.backfill_referral_paths.
+# Путь собирается вверх по referrer_id, не длиннее 10 уровней
+backfill_referral_paths = """
+WITH RECURSIVE chain AS (
+    SELECT id AS user_id, referrer_id AS ancestor_id, 1 AS level
+    FROM users
+    WHERE referrer_id IS NOT NULL
+    UNION ALL
+    SELECT chain.user_id, users.referrer_id, chain.level + 1
+    FROM chain
+    JOIN users ON users.id = chain.ancestor_id
+    WHERE users.referrer_id IS NOT NULL AND chain.level < 10
+)
+UPDATE users
+SET referral_path = paths.path
+FROM (
+    SELECT user_id, array_agg(ancestor_id ORDER BY level) AS path
+    FROM chain
+    GROUP BY user_id
+) AS paths
+WHERE users.id = paths.user_id AND users.referral_path IS DISTINCT FROM paths.path;
 """
 
 # начисление процента заработанной валюты от рефералов пользователю
-# вызывается каждые 24 часа
-calculate_and_append_referral_commissions = """
-DECLARE
-    user_record RECORD;
-    referral_record RECORD;
-    commission_rate FLOAT;
-    earned_currency FLOAT;
-    commission_amount FLOAT;
-BEGIN
-    FOR user_record IN SELECT * FROM users LOOP
-        FOR referral_record IN SELECT * FROM user_referrals WHERE owner_id = user_record.id LOOP
-            SELECT commision_rate INTO commission_rate FROM referral_levels WHERE id = referral_record.level_id;
-            -- Получаем заработанную валюту рефералов
-            SELECT game_balance INTO earned_currency FROM users WHERE id = referral_record.referral_id;
-            -- Вычисляем итоговое кол-во начисляемой валюты
-            commission_amount := earned_currency * commission_rate;
-            -- Начисляем комиссионные пользователю
-            UPDATE users SET game_balance = game_balance + commission_amount WHERE id = user_record.id;
-        END LOOP;
-    END LOOP;
-END;
+# больше не выполняется функцией pg_cron: комиссии считает CommissionService порциями и только
+# с заработанного с прошлого запуска, раз в сутки (CommissionService.run_scheduler в воркерах api,
+# вручную - python -m src.game_api.repeat_tasks calculate_referral_commissions). Задачу pg_cron для calculate_and_append_referral_commissions() нужно снять,
+# а функцию удалить: DROP FUNCTION calculate_and_append_referral_commissions();
+
+# разовая установка водяных знаков комиссий при переходе на CommissionService,
+# чтобы первый запуск не начислил комиссии со всего накопленного ВВП рефералов
+init_commission_watermarks = """
+UPDATE user_state SET commission_watermark = effective_game_balance(user_state);
 """
\ No newline at end of file
@@ -0,0 +1,126 @@
+"""
+Игровые формулы.
+
+Одни и те же правила считаются в нескольких местах (python, SQL, lua-скрипты redis),
+поэтому python-версии живут здесь и служат эталоном для остальных реализаций.
+"""
+from datetime import datetime, timedelta, timezone, time
+from functools import cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+
+from sqlalchemy import BigInteger, case, cast, func
+
+from src.core.enums import EnergyRestorePolicy
+from src.settings import get_settings
+
+cfg = get_settings()
+
+
+def tap_reward(total_capacity: int, total_boost_value: int, taps: int) -> int:
+    """
+    Сколько ВВП приносят taps тапов.\n
+    Каждый тап дает (производительность + бонус буста) * 2,
+    бонус буста - процент от производительности, нулевой буст считается как 1%
+    """
+    boost = total_boost_value or 1
+    return 2 * total_capacity * taps * (100 + boost) // 100
+
+
+def tap_reward_sql(total_capacity, total_boost_value, taps):
+    """
+    SQL-выражение для tap_reward, аргументы - столбцы или выражения sqlalchemy
+    """
+    boost = case((total_boost_value == 0, 1), else_=total_boost_value)
+    return 2 * cast(total_capacity, BigInteger) * taps * (100 + boost) // 100
+
+
+@cache
+def _known_zones() -> frozenset[str]:
+    return frozenset(available_timezones())
+
+
+def is_known_zone(tz_name: str) -> bool:
+    """
+    Есть ли часовой пояс в базе IANA.\n
+    users.timezone уходит в postgres timezone() как есть, поэтому писать туда можно только такие имена
+    """
+    return tz_name in _known_zones()
+
+
+def _zone(tz_name: str | None) -> ZoneInfo:
+    try:
+        return ZoneInfo(tz_name or 'UTC')
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo('UTC')
+
+
+def next_energy_restore(last_energy_update: datetime, tz_name: str | None) -> datetime:
+    """
+    Момент следующего полного восстановления энергии по политике cfg.energy_restore_policy
+    """
+    if cfg.energy_restore_policy == EnergyRestorePolicy.interval:
+        return last_energy_update + timedelta(hours=cfg.energy_restore_interval_hours)
+
+    tz = _zone(tz_name)
+    local_date = last_energy_update.astimezone(tz).date()
+    return datetime.combine(local_date + timedelta(days=1), time(), tzinfo=tz)
+
+
+def restored_energy(
+        energy: int,
+        last_energy_update: datetime | None,
+        tz_name: str | None,
+        now: datetime | None = None,
+) -> tuple[int, datetime]:
+    """
+    Энергия юзера с учетом ленивого восстановления.\n
+    Возвращает энергию и время последнего восстановления,
+    в базу их нужно записать только при изменении энергии
+    """
+    now = now or datetime.now(timezone.utc)
+    if last_energy_update is None:
+        return cfg.energy_limit, now
+    if now >= next_energy_restore(last_energy_update, tz_name):
+        return cfg.energy_limit, now
+    return energy, last_energy_update
+
+
+def energy_restore_due_sql(last_energy_update, tz_name):
+    """
+    SQL-условие для restored_energy: пора ли восстановить энергию
+    """
+    if cfg.energy_restore_policy == EnergyRestorePolicy.interval:
+        return last_energy_update <= func.now() - timedelta(hours=cfg.energy_restore_interval_hours)
+
+    return (
+        func.date_trunc('day', func.timezone(tz_name, func.now()))
+        > func.date_trunc('day', func.timezone(tz_name, last_energy_update))
+    )
+
+
+def passive_income(
+        total_capacity: int,
+        last_accrued_at: datetime | None,
+        now: datetime | None = None,
+) -> int:
+    """
+    Пассивный доход, накопленный с last_accrued_at.\n
+    Начисляется total_capacity за каждое начало часа (как и почасовая задача pg_cron,
+    которую заменяет), поэтому после начисления last_accrued_at можно ставить в now
+    """
+    if last_accrued_at is None:
+        return 0
+    now = now or datetime.now(timezone.utc)
+    hours = int(now.timestamp() // 3600) - int(last_accrued_at.timestamp() // 3600)
+    return total_capacity * max(hours, 0)
+
+
+def passive_income_sql(total_capacity, last_accrued_at):
+    """
+    SQL-выражение для passive_income
+    """
+    hours = (
+        func.floor(func.extract('epoch', func.now()) / 3600)
+        - func.floor(func.extract('epoch', last_accrued_at) / 3600)
+    )
+    return cast(total_capacity, BigInteger) * func.greatest(cast(hours, BigInteger), 0)
@@ -1,15 +1,25 @@
+import argparse
+import asyncio
 import random
 from typing import Optional, Union, List, Any
 
 from fastapi import HTTPException, status
-from sqlalchemy import select, update, func
+from sqlalchemy import select, insert, update, delete, func, text
 from sqlalchemy.orm import selectinload, joinedload
 
 from src.core.enums import SortType
 from src.game_api.schemas.user_schemas import User
-from src.core.models import UserModel
+from src.core.models import UserModel, ReferralModel, ReferralCountModel
 from src.game_api.dao import UserDAO, EnterpriseDAO
 from src.core.database import db_helper as db
+from src.game_api.db_functions import (backfill_referral_paths, init_commission_watermarks, create_user_state,
+                                      split_user_state, user_state_fillfactor, effective_game_balance,
+                                      drop_user_counters)
+from src.game_api.services.leaderboard_service import LeaderboardService
+from src.game_api.services.catalog_service import CatalogService
+from src.game_api.services.commission_service import CommissionService
+from src.game_api.services.country_rating_service import CountryRatingService
+from src.redis_queue import queue
 
 from src.game_api.utils import exception_and_log, log
 from src.settings import get_settings
@@ -17,26 +27,124 @@ from src.settings import get_settings
 cfg = get_settings()
 
 
-# class RepeatTasksService:
-#     @classmethod
-#     async def restore_energy(cls):
-#         async with db.session_factory() as ses:
-#             users = await UserDAO.find_all(ses)
-#             if users is None:
-#                 raise HTTPException(
-#                     status_code=status.HTTP_404_NOT_FOUND,
-#                     detail='Users not found'
-#                 )
-#
-#         users = db.query(User).all()
-#         now_utc = datetime.utcnow().replace(tzinfo=pytz.utc)
-#
-#         for user in users:
-#             user_tz = pytz.timezone(user.timezone)
-#             user_now = now_utc.astimezone(user_tz)
-#
-#             if user.last_energy_update is None or (user_now - user.last_energy_update).total_seconds() >= 24 * 3600:
-#                 user.energy = 500
-#                 user.last_energy_update = user_now
-#
-#         db.commit()
\ No newline at end of file
+# Ежедневное восстановление энергии (restore_energy) заменено ленивым восстановлением
+# с политиками по часовому поясу юзера или интервалу, см. economy.restored_energy
+
+
+class RepeatTasksService:
+    """
+    Периодические и служебные задачи.\n
+    Запуск из консоли: python -m src.game_api.repeat_tasks <task>
+    """
+    @classmethod
+    async def rebuild_leaderboards(cls) -> None:
+        """
+        Пересборка рейтингов в redis из postgres (холодный старт, сверка раз в час)
+        """
+        await LeaderboardService.rebuild()
+
+    @classmethod
+    async def backfill_referral_paths(cls) -> None:
+        """
+        Разовое заполнение users.referral_path для существующих юзеров
+        """
+        async with db.session_factory() as ses:
+            result = await ses.execute(text(backfill_referral_paths))
+            await ses.commit()
+        log.info(f'Referral paths backfilled: {result.rowcount} users')
+
+    @classmethod
+    async def split_user_state(cls) -> None:
+        """
+        Разовый перенос счетчиков из users в user_state одной транзакцией
+        (приложение должно быть остановлено), см. db_functions.split_user_state
+        """
+        async with db.session_factory() as ses:
+            await ses.execute(text(create_user_state))
+            result = await ses.execute(text(split_user_state))
+            await ses.execute(text(user_state_fillfactor))
+            await ses.execute(text('DROP FUNCTION IF EXISTS effective_game_balance(users)'))
+            await ses.execute(text(effective_game_balance))
+            await ses.execute(text(drop_user_counters))
+            await ses.commit()
+        log.info(f'User counters moved to user_state: {result.rowcount} users')
+
+    @classmethod
+    async def repair_referral_counts(cls) -> None:
+        """
+        Пересчет счетчиков рефералов (referral_counts) из user_referrals.\n
+        Таблица счетчиков блокируется от записи на время пересчета: регистрации ждут его окончания
+        и применяют свои инкременты уже к пересчитанным значениям, чтение не блокируется
+        """
+        async with db.session_factory() as ses:
+            await ses.execute(text(f'LOCK TABLE {ReferralCountModel.__tablename__} IN EXCLUSIVE MODE'))
+            await ses.execute(delete(ReferralCountModel))
+            result = await ses.execute(
+                insert(ReferralCountModel).from_select(
+                    ['owner_id', 'level', 'count'],
+                    select(ReferralModel.owner_id, ReferralModel.level_id, func.count())
+                    .group_by(ReferralModel.owner_id, ReferralModel.level_id)
+                )
+            )
+            await ses.commit()
+        log.info(f'Referral counts repaired: {result.rowcount} rows')
+
+    @classmethod
+    async def calculate_referral_commissions(cls) -> None:
+        """
+        Начисление реферальных комиссий с заработанного с прошлого запуска
+        (раз в сутки запускается в воркерах api, см. CommissionService.run_scheduler)
+        """
+        await CommissionService.run()
+
+    @classmethod
+    async def init_commission_watermarks(cls) -> None:
+        """
+        Разовая установка водяных знаков комиссий по текущему ВВП юзеров
+        """
+        async with db.session_factory() as ses:
+            result = await ses.execute(text(init_commission_watermarks))
+            await ses.commit()
+        log.info(f'Commission watermarks initialized: {result.rowcount} users')
+
+    @classmethod
+    async def reconcile_country_ratings(cls) -> None:
+        """
+        Сверка рейтинга стран с users (подтягивает пассивный доход,
+        раз в час запускается в воркерах api, см. CountryRatingService.run_reconciler)
+        """
+        await CountryRatingService.reconcile()
+
+    @classmethod
+    async def reload_catalog(cls) -> None:
+        """
+        Перезагрузка справочников во всех воркерах после их изменения в базе
+        """
+        async with queue.get_broker():
+            version = await CatalogService.notify_changed()
+        log.info(f'Catalog version bumped to {version}')
+
+
+TASKS = {
+    'rebuild_leaderboards': RepeatTasksService.rebuild_leaderboards,
+    'reload_catalog': RepeatTasksService.reload_catalog,
+    'backfill_referral_paths': RepeatTasksService.backfill_referral_paths,
+    'split_user_state': RepeatTasksService.split_user_state,
+    'repair_referral_counts': RepeatTasksService.repair_referral_counts,
+    'calculate_referral_commissions': RepeatTasksService.calculate_referral_commissions,
+    'init_commission_watermarks': RepeatTasksService.init_commission_watermarks,
+    'reconcile_country_ratings': RepeatTasksService.reconcile_country_ratings,
+}
+
+
+async def main(task: str) -> None:
+    try:
+        await TASKS[task]()
+    finally:
+        await db.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Служебные задачи игрового API')
+    parser.add_argument('task', choices=TASKS.keys())
+    asyncio.run(main(parser.parse_args().task))
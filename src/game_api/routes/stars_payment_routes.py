@@ -19,7 +19,7 @@ stars_payment_router = APIRouter(prefix='/stars_payment', tags=["Stars payment"]
 
 
 class Timeout(BaseModel):
-    req_timeout: int = Field(default=100, ge=10)
+    req_timeout: int = Field(default=int(cfg.bot_api_timeout), ge=1, le=int(cfg.bot_api_max_timeout))
 
 
 @stars_payment_router.post("/getInvoiceLink")
@@ -53,7 +53,6 @@ async def make_refund(
     refund = await bot.refund_star_payment(
         user_id=user_id,
         telegram_payment_charge_id=transaction_id,
-        request_timeout=1000
     )
     return refund
 
@@ -75,7 +74,7 @@ async def get_stars_transactions(
 ):
     """
     Получение списка транзакций пользователя в telegram stars\n
-    req_timeout - время ожидания ответа в секундах
+    req_timeout - время ожидания ответа в секундах (не больше cfg.bot_api_max_timeout)
     """
     transactions = await stars_transactions(
         bot=bot,
@@ -1,16 +1,17 @@
 import uuid
 from typing import Optional, List, Any
 
-from fastapi import Request, APIRouter, Header, Depends, HTTPException, status
+from fastapi import Request, Response, APIRouter, Header, Depends, HTTPException, status
 from fastapi.responses import ORJSONResponse
 from pydantic import Field
 
 from src.core.enums import SortType, RatingType
-from src.core.schemas import Pagination
+from src.core.schemas import Pagination, RatingWindow, CursorPagination, Page
 from src.game_api.schemas.user_referral_schemas import UserReferralCreate, UserReferral
 from src.game_api.schemas.user_schemas import (Tap, User, UserCreate,
-                                               UserUpdate, UserBalanceUpdate)
+                                               UserUpdate, UserBalanceUpdate, UserRating, UserRatingWindow)
 from src.game_api.services.user_service import UserService
+from src.game_api.services.profile_cache import ProfileCacheService
 
 from src.redis_queue import queue
 from src.settings import get_settings
@@ -70,6 +71,16 @@ async def get_user_by_telegram_id(tg_id: str) -> Any:
     return ORJSONResponse(content=user)
 
 
+@user_router.get("/profileCacheStats")
+async def get_profile_cache_stats() -> Any:
+    """
+    Статистика кэша профилей: попадания, промахи и доля попаданий
+
+    """
+    stats = await ProfileCacheService.stats()
+    return ORJSONResponse(content=stats)
+
+
 @user_router.get("/getReflink")
 async def get_referral_link(tg_id: str) -> str:
     """
@@ -134,15 +145,51 @@ async def get_referrals_stats_by_telegram_id(
     return ORJSONResponse(content=stat)
 
 
+@user_router.get("/getReferrals")
+async def get_referrals_by_telegram_id(
+        tg_id: str,
+        pag: CursorPagination = Depends(CursorPagination),
+) -> Page[UserReferral]:
+    """
+    Рефералы юзера с постраничной выдачей по курсору\n
+    cursor - значение next_cursor из предыдущего ответа (для первой страницы не передается)
+    """
+    return await UserService.get_referrals(
+        tg_id=tg_id, cursor=pag.cursor, limit=pag.limit)
+
+
 @user_router.get("/rating")
-async def get_rating(rating_type: RatingType, pag: Pagination = Depends(Pagination)):
+async def get_rating(
+        response: Response,
+        rating_type: RatingType,
+        pag: Pagination = Depends(Pagination),
+        cursor: Optional[str] = None,
+):
     """
     Получение рейтинга по юзерам для gdp и производительности\n
-    rating_type: str = "gdp or capacity"
+    rating_type: str = "gdp or capacity"\n
+    cursor - вместо offset: значение заголовка X-Next-Cursor предыдущего ответа,
+    страницы по курсору не смещаются при изменении рейтинга между запросами
     """
-    res = []
     if rating_type == "gdp":
-        res = await UserService.get_gdp_rating(offset=pag.offset, limit=pag.limit)
+        page = await UserService.get_gdp_rating(offset=pag.offset, cursor=cursor, limit=pag.limit)
     else:
-        res = await UserService.get_capacity_rating(offset=pag.offset, limit=pag.limit)
-    return res
+        page = await UserService.get_capacity_rating(offset=pag.offset, cursor=cursor, limit=pag.limit)
+    if page.next_cursor is not None:
+        response.headers['X-Next-Cursor'] = page.next_cursor
+    return page.items
+
+
+@user_router.get("/rating/around")
+async def get_rating_around(
+        tg_id: str,
+        rating_type: RatingType,
+        window: RatingWindow = Depends(RatingWindow),
+) -> UserRatingWindow:
+    """
+    Соседи юзера в рейтинге: size мест выше и ниже него\n
+    rating_type: str = "gdp or capacity"\n
+    position - место юзера в рейтинге (то же, что user_rating_position / capacity_rating_position в /user/me)
+    """
+    return await UserService.get_rating_around(
+        tg_id=tg_id, rating_type=rating_type, size=window.size)
@@ -69,6 +69,7 @@ class UserUpdate(BaseModel):
     tg_url: Optional[str] = Field(None)
     country_id: Optional[int] = Field(None)
     region_id: Optional[int] = Field(None)
+    timezone: Optional[str] = Field(None, max_length=50)
 
 
 class UserBalanceUpdate(BaseModel):
@@ -114,3 +115,9 @@ class UserRating(UserRatingBase):
 
     class Config:
         from_attributes = True
+
+
+# Окно рейтинга вокруг юзера
+class UserRatingWindow(BaseModel):
+    position: int
+    items: list[UserRating]
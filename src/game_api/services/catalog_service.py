@@ -0,0 +1,99 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Optional
+
+from sqlalchemy import select
+
+from src.core.models import CountryModel, RegionModel, EnterpriseModel, ReferralLevelModel
+from src.core.database import db_helper as db
+from src.redis_queue import queue
+
+from src.game_api.utils import log
+from src.settings import get_settings
+
+cfg = get_settings()
+broker = queue.get_broker()
+
+VERSION_KEY = 'catalog:version'
+INVALIDATE_CHANNEL = 'catalog:invalidate'
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    """
+    Неизменяемый снимок справочников.\n
+    Строки - отсоединенные от сессии модели, читать можно только столбцы (без relationship)
+    """
+    version: int
+    countries: dict[int, CountryModel] = field(default_factory=dict)
+    regions: dict[int, RegionModel] = field(default_factory=dict)
+    enterprises: dict[int, EnterpriseModel] = field(default_factory=dict)
+    referral_levels: dict[int, ReferralLevelModel] = field(default_factory=dict)
+
+    def region(self, region_id: int, country_id: Optional[int] = None) -> Optional[RegionModel]:
+        region = self.regions.get(region_id)
+        if region is None or (country_id is not None and region.country_id != country_id):
+            return None
+        return region
+
+
+class CatalogService:
+    """
+    Справочники (страны, регионы, предприятия, уровни рефералов) в памяти воркера.\n
+    Снимок загружается при старте (lifespan) и целиком подменяется при перезагрузке,
+    читатели всегда видят согласованную версию. Версия хранится в redis (catalog:version),
+    после изменения справочника админ вызывает notify_changed (или задачу reload_catalog),
+    и все воркеры перезагружают снимок по сообщению из pub/sub канала catalog:invalidate
+    """
+    _redis = queue.get_redis()
+    _snapshot: Optional[CatalogSnapshot] = None
+    _lock = asyncio.Lock()
+
+    @classmethod
+    async def get(cls) -> CatalogSnapshot:
+        if cls._snapshot is None:
+            return await cls.load(min_version=0)
+        return cls._snapshot
+
+    @classmethod
+    async def load(cls, min_version: Optional[int] = None) -> CatalogSnapshot:
+        """
+        Загружает новый снимок. С min_version загрузка пропускается,
+        если пока ждали блокировку, снимок этой версии уже загрузил другой вызов
+        """
+        async with cls._lock:
+            if (min_version is not None and cls._snapshot is not None
+                    and cls._snapshot.version >= min_version):
+                return cls._snapshot
+
+            # версию читаем до загрузки: изменение во время загрузки придет новым сообщением
+            version = int(await cls._redis.get(VERSION_KEY) or 0)
+            async with db.session_factory() as ses:
+                tables = []
+                for model in (CountryModel, RegionModel, EnterpriseModel, ReferralLevelModel):
+                    rows = (await ses.scalars(select(model))).all()
+                    tables.append({row.id: row for row in rows})
+                ses.expunge_all()
+
+            cls._snapshot = CatalogSnapshot(version, *tables)
+            log.info(
+                f'Catalog v{version} loaded: {len(tables[0])} countries, {len(tables[1])} regions, '
+                f'{len(tables[2])} enterprises, {len(tables[3])} referral levels'
+            )
+            return cls._snapshot
+
+    @classmethod
+    async def notify_changed(cls) -> int:
+        """
+        Поднимает версию справочников и рассылает ее всем воркерам
+        """
+        version = await cls._redis.incr(VERSION_KEY)
+        await broker.publish(version, channel=INVALIDATE_CHANNEL)
+        return version
+
+
+@broker.subscriber(INVALIDATE_CHANNEL)
+async def on_catalog_changed(version: int) -> None:
+    snapshot = CatalogService._snapshot
+    if snapshot is None or snapshot.version < version:
+        await CatalogService.load(min_version=version)
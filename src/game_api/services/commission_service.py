@@ -0,0 +1,161 @@
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Optional
+
+from sqlalchemy import select, update, func, values, column, cast, BigInteger, UUID
+
+from src.core.models import UserModel, UserStateModel, ReferralModel, ReferralLevelModel
+from src.core.database import db_helper as db
+from src.core.enums import RatingType
+from src.game_api.economy import passive_income_sql
+from src.game_api.services.leaderboard_service import LeaderboardService
+from src.game_api.services.profile_cache import ProfileCacheService
+from src.game_api.services.tap_service import TapService
+from src.game_api.services.country_rating_service import CountryRatingService
+from src.redis_queue import queue, run_periodic, RedisLock
+
+from src.game_api.utils import log
+from src.settings import get_settings
+
+cfg = get_settings()
+
+LOCK_KEY = 'commissions:lock'
+LOCK_TTL = 3600  # сек, продлевается после каждой порции
+
+
+class CommissionService:
+    """
+    Начисление реферальных комиссий (заменяет PL/pgSQL calculate_and_append_referral_commissions).\n
+    Комиссия считается только с ВВП, заработанного рефералом с прошлого запуска:
+    effective_game_balance - commission_watermark. Юзеры обрабатываются порциями
+    по cfg.commission_chunk_size в порядке id, каждая порция - отдельная транзакция:
+    заработок порции, сдвиг водяных знаков и одно агрегированное по пригласившим начисление.
+    Прерванный запуск можно просто повторить: обработанные юзеры уже ничего не заработали.
+    Запускается раз в cfg.commission_interval из воркеров api (run_scheduler)
+    """
+    _redis = queue.get_redis()
+
+    @classmethod
+    async def run(cls, chunk_size: Optional[int] = None) -> dict[str, Any]:
+        chunk_size = chunk_size or cfg.commission_chunk_size
+        lock = RedisLock(LOCK_KEY, LOCK_TTL)
+        if not await lock.acquire():
+            log.warning('Referral commissions are already being calculated')
+            return {}
+
+        stats = dict(users=0, earners=0, owners=0, commission=0)
+        started = time.perf_counter()
+        last_id = None
+        try:
+            while True:
+                async with db.session_factory() as ses:
+                    last_id, credited, chunk_stats = await cls._process_chunk(ses, last_id, chunk_size)
+                    country_deltas = defaultdict(int)
+                    for row in credited:
+                        country_deltas[row.country_id] += row.amount
+                    await CountryRatingService.add_balances(ses, country_deltas)
+                    await ses.commit()
+                if credited:
+                    await TapService.invalidate(*[row.tg_id for row in credited])
+                    await ProfileCacheService.invalidate(*[row.tg_id for row in credited])
+                    await LeaderboardService.update_scores(
+                        RatingType.gdp, {row.id: row.balance for row in credited})
+                for key, value in chunk_stats.items():
+                    stats[key] += value
+                if last_id is None:
+                    break
+                if not await lock.extend():
+                    # блокировка истекла и, возможно, взята другим запуском: он продолжит с начала,
+                    # обработанные порции ему уже ничего не начислят
+                    log.error('Referral commissions stopped: lock expired')
+                    break
+        finally:
+            await lock.release()
+
+        elapsed = time.perf_counter() - started
+        stats.update(
+            elapsed_sec=round(elapsed, 3),
+            rows_per_sec=round(stats['users'] / elapsed, 1) if elapsed else 0.0,
+        )
+        log.info(f'Referral commissions calculated: {stats}')
+        return stats
+
+    @classmethod
+    async def run_scheduler(cls) -> None:
+        await run_periodic('referral_commissions', cfg.commission_interval, cls.run)
+
+    @classmethod
+    async def _process_chunk(
+            cls,
+            ses,
+            last_id: Optional[uuid.UUID],
+            chunk_size: int,
+    ) -> tuple[Optional[uuid.UUID], list[Any], dict[str, int]]:
+        """
+        Обрабатывает порцию юзеров после last_id.
+        Возвращает id последнего юзера порции (None - юзеры закончились),
+        получивших комиссию юзеров с новым ВВП и статистику порции
+        """
+        state = UserStateModel
+        effective_balance = state.game_balance + passive_income_sql(state.total_capacity, state.last_accrued_at)
+        stmt = (
+            select(state.user_id.label('id'), (effective_balance - state.commission_watermark).label('earned'))
+            .order_by(state.user_id)
+            .limit(chunk_size)
+            .with_for_update()
+        )
+        if last_id is not None:
+            stmt = stmt.where(state.user_id > last_id)
+        chunk = (await ses.execute(stmt)).all()
+        if not chunk:
+            return None, [], dict(users=0, earners=0, owners=0, commission=0)
+
+        # водяной знак сдвигается и вниз (ВВП уменьшился при смене страны), но платим только с роста
+        changed = [(user_id, earned) for user_id, earned in chunk if earned != 0]
+        if changed:
+            delta = values(column('id', UUID), column('earned', BigInteger), name='delta').data(changed)
+            await ses.execute(
+                update(state)
+                .where(state.user_id == delta.c.id)
+                .values(commission_watermark=state.commission_watermark + delta.c.earned)
+            )
+
+        earners = [(user_id, earned) for user_id, earned in changed if earned > 0]
+        credited = []
+        owners = commission = 0
+        if earners:
+            earned = values(column('referral_id', UUID), column('earned', BigInteger), name='earned').data(earners)
+            commissions = (
+                select(
+                    ReferralModel.owner_id,
+                    cast(func.floor(func.sum(earned.c.earned * ReferralLevelModel.commision_rate)), BigInteger)
+                    .label('amount'),
+                )
+                .select_from(earned)
+                .join(ReferralModel, ReferralModel.referral_id == earned.c.referral_id)
+                .join(ReferralLevelModel, ReferralLevelModel.id == ReferralModel.level_id)
+                .group_by(ReferralModel.owner_id)
+                .subquery()
+            )
+            result = await ses.execute(
+                update(state)
+                .where(
+                    state.user_id == commissions.c.owner_id,
+                    UserModel.id == state.user_id,
+                    commissions.c.amount > 0,
+                )
+                .values(
+                    game_balance=state.game_balance + commissions.c.amount,
+                    commission_watermark=state.commission_watermark + commissions.c.amount,
+                )
+                .returning(
+                    UserModel.id, UserModel.tg_id, UserModel.country_id,
+                    effective_balance.label('balance'), commissions.c.amount,
+                )
+            )
+            credited = result.all()
+            owners, commission = len(credited), sum(row.amount for row in credited)
+
+        last_id = chunk[-1].id if len(chunk) == chunk_size else None
+        return last_id, credited, dict(users=len(chunk), earners=len(earners), owners=owners, commission=commission)
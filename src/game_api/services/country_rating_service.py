@@ -0,0 +1,140 @@
+import asyncio
+from typing import Optional
+
+from sqlalchemy import table, column, delete, insert, text, Integer, BigInteger
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from src.core.database import db_helper as db
+from src.game_api.db_functions import reconcile_country_ratings, flush_country_rating_deltas
+from src.redis_queue import queue, run_periodic, RedisLock
+
+from src.game_api.utils import log
+from src.settings import get_settings
+
+cfg = get_settings()
+
+# таблицы создаются вне моделей (см. db_functions.reconcile_country_ratings и country_rating_deltas)
+country_ratings = table(
+    'country_ratings',
+    column('country_id', Integer),
+    column('user_count', Integer),
+    column('total_balance', BigInteger),
+)
+country_rating_deltas = table(
+    'country_rating_deltas',
+    column('country_id', Integer),
+    column('delta', BigInteger),
+)
+
+LOCK_KEY = 'country_rating:reconcile_lock'
+
+
+class CountryRatingService:
+    """
+    Рейтинг стран (country_ratings: user_count, total_balance) без ежечасной пересборки.\n
+    total_balance - сумма effective_game_balance юзеров страны. Изменения ВВП от тапов и комиссий
+    записываются в country_rating_deltas в той же транзакции, что и изменение баланса
+    (только вставки, без горячей строки страны), и периодически сворачиваются одним запросом.
+    Смена страны и уменьшение ВВП при ней пишутся сразу, в транзакции изменения юзера.
+    Пассивный доход растет без записей в базу, поэтому раз в cfg.country_rating_reconcile_interval
+    reconcile (run_reconciler) пересчитывает
+    таблицу целиком одним запросом
+    """
+    _redis = queue.get_redis()
+
+    @classmethod
+    async def add_balances(cls, ses, deltas: dict[Optional[int], int]) -> None:
+        """
+        Записывает изменения ВВП по странам в транзакции ses, в которой меняются балансы
+        """
+        rows = [
+            dict(country_id=country_id, delta=delta)
+            for country_id, delta in deltas.items() if country_id is not None and delta
+        ]
+        if rows:
+            await ses.execute(insert(country_rating_deltas), rows)
+
+    @classmethod
+    async def apply_user_change(
+            cls,
+            ses,
+            old_country_id: Optional[int],
+            old_balance: int,
+            new_country_id: Optional[int],
+            new_balance: int,
+    ) -> None:
+        """
+        Переносит юзера между странами (или меняет ВВП в его стране) в транзакции ses
+        """
+        if old_country_id == new_country_id:
+            changes = {old_country_id: (0, new_balance - old_balance)}
+        else:
+            changes = {old_country_id: (-1, -old_balance), new_country_id: (1, new_balance)}
+        rows = [
+            dict(country_id=country_id, user_count=user_count, total_balance=balance)
+            for country_id, (user_count, balance) in sorted(
+                (item for item in changes.items() if item[0] is not None), key=lambda item: item[0])
+            if user_count or balance
+        ]
+        if not rows:
+            return
+
+        stmt = pg_insert(country_ratings).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[country_ratings.c.country_id],
+            set_=dict(
+                user_count=country_ratings.c.user_count + stmt.excluded.user_count,
+                total_balance=country_ratings.c.total_balance + stmt.excluded.total_balance,
+            ),
+        )
+        await ses.execute(stmt)
+
+    @classmethod
+    async def flush(cls) -> int:
+        """
+        Применяет накопленные изменения ВВП. Возвращает кол-во обновленных стран
+        """
+        async with db.session_factory() as ses:
+            # конфликтует с EXCLUSIVE у reconcile: сброс и пересчет не пересекаются
+            await ses.execute(text('LOCK TABLE country_ratings IN ROW EXCLUSIVE MODE'))
+            result = await ses.execute(text(flush_country_rating_deltas))
+            await ses.commit()
+        return result.rowcount
+
+    @classmethod
+    async def run_flusher(cls) -> None:
+        while True:
+            try:
+                await cls.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f'Country ratings flush error: {e}')
+            await asyncio.sleep(cfg.country_rating_flush_interval)
+
+    @classmethod
+    async def run_reconciler(cls) -> None:
+        await run_periodic('country_ratings_reconcile', cfg.country_rating_reconcile_interval, cls.reconcile)
+
+    @classmethod
+    async def reconcile(cls) -> None:
+        """
+        Полный пересчет рейтинга стран. Выполняется одним запросом в одной транзакции,
+        читатели видят либо старую, либо новую таблицу целиком. Транзакция REPEATABLE READ
+        со снимком, взятым после блокировки таблицы: удаляются только те изменения ВВП,
+        которые уже есть в этом снимке users, более поздние применит следующий сброс
+        """
+        lock = RedisLock(LOCK_KEY, 600)
+        if not await lock.acquire():
+            log.warning('Country ratings are already being reconciled')
+            return
+        try:
+            async with db.session_factory() as ses:
+                await ses.connection(execution_options=dict(isolation_level='REPEATABLE READ'))
+                await ses.execute(text('LOCK TABLE country_ratings IN EXCLUSIVE MODE'))
+                await ses.execute(delete(country_rating_deltas))
+                await ses.execute(text(reconcile_country_ratings))
+                await ses.commit()
+        finally:
+            await lock.release()
+        log.info('Country ratings reconciled')
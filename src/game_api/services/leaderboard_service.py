@@ -0,0 +1,418 @@
+import json
+import uuid
+from typing import Any, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import contains_eager
+
+from src.core.base_dao import encode_cursor, decode_cursor
+from src.core.enums import RatingType
+from src.core.exceptions import InvalidCursorException
+from src.core.models import UserModel, UserStateModel, CountryModel
+from src.core.database import db_helper as db
+from src.game_api.economy import passive_income_sql
+from src.game_api.schemas.user_schemas import UserRating, UserRatingWindow
+from src.redis_queue import queue, run_periodic, RedisLock
+
+from src.game_api.utils import log
+from src.settings import get_settings
+
+cfg = get_settings()
+
+RATING_KEYS = {
+    RatingType.gdp: 'rating:gdp',
+    RatingType.capacity: 'rating:capacity',
+}
+PROFILES_KEY = 'rating:profiles'  # user_id -> json с данными юзера для вывода в рейтинге
+REBUILD_LOCK_KEY = 'rating:rebuild_lock'
+REBUILD_ACTIVE_KEY = 'rating:rebuild_active'  # есть, пока идет пересборка
+REMOVED_JOURNAL_KEY = 'rating:removed:journal'  # юзеры, удаленные во время пересборки
+REBUILD_CHUNK_SIZE = 5000
+REBUILD_TTL = 3600  # сек, блокировка пересборки и журналы изменений
+
+# Запись в рейтинг или профили (ARGV[1] - ZADD или HSET, дальше пары member, значение).
+# Во время пересборки та же запись добавляется в журнал, после сборки он применяется к новым ключам
+_WRITE_LUA = """
+local function write(key)
+    for i = 2, #ARGV - 1, 2 do
+        if ARGV[1] == 'ZADD' then
+            redis.call('ZADD', key, ARGV[i + 1], ARGV[i])
+        else
+            redis.call('HSET', key, ARGV[i], ARGV[i + 1])
+        end
+    end
+end
+write(KEYS[2])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    write(KEYS[3])
+    redis.call('EXPIRE', KEYS[3], ARGV[#ARGV])
+end
+return 1
+"""
+
+# Удаление юзера из рейтингов и профилей (KEYS[2..4]), во время пересборки он запоминается в журнале
+_REMOVE_LUA = """
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('SADD', KEYS[5], ARGV[1])
+    redis.call('EXPIRE', KEYS[5], ARGV[2])
+end
+return 1
+"""
+
+# Завершение пересборки: к собранным ключам применяются изменения из журналов (они новее
+# прочитанного из postgres или совпадают с ним), затем ключи подменяют текущие.
+# KEYS: блокировка пересборки, маркер пересборки, журнал удалений, дальше тройки
+# (ключ, собранный ключ, журнал); ARGV[1] - токен владельца блокировки, дальше тип каждой тройки
+# (zset или hash). Если блокировка уже не принадлежит этой пересборке, ничего не меняется
+_SWAP_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+local removed = redis.call('SMEMBERS', KEYS[3])
+for t = 1, #ARGV - 1 do
+    local key, tmp_key, journal = KEYS[t * 3 + 1], KEYS[t * 3 + 2], KEYS[t * 3 + 3]
+    if ARGV[t + 1] == 'zset' then
+        local entries = redis.call('ZRANGE', journal, 0, -1, 'WITHSCORES')
+        for i = 1, #entries, 2 do
+            redis.call('ZADD', tmp_key, entries[i + 1], entries[i])
+        end
+        for _, member in ipairs(removed) do
+            redis.call('ZREM', tmp_key, member)
+        end
+    else
+        local entries = redis.call('HGETALL', journal)
+        for i = 1, #entries, 2 do
+            redis.call('HSET', tmp_key, entries[i], entries[i + 1])
+        end
+        for _, member in ipairs(removed) do
+            redis.call('HDEL', tmp_key, member)
+        end
+    end
+    if redis.call('EXISTS', tmp_key) == 1 then
+        redis.call('RENAME', tmp_key, key)
+        redis.call('PERSIST', key)
+    else
+        redis.call('DEL', key)
+    end
+    redis.call('DEL', journal)
+end
+redis.call('DEL', KEYS[2], KEYS[3])
+return 1
+"""
+
+# Страница рейтинга за позицией (очки, member) курсора. Порядок ZREVRANGE - по очкам, при равных
+# очках по member в обратном лексикографическом порядке, поэтому место пары находится через ZREVRANK
+# member, временно поставленного на очки курсора; его прежние очки (или отсутствие) сразу
+# восстанавливаются, скрипт атомарен и снаружи изменение не видно.
+# KEYS[1] - рейтинг; ARGV - очки и member курсора, размер страницы.
+# Возвращает число записей перед страницей и limit + 1 записей (member, очки)
+_SEEK_LUA = """
+local old = redis.call('ZSCORE', KEYS[1], ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+local start = redis.call('ZREVRANK', KEYS[1], ARGV[2])
+if old then
+    redis.call('ZADD', KEYS[1], old, ARGV[2])
+    if tonumber(old) >= tonumber(ARGV[1]) then
+        start = start + 1
+    end
+else
+    redis.call('ZREM', KEYS[1], ARGV[2])
+end
+return {start, redis.call('ZREVRANGE', KEYS[1], start, start + tonumber(ARGV[3]), 'WITHSCORES')}
+"""
+
+
+def journal_key(key: str) -> str:
+    """
+    Журнал изменений ключа рейтинга или профилей, записанных во время пересборки
+    """
+    return f'{key}:journal'
+
+
+def rating_profile(db_user: UserModel, country_image_url: Optional[str] = None) -> dict[str, Any]:
+    return dict(
+        username=db_user.username,
+        first_name=db_user.first_name,
+        last_name=db_user.last_name,
+        tg_id=db_user.tg_id,
+        country_image_url=country_image_url,
+    )
+
+
+class LeaderboardService:
+    """
+    Рейтинги юзеров по ВВП и производительности в redis sorted set.\n
+    Очки обновляются при каждом изменении game_balance / total_capacity,
+    позиция юзера - ZREVRANK (O(log n)), страница - ZREVRANGE.
+    Пассивный доход начисляется лениво, поэтому очки по ВВП отражают баланс на момент
+    последнего изменения, а полная пересборка (rebuild, раз в cfg.leaderboard_rebuild_interval,
+    см. run_rebuilder) приводит их к актуальному значению
+    """
+    _redis = queue.get_redis()
+    _write = _redis.register_script(_WRITE_LUA)
+    _remove = _redis.register_script(_REMOVE_LUA)
+    _swap = _redis.register_script(_SWAP_LUA)
+    _seek = _redis.register_script(_SEEK_LUA)
+
+    @classmethod
+    def _write_items(cls, key: str, command: str, items: dict[str, Any], client=None):
+        """
+        Запись через _WRITE_LUA, client - pipeline, в который добавляется вызов
+        """
+        args: list[Any] = [command]
+        for member, value in items.items():
+            args.extend([member, value])
+        args.append(REBUILD_TTL)
+        return cls._write(keys=[REBUILD_ACTIVE_KEY, key, journal_key(key)], args=args, client=client)
+
+    @classmethod
+    async def update_user(
+            cls,
+            user_id: uuid.UUID | str,
+            game_balance: Optional[int] = None,
+            total_capacity: Optional[int] = None,
+            profile: Optional[dict[str, Any]] = None,
+    ) -> None:
+        member = str(user_id)
+        pipe = cls._redis.pipeline(transaction=False)
+        if game_balance is not None:
+            await cls._write_items(RATING_KEYS[RatingType.gdp], 'ZADD', {member: game_balance}, client=pipe)
+        if total_capacity is not None:
+            await cls._write_items(RATING_KEYS[RatingType.capacity], 'ZADD', {member: total_capacity}, client=pipe)
+        if profile is not None:
+            await cls._write_items(PROFILES_KEY, 'HSET', {member: json.dumps(profile)}, client=pipe)
+        await pipe.execute()
+
+    @classmethod
+    async def update_scores(cls, rating_type: RatingType, scores: dict[uuid.UUID | str, int]) -> None:
+        """
+        Очки сразу многих юзеров одного рейтинга (массовые начисления)
+        """
+        if scores:
+            await cls._write_items(
+                RATING_KEYS[rating_type], 'ZADD', {str(user_id): score for user_id, score in scores.items()})
+
+    @classmethod
+    async def remove_user(cls, user_id: uuid.UUID | str) -> None:
+        await cls._remove(
+            keys=[REBUILD_ACTIVE_KEY, *RATING_KEYS.values(), PROFILES_KEY, REMOVED_JOURNAL_KEY],
+            args=[str(user_id), REBUILD_TTL],
+        )
+
+    @classmethod
+    async def get_positions(cls, user_id: uuid.UUID | str) -> dict[RatingType, Optional[int]]:
+        """
+        Места юзера во всех рейтингах (с 1), None - юзера нет в рейтинге
+        """
+        pipe = cls._redis.pipeline(transaction=False)
+        for key in RATING_KEYS.values():
+            pipe.zrevrank(key, str(user_id))
+        ranks = await pipe.execute()
+        return {
+            rating_type: rank + 1 if rank is not None else None
+            for rating_type, rank in zip(RATING_KEYS, ranks)
+        }
+
+    @classmethod
+    async def get_page(
+            cls,
+            rating_type: RatingType,
+            offset: int = 0,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+    ) -> tuple[list[UserRating], Optional[str]]:
+        """
+        Страница рейтинга и курсор следующей страницы (очки и user_id ее последней записи).\n
+        С курсором offset не используется: страница начинается сразу за парой (очки, user_id)
+        курсора в порядке рейтинга, даже если эта запись с тех пор изменилась или удалена,
+        см. _SEEK_LUA. Стоимость O(log n + limit) при любом способе
+        """
+        key = RATING_KEYS[rating_type]
+        if cursor is None:
+            start = offset
+            entries = await cls._redis.zrevrange(key, offset, offset + limit, withscores=True)
+        else:
+            values = decode_cursor(cursor)
+            if len(values) != 2:
+                raise InvalidCursorException
+            score, member = values
+            if isinstance(score, bool) or not isinstance(score, (int, float)) or not isinstance(member, str):
+                raise InvalidCursorException
+
+            start, flat = await cls._seek(keys=[key], args=[score, member, limit])
+            entries = [(flat[i], float(flat[i + 1])) for i in range(0, len(flat), 2)]
+
+        next_cursor = None
+        if len(entries) > limit:
+            entries = entries[:limit]
+            member, score = entries[-1]
+            next_cursor = encode_cursor([score, member.decode()])
+        return await cls._with_profiles(entries, first_position=start + 1), next_cursor
+
+    @classmethod
+    async def get_around(
+            cls,
+            rating_type: RatingType,
+            user_id: uuid.UUID | str,
+            size: int = 10,
+    ) -> Optional[UserRatingWindow]:
+        """
+        Окно рейтинга вокруг юзера: size мест выше и ниже него.\n
+        Стоимость O(log n + size) и не зависит от места юзера
+        """
+        key = RATING_KEYS[rating_type]
+        rank = await cls._redis.zrevrank(key, str(user_id))
+        if rank is None:
+            return None
+
+        start = max(rank - size, 0)
+        entries = await cls._redis.zrevrange(key, start, rank + size, withscores=True)
+        return UserRatingWindow(
+            position=rank + 1,
+            items=await cls._with_profiles(entries, first_position=start + 1),
+        )
+
+    @classmethod
+    async def _with_profiles(cls, entries: list[tuple[Any, float]], first_position: int) -> list[UserRating]:
+        if not entries:
+            return []
+
+        profiles = await cls._redis.hmget(PROFILES_KEY, [member for member, _ in entries])
+        return cls._build_rating(entries, profiles, first_position)
+
+    @classmethod
+    def _build_rating(
+            cls,
+            entries: list[tuple[Any, float]],
+            profiles: list[Optional[bytes]],
+            first_position: int,
+    ) -> list[UserRating]:
+        rating = []
+        for position, ((member, score), profile) in enumerate(zip(entries, profiles), start=first_position):
+            rating.append(UserRating(
+                id=position,
+                user_id=member.decode(),
+                total=int(score),
+                **(json.loads(profile) if profile else {}),
+            ))
+        return rating
+
+    @classmethod
+    async def rebuild(cls) -> Optional[int]:
+        """
+        Полная пересборка рейтингов из postgres (холодный старт или сверка).\n
+        Рейтинги собираются во временных ключах и подменяются атомарно,
+        читатели не видят частично собранный рейтинг. Изменения, записанные во время сборки,
+        попадают в журналы и применяются к собранным ключам при подмене.
+        Одновременно выполняется только одна пересборка: блокировка продлевается после каждой
+        порции, а если она все же истекла и ее взял другой процесс, эта пересборка прерывается
+        и ничего не подменяет. None - пересборка уже идет или прервана
+        """
+        lock = RedisLock(REBUILD_LOCK_KEY, REBUILD_TTL)
+        if not await lock.acquire():
+            log.warning('Leaderboards are already being rebuilt')
+            return None
+        try:
+            return await cls._rebuild(lock)
+        finally:
+            await lock.release()
+
+    @classmethod
+    async def _rebuild(cls, lock: RedisLock) -> Optional[int]:
+        keys = (*RATING_KEYS.values(), PROFILES_KEY)
+        # временные ключи свои у каждой пересборки, прерванная не пишет в ключи следующей
+        tmp_keys = {key: f'{key}:tmp:{lock.token}' for key in keys}
+        journal_keys = [journal_key(key) for key in keys]
+        await cls._redis.delete(*journal_keys, REMOVED_JOURNAL_KEY)
+        # с этого момента изменения рейтингов пишутся и в журналы
+        await cls._redis.set(REBUILD_ACTIVE_KEY, 1, ex=REBUILD_TTL)
+
+        total = None
+        try:
+            total = await cls._load_tmp_keys(tmp_keys, lock)
+            if total is not None:
+                swap_keys = [REBUILD_LOCK_KEY, REBUILD_ACTIVE_KEY, REMOVED_JOURNAL_KEY]
+                for key, journal in zip(keys, journal_keys):
+                    swap_keys.extend([key, tmp_keys[key], journal])
+                if not await cls._swap(
+                        keys=swap_keys, args=[lock.token, *['zset'] * len(RATING_KEYS), 'hash']):
+                    total = None
+        finally:
+            if total is None:
+                # маркер и журналы удаляются, только пока блокировка наша: иначе они уже
+                # принадлежат пересборке, которая ее взяла
+                await cls._redis.delete(*tmp_keys.values())
+                await lock.release(REBUILD_ACTIVE_KEY, *journal_keys, REMOVED_JOURNAL_KEY)
+
+        if total is None:
+            log.error('Leaderboards rebuild aborted: rebuild lock expired')
+            return None
+        log.info(f'Leaderboards rebuilt: {total} users')
+        return total
+
+    @classmethod
+    async def _load_tmp_keys(cls, tmp_keys: dict[str, str], lock: RedisLock) -> Optional[int]:
+        """
+        Заполняет временные ключи порциями из postgres, None - блокировка пересборки потеряна
+        """
+        game_balance = UserStateModel.game_balance + passive_income_sql(
+            UserStateModel.total_capacity, UserStateModel.last_accrued_at)
+        last_id = None
+        total = 0
+        async with db.session_factory() as ses:
+            while True:
+                stmt = (
+                    select(UserModel, game_balance.label('effective_balance'), CountryModel.image_url)
+                    .join(UserModel.state)
+                    .options(contains_eager(UserModel.state))
+                    .outerjoin(CountryModel, CountryModel.id == UserModel.country_id)
+                    .order_by(UserModel.id)
+                    .limit(REBUILD_CHUNK_SIZE)
+                )
+                if last_id is not None:
+                    stmt = stmt.where(UserModel.id > last_id)
+                rows = (await ses.execute(stmt)).all()
+                if not rows:
+                    break
+
+                pipe = cls._redis.pipeline(transaction=False)
+                pipe.zadd(tmp_keys[RATING_KEYS[RatingType.gdp]], {
+                    str(db_user.id): balance for db_user, balance, _ in rows
+                })
+                pipe.zadd(tmp_keys[RATING_KEYS[RatingType.capacity]], {
+                    str(db_user.id): db_user.total_capacity for db_user, _, _ in rows
+                })
+                pipe.hset(tmp_keys[PROFILES_KEY], mapping={
+                    str(db_user.id): json.dumps(rating_profile(db_user, image_url))
+                    for db_user, _, image_url in rows
+                })
+                for key in (*tmp_keys.values(), REBUILD_ACTIVE_KEY):
+                    pipe.expire(key, REBUILD_TTL)
+                await pipe.execute()
+
+                total += len(rows)
+                last_id = rows[-1][0].id
+                ses.expunge_all()
+                if not await lock.extend():
+                    return None
+        return total
+
+    @classmethod
+    async def ensure_built(cls) -> None:
+        """
+        Собирает рейтинги при холодном старте (пустой redis)
+        """
+        if await cls._redis.exists(RATING_KEYS[RatingType.gdp]):
+            return
+        await cls.rebuild()
+
+    @classmethod
+    async def run_rebuilder(cls) -> None:
+        """
+        Периодическая пересборка рейтингов: подтягивает пассивный доход юзеров,
+        которые давно ничего не делали и чьи очки поэтому не обновлялись
+        """
+        await run_periodic('leaderboards_rebuild', cfg.leaderboard_rebuild_interval, cls.rebuild)
@@ -0,0 +1,110 @@
+import json
+from typing import Any, Optional
+
+from src.redis_queue import queue
+from src.settings import get_settings
+
+cfg = get_settings()
+
+PROFILE_KEY_PREFIX = 'user:profile:'
+VERSION_KEY_PREFIX = 'user:profile:ver:'  # поколение профиля, растет при каждой инвалидации
+STATS_KEY = 'user:profile:stats'
+
+# Чтение из кэша со счетчиками попаданий/промахов за один запрос к redis.
+# При промахе возвращает текущее поколение профиля, с ним потом пишется снимок из базы
+_GET_LUA = """
+local profile = redis.call('GET', KEYS[1])
+if profile then
+    redis.call('HINCRBY', KEYS[3], 'hits', 1)
+    return {1, profile}
+end
+redis.call('HINCRBY', KEYS[3], 'misses', 1)
+return {0, redis.call('GET', KEYS[2]) or '0'}
+"""
+
+# Пишет снимок, только если с момента промаха профиль не инвалидировали (поколение не изменилось),
+# иначе снимок мог быть прочитан из базы до записи и перезаписал бы кэш устаревшими данными
+_SET_LUA = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+# Для каждого юзера (пары ключей профиль/поколение) увеличивает поколение и удаляет снимок.
+# Поколение хранится ARGV[1] сек - заведомо дольше любого чтения из базы между промахом и записью
+_INVALIDATE_LUA = """
+for i = 1, #KEYS, 2 do
+    redis.call('INCR', KEYS[i + 1])
+    redis.call('EXPIRE', KEYS[i + 1], ARGV[1])
+    redis.call('DEL', KEYS[i])
+end
+return #KEYS / 2
+"""
+
+
+def _profile_key(tg_id: str) -> str:
+    return f'{PROFILE_KEY_PREFIX}{tg_id}'
+
+
+def _version_key(tg_id: str) -> str:
+    return f'{VERSION_KEY_PREFIX}{tg_id}'
+
+
+class ProfileCacheService:
+    """
+    Read-through кэш профиля юзера по tg_id.\n
+    Хранится снимок строки юзера со страной и регионом (см. UserService._profile_snapshot),
+    производные поля (восстановление энергии, пассивный доход, места в рейтингах)
+    считаются при каждом чтении. Все пути записи профиля инвалидируют запись в кэше.\n
+    get при промахе возвращает поколение профиля, set с этим поколением ничего не пишет,
+    если профиль успели инвалидировать
+    """
+    _redis = queue.get_redis()
+    _get = _redis.register_script(_GET_LUA)
+    _set = _redis.register_script(_SET_LUA)
+    _invalidate = _redis.register_script(_INVALIDATE_LUA)
+
+    @classmethod
+    async def get(cls, tg_id: str) -> tuple[Optional[dict[str, Any]], Optional[str]]:
+        """
+        (профиль, None) при попадании, (None, поколение) при промахе
+        """
+        if not cfg.profile_cache_enabled:
+            return None, None
+        found, value = await cls._get(keys=[_profile_key(tg_id), _version_key(tg_id), STATS_KEY])
+        if found:
+            return json.loads(value), None
+        return None, value.decode() if isinstance(value, bytes) else str(value)
+
+    @classmethod
+    async def set(cls, tg_id: str, profile: dict[str, Any], version: Optional[str]) -> bool:
+        if not cfg.profile_cache_enabled or version is None:
+            return False
+        stored = await cls._set(
+            keys=[_profile_key(tg_id), _version_key(tg_id)],
+            args=[version, json.dumps(profile, default=str), cfg.profile_cache_ttl],
+        )
+        return bool(stored)
+
+    @classmethod
+    async def invalidate(cls, *tg_ids: str) -> None:
+        if not tg_ids:
+            return
+        keys = []
+        for tg_id in tg_ids:
+            keys.extend([_profile_key(tg_id), _version_key(tg_id)])
+        await cls._invalidate(keys=keys, args=[cfg.profile_cache_ttl * 2])
+
+    @classmethod
+    async def stats(cls) -> dict[str, Any]:
+        stats = await cls._redis.hgetall(STATS_KEY)
+        hits = int(stats.get(b'hits', 0))
+        misses = int(stats.get(b'misses', 0))
+        total = hits + misses
+        return dict(
+            hits=hits,
+            misses=misses,
+            hit_ratio=round(hits / total, 4) if total else None,
+        )
@@ -0,0 +1,397 @@
+import asyncio
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Optional
+
+from fastapi import status
+from sqlalchemy import update, values, column, func, UUID, BigInteger, Integer
+from sqlalchemy.exc import SQLAlchemyError
+
+from src.core.enums import EnergyRestorePolicy, RatingType
+from src.core.models import UserModel, UserStateModel
+from src.game_api.dao import UserDAO
+from src.game_api.economy import restored_energy, next_energy_restore, passive_income, passive_income_sql
+from src.core.database import db_helper as db
+from src.core.metrics import TAP_SETTLEMENTS
+from src.game_api.services.leaderboard_service import RATING_KEYS, REBUILD_ACTIVE_KEY, REBUILD_TTL, journal_key
+from src.game_api.services.country_rating_service import CountryRatingService
+from src.game_api.services.profile_cache import ProfileCacheService
+from src.redis_queue import queue
+
+from src.game_api.utils import exception_and_log, log
+from src.settings import get_settings
+
+cfg = get_settings()
+
+STATE_KEY_PREFIX = 'tap:state:'  # hash с энергией и балансом юзера
+DIRTY_KEY = 'tap:dirty'  # юзеры с несброшенными тапами
+INFLIGHT_KEY = 'tap:inflight'  # юзеры, чей сброс в postgres еще не подтвержден
+
+# Загружает состояние юзера из postgres, если его еще нет в redis
+_HYDRATE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1],
+    'user_id', ARGV[2], 'energy', ARGV[3], 'balance', ARGV[4],
+    'capacity', ARGV[5], 'boost', ARGV[6], 'd_balance', 0,
+    'restored_at', ARGV[7], 'restore_at', ARGV[8])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Атомарно применяет тапы. Логика повторяет UserService.update_game_balance
+# и economy.tap_reward / economy.restored_energy. Коды ответа:
+# -1 - состояния нет в redis, 0 - баланс обновлен, 1 - энергия закончилась,
+# 2 - неверное кол-во тапов, 3 - тапов еще не было.
+# Восстановление энергии: restore_at - момент следующего восстановления (unix time),
+# ARGV[5] - период, ARGV[6] == '1' - восстановление привязано к полуночи
+# (переходы на летнее время не учитываются, при следующей загрузке из postgres время выравнивается).
+# KEYS[3] - рейтинг по ВВП, новый баланс сразу попадает в него, а во время пересборки рейтингов
+# (есть KEYS[4]) - и в ее журнал KEYS[5] (ARGV[7] - срок хранения журнала).
+# Изменения ВВП стран записываются при сбросе в postgres (см. TapService._flush_users)
+_TAP_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {-1, 0}
+end
+local state = redis.call('HMGET', KEYS[1], 'energy', 'balance', 'capacity', 'boost', 'restore_at', 'user_id')
+local energy = tonumber(state[1])
+local balance = tonumber(state[2])
+local new_tap_count = tonumber(ARGV[1])
+
+local now = tonumber(redis.call('TIME')[1])
+local restore_at = tonumber(state[5])
+if now >= restore_at then
+    local period = tonumber(ARGV[5])
+    if ARGV[6] == '1' then
+        restore_at = restore_at + period * (math.floor((now - restore_at) / period) + 1)
+    else
+        restore_at = now + period
+    end
+    energy = tonumber(ARGV[2])
+    redis.call('HSET', KEYS[1], 'energy', energy, 'restored_at', now,
+        'restore_at', string.format('%d', restore_at))
+    redis.call('SADD', KEYS[2], ARGV[4])
+end
+
+if energy == 0 then
+    return {1, state[2]}
+end
+local current_tap_count = tonumber(ARGV[2]) - energy
+if new_tap_count < current_tap_count or new_tap_count < 0 then
+    return {2, state[2]}
+end
+if new_tap_count == 0 then
+    return {3, state[2]}
+end
+
+local taps = math.min(new_tap_count - current_tap_count, energy)
+local boost = tonumber(state[4])
+if boost == 0 then
+    boost = 1
+end
+local reward = math.floor(2 * tonumber(state[3]) * taps * (100 + boost) / 100)
+local new_balance = string.format('%d', balance + reward)
+
+redis.call('HSET', KEYS[1], 'energy', energy - taps, 'balance', new_balance)
+redis.call('HINCRBY', KEYS[1], 'd_balance', string.format('%d', reward))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('SADD', KEYS[2], ARGV[4])
+redis.call('ZADD', KEYS[3], new_balance, state[6])
+if redis.call('EXISTS', KEYS[4]) == 1 then
+    redis.call('ZADD', KEYS[5], new_balance, state[6])
+    redis.call('EXPIRE', KEYS[5], ARGV[7])
+end
+return {0, new_balance}
+"""
+
+# Забирает пачку юзеров из DIRTY_KEY на сброс: накопленная дельта переносится
+# в поля f_*, каждому сбросу присваивается номер f_seq (время redis в мкс).
+# Пока предыдущий сброс юзера не подтвержден, новый не начинается.
+_CLAIM_LUA = """
+local now = redis.call('TIME')
+local seq = now[1] .. string.format('%06d', tonumber(now[2]))
+local claimed = {}
+for _, tg_id in ipairs(redis.call('SPOP', KEYS[1], ARGV[1])) do
+    local key = ARGV[2] .. tg_id
+    if redis.call('HEXISTS', key, 'f_seq') == 1 then
+        redis.call('SADD', KEYS[1], tg_id)
+    elseif redis.call('EXISTS', key) == 1 then
+        local state = redis.call('HMGET', key, 'd_balance', 'energy', 'restored_at')
+        redis.call('HSET', key, 'f_balance', state[1], 'f_energy', state[2], 'f_restored', state[3],
+            'f_seq', seq, 'd_balance', 0)
+        redis.call('SADD', KEYS[2], tg_id)
+        table.insert(claimed, tg_id)
+    end
+end
+return claimed
+"""
+
+# Вытеснение состояния юзеров ARGV из redis (TapService.invalidate). По каждому юзеру:
+# 0 - состояния нет или оно удалено, 1 - есть несброшенные тапы: они забраны на сброс
+# как в _CLAIM_LUA (или сброс уже идет), удалить состояние можно после его подтверждения
+_EVICT_LUA = """
+local now = redis.call('TIME')
+local seq = now[1] .. string.format('%06d', tonumber(now[2]))
+local result = {}
+for i, tg_id in ipairs(ARGV) do
+    local key = KEYS[3] .. tg_id
+    if redis.call('EXISTS', key) == 0 then
+        redis.call('SREM', KEYS[1], tg_id)
+        result[i] = 0
+    elseif redis.call('HEXISTS', key, 'f_seq') == 1 then
+        result[i] = 1
+    elseif redis.call('SREM', KEYS[1], tg_id) == 1 then
+        local state = redis.call('HMGET', key, 'd_balance', 'energy', 'restored_at')
+        redis.call('HSET', key, 'f_balance', state[1], 'f_energy', state[2], 'f_restored', state[3],
+            'f_seq', seq, 'd_balance', 0)
+        redis.call('SADD', KEYS[2], tg_id)
+        result[i] = 1
+    else
+        redis.call('DEL', key)
+        result[i] = 0
+    end
+end
+return result
+"""
+
+# Подтверждает сброс: ARGV - пары tg_id, seq
+_ACK_LUA = """
+for i = 1, #ARGV, 2 do
+    local key = KEYS[2] .. ARGV[i]
+    if redis.call('HGET', key, 'f_seq') == ARGV[i + 1] then
+        redis.call('HDEL', key, 'f_balance', 'f_energy', 'f_restored', 'f_seq')
+    end
+    redis.call('SREM', KEYS[1], ARGV[i])
+end
+return #ARGV / 2
+"""
+
+_TAP_MESSAGES = {
+    0: "Balance successfully updated",
+    1: "The energy is gone",
+    2: """Вы не можете передать кол-во кликов меньше 0 или меньше,
+                         чем уже сделали за сегодня""",
+    3: "Make taps before update your balance",
+}
+# код 0 lua-скрипта - и начисление, и запрос без новых тапов
+_TAP_RESULTS = {0: 'settled', 1: 'energy_exhausted', 2: 'rejected', 3: 'no_taps'}
+
+
+def _state_key(tg_id: str) -> str:
+    return f'{STATE_KEY_PREFIX}{tg_id}'
+
+
+def _restore_period() -> tuple[int, int]:
+    """
+    Период восстановления энергии в секундах и признак привязки к полуночи для lua-скрипта
+    """
+    if cfg.energy_restore_policy == EnergyRestorePolicy.interval:
+        return cfg.energy_restore_interval_hours * 3600, 0
+    return 24 * 3600, 1
+
+
+class TapService:
+    """
+    Write-behind режим для тапов (cfg.tap_write_behind).\n
+    Энергия и баланс юзера хранятся в redis hash и меняются атомарно lua-скриптом,
+    а фоновый сборщик пачками переносит накопленные дельты в таблицу users.\n
+
+    Сброс устойчив к падениям: дельта сначала переносится в поля f_* и получает номер f_seq,
+    в postgres она применяется только если users.tap_flush_seq меньше этого номера,
+    а из redis удаляется только после коммита. Незавершенные сбросы (INFLIGHT_KEY)
+    повторяются на следующем цикле, повтор уже примененного сброса ничего не меняет.\n
+
+    В состоянии хранятся и capacity, boost и balance из postgres, поэтому каждый путь,
+    который меняет эти столбцы (профиль, страна, комиссии, предприятия и бусты), после коммита
+    вызывает invalidate: несброшенные тапы сбрасываются, состояние удаляется и при следующем тапе
+    загружается заново.
+    """
+    _redis = queue.get_redis()
+    _hydrate = _redis.register_script(_HYDRATE_LUA)
+    _tap = _redis.register_script(_TAP_LUA)
+    _claim = _redis.register_script(_CLAIM_LUA)
+    _ack = _redis.register_script(_ACK_LUA)
+    _evict = _redis.register_script(_EVICT_LUA)
+
+    @classmethod
+    async def update_game_balance(cls, tg_id: str, new_tap_count: int) -> dict:
+        args = [new_tap_count, cfg.energy_limit, cfg.tap_state_ttl, tg_id, *_restore_period(), REBUILD_TTL]
+        gdp_key = RATING_KEYS[RatingType.gdp]
+        keys = [_state_key(tg_id), DIRTY_KEY, gdp_key, REBUILD_ACTIVE_KEY, journal_key(gdp_key)]
+
+        code, balance = await cls._tap(keys=keys, args=args)
+        if code == -1:
+            await cls._load_state(tg_id)
+            code, balance = await cls._tap(keys=keys, args=args)
+
+        TAP_SETTLEMENTS.labels('write_behind', _TAP_RESULTS[code]).inc()
+        return dict(
+            message=_TAP_MESSAGES[code],
+            balance=int(balance)
+        )
+
+    @classmethod
+    async def get_state(cls, tg_id: str) -> Optional[dict[str, int]]:
+        """
+        Актуальные энергия и баланс юзера, если он сейчас тапает в write-behind режиме
+        """
+        energy, balance, restore_at = await cls._redis.hmget(
+            _state_key(tg_id), 'energy', 'balance', 'restore_at')
+        if energy is None or balance is None:
+            return None
+        if time.time() >= int(restore_at):
+            energy = cfg.energy_limit
+        return dict(energy=int(energy), game_balance=int(balance))
+
+    @classmethod
+    async def _load_state(cls, tg_id: str) -> None:
+        async with db.session_factory() as ses:
+            db_user = await UserDAO.find_one_or_none(ses, tg_id=tg_id)
+            if db_user is None:
+                exception_and_log(
+                    cfg.debug,
+                    status.HTTP_404_NOT_FOUND,
+                    f"User by tg_id {tg_id} not found"
+                )
+
+        energy, last_energy_update = restored_energy(
+            db_user.energy, db_user.last_energy_update, db_user.timezone)
+        restore_at = next_energy_restore(last_energy_update, db_user.timezone)
+        await cls._hydrate(
+            keys=[_state_key(tg_id)],
+            args=[
+                cfg.tap_state_ttl,
+                str(db_user.id),
+                energy,
+                db_user.game_balance + passive_income(db_user.total_capacity, db_user.last_accrued_at),
+                db_user.total_capacity,
+                db_user.total_boost_value,
+                int(last_energy_update.timestamp()),
+                int(restore_at.timestamp()),
+            ]
+        )
+
+    @classmethod
+    async def flush(cls) -> int:
+        """
+        Один цикл сброса: сначала повторяет незавершенные сбросы,
+        если их нет - забирает новую пачку. Возвращает кол-во сброшенных юзеров
+        """
+        tg_ids = await cls._redis.srandmember(INFLIGHT_KEY, cfg.tap_flush_batch_size)
+        if not tg_ids:
+            tg_ids = await cls._claim(
+                keys=[DIRTY_KEY, INFLIGHT_KEY],
+                args=[cfg.tap_flush_batch_size, STATE_KEY_PREFIX]
+            )
+        if not tg_ids:
+            return 0
+        return await cls._flush_users([tg_id.decode() if isinstance(tg_id, bytes) else str(tg_id) for tg_id in tg_ids])
+
+    @classmethod
+    async def _flush_users(cls, tg_ids: list[str]) -> int:
+        """
+        Переносит в postgres забранные на сброс (f_*) дельты юзеров и подтверждает сброс
+        """
+        pipe = cls._redis.pipeline(transaction=False)
+        for tg_id in tg_ids:
+            pipe.hmget(_state_key(tg_id), 'user_id', 'f_balance', 'f_energy', 'f_restored', 'f_seq')
+        states = await pipe.execute()
+
+        data: list[tuple] = []
+        flushed: list[str] = []
+        acks: list[Any] = []
+        for tg_id, (user_id, f_balance, f_energy, f_restored, f_seq) in zip(tg_ids, states):
+            if f_seq is None:
+                # состояние истекло или сброс уже подтвержден другим воркером
+                acks.extend([tg_id, ''])
+                continue
+            data.append((uuid.UUID(user_id.decode()), int(f_balance), int(f_energy), int(f_restored), int(f_seq)))
+            flushed.append(tg_id)
+            acks.extend([tg_id, f_seq])
+
+        if data:
+            batch = values(
+                column('b_id', UUID),
+                column('b_balance', BigInteger),
+                column('b_energy', Integer),
+                column('b_restored', BigInteger),
+                column('b_seq', BigInteger),
+                name='batch',
+            ).data(data)
+            state = UserStateModel
+            stmt = (
+                update(state)
+                .where(
+                    state.user_id == batch.c.b_id,
+                    state.tap_flush_seq < batch.c.b_seq,
+                    UserModel.id == state.user_id,
+                )
+                .values(
+                    game_balance=state.game_balance + batch.c.b_balance + passive_income_sql(
+                        state.total_capacity, state.last_accrued_at),
+                    last_accrued_at=func.now(),
+                    energy=batch.c.b_energy,
+                    last_energy_update=func.to_timestamp(batch.c.b_restored),
+                    tap_flush_seq=batch.c.b_seq,
+                )
+                .returning(UserModel.country_id, batch.c.b_balance)
+            )
+            try:
+                async with db.session_factory() as ses:
+                    # применяются только еще не примененные сбросы, изменения ВВП стран пишутся по ним
+                    # в той же транзакции (страна берется из users, а не из состояния в redis)
+                    country_deltas = defaultdict(int)
+                    for country_id, delta in await ses.execute(stmt):
+                        country_deltas[country_id] += delta
+                    await CountryRatingService.add_balances(ses, country_deltas)
+                    await ses.commit()
+            except SQLAlchemyError as e:
+                log.error(f'Tap flush failed, {len(data)} users will be retried: {e}')
+                return 0
+            # баланс и начисление пассивного дохода в базе изменились
+            await ProfileCacheService.invalidate(*flushed)
+
+        await cls._ack(keys=[INFLIGHT_KEY, STATE_KEY_PREFIX], args=acks)
+        return len(tg_ids)
+
+    @classmethod
+    async def invalidate(cls, *tg_ids: str) -> None:
+        """
+        Сбрасывает несброшенные тапы юзеров в postgres и удаляет их состояние из redis
+        """
+        if not cfg.tap_write_behind or not tg_ids:
+            return
+        pending = list(tg_ids)
+        for _ in range(10):
+            result = await cls._evict(keys=[DIRTY_KEY, INFLIGHT_KEY, STATE_KEY_PREFIX], args=pending)
+            pending = [tg_id for tg_id, busy in zip(pending, result) if busy]
+            if not pending:
+                return
+            await cls._flush_users(pending)
+        log.error(f'Tap state invalidation failed for {len(pending)} users, it will expire in {cfg.tap_state_ttl} sec')
+
+    @classmethod
+    async def run_flusher(cls) -> None:
+        """
+        Фоновая задача, запускается в lifespan приложения
+        """
+        while True:
+            try:
+                flushed = await cls.flush()
+                if flushed < cfg.tap_flush_batch_size:
+                    await asyncio.sleep(cfg.tap_flush_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f'Tap flusher error: {e}')
+                await asyncio.sleep(cfg.tap_flush_interval)
+
+    @classmethod
+    async def flush_all(cls) -> None:
+        """
+        Сбрасывает все накопленные тапы, вызывается при остановке приложения
+        """
+        while await cls.flush():
+            pass
@@ -2,39 +2,47 @@ import string
 import time
 import random
 import uuid
+from datetime import datetime, timezone
 
 from typing import Optional, Union, List, Any
 
 from fastapi import HTTPException, status
-from sqlalchemy import select, update, func, asc, text, desc
-from sqlalchemy.orm import selectinload, joinedload
+from sqlalchemy import select, insert, update, func, asc, text, desc, true, case, literal, and_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import selectinload, joinedload, set_committed_value
 
-from src.core.enums import SortType
+from src.core.enums import SortType, RatingType
+from src.core.schemas import Page
 from src.game_api.schemas.enterprise_schemas import UserEnterpriseCreate
-from src.game_api.schemas.user_schemas import User, UserCreate, UserUpdate, UserRating
+from src.game_api.schemas.user_schemas import User, UserCreate, UserUpdate, UserRating, UserRatingWindow
 from src.game_api.schemas.user_referral_schemas import UserReferral, UserReferralCreate, UserReferralUpdate
-from src.core.models import UserModel, ReferralModel, ReferralLevelModel, UserEnterpriseModel, EnterpriseModel, \
-    GdpUserRatingModel, CapacityUserRatingModel
-from src.game_api.dao import UserDAO, UserReferralDAO, UserEnterpriseDAO, EnterpriseDAO, CountryDAO, RegionDAO, \
-    GdpUserRatingDAO, CapacityUserRatingDAO
+from src.core.models import UserModel, UserStateModel, ReferralModel, ReferralCountModel, ReferralLevelModel, UserEnterpriseModel, EnterpriseModel, \
+    CountryModel, RegionModel
+from src.game_api.dao import UserDAO, UserStateDAO, UserReferralDAO, UserEnterpriseDAO
 from src.core.database import db_helper as db
+from src.core.metrics import TAP_SETTLEMENTS, SIGNUPS
+from src.game_api.services.tap_service import TapService
+from src.game_api.services.leaderboard_service import LeaderboardService, rating_profile
+from src.game_api.services.profile_cache import ProfileCacheService
+from src.game_api.services.catalog_service import CatalogService
+from src.game_api.services.country_rating_service import CountryRatingService, country_rating_deltas
+from src.game_api.economy import (tap_reward_sql, energy_restore_due_sql, restored_energy,
+                                  passive_income, passive_income_sql, is_known_zone)
 
 from src.game_api.utils import exception_and_log, log
 from src.settings import get_settings
 
 cfg = get_settings()
 
+STARTER_ENTERPRISE_IDS = (1, 2, 3)  # стартовые предприятия нового юзера
+MAX_REFERRAL_LEVEL = 10
+
 
 class UserService:
     @classmethod
     async def check_user_by_telegram_id(cls, tg_id: str) -> User | str:
-        async with db.session_factory() as session:
-            user_exist = await UserDAO.find_one_or_none(session, tg_id=tg_id)
-            if user_exist:
-                return user_exist
-            else:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
+        profile = await cls._get_profile_snapshot(tg_id)
+        return User(**profile)
 
 
 
@@ -44,68 +52,8 @@ class UserService:
             user_exist = await UserDAO.find_one_or_none(ses, tg_id=user.tg_id)
             owner = await UserDAO.find_one_or_none(ses, tg_id=user.referrer_id)
             if user_exist is None:
-                if owner is None:
-                    user.referrer_id = None
-                else:
-                    user.referrer_id = owner.id
-
-                db_user = await UserDAO.add(ses, user)
-                total_capacity = 0
-
-                for i in range(1, 4):  # Добавляем 3 начальных предприятия юзеру
-                    added_ents = await UserEnterpriseDAO.add(
-                        ses,
-                        UserEnterpriseCreate(
-                            tg_id=user.tg_id,
-                            enterprise_id=i,
-                        )
-                    )
-                    current_ent = await EnterpriseDAO.find_one_or_none(ses, id=i)
-                    total_capacity += current_ent.capacity
-                    await ses.commit()
-
-                db_user.total_capacity = total_capacity
-                await ses.commit()
-
-                if owner:
-                    log.info(f'Owner:{owner}')
-                    level = 1
-                    current_referrer_id = owner.referrer_id
-
-                    # Реализация многоуровневой реферальной системы
-                    # Идем вверх по цепочке, пока не достигнем 10 уровня или юзера, которого никто не приглашал
-                    while level <= 10:
-
-                        # если такой юзер найден, добавляем одну запись и выходим из цикла
-                        if current_referrer_id is None:
-                            ref_obj = UserReferralCreate(
-                                owner_id=owner.id,
-                                referral_id=db_user.id,
-                                level_id=1
-                            )
-                            log.success(f'Юзер найден. Добавляем одну запись:{ref_obj}')
-                            new_ref = await UserReferralDAO.add(ses, obj_in=ref_obj)
-                            await ses.commit()
-                            break
-                        else:   # если нет, добавляем записи (рефералов) для каждого юзера вверх по цепочке
-                            log.warning(f'Юзер не найден. Идем вверх по цепочке')
-                            next_owner = await UserDAO.find_one_or_none(ses, id=current_referrer_id)
-                            if next_owner is None:
-                                log.warning(f'Next owner не найден')
-                                break
-
-                            level += 1
-                            ref_for_next_owner = UserReferralCreate(
-                                owner_id=next_owner.id,
-                                referral_id=db_user.id,
-                                level_id=level
-                            )
-                            new_ref = await UserReferralDAO.add(ses, obj_in=ref_for_next_owner)
-                            await ses.commit()
-                            current_referrer_id = next_owner.referrer_id
-                    else:
-                        log.warning(f"Owner by uuid: {user.referrer_id} not found")
-
+                db_user = await cls._onboard_user(ses, user, owner)
+                await cls._update_leaderboards(ses, db_user)
 
                 return db_user
             else:
@@ -115,6 +63,87 @@ class UserService:
                 )
 
 
+    @classmethod
+    async def _onboard_user(
+            cls,
+            ses,
+            user: UserCreate,
+            owner: Optional[UserModel] = None,
+    ) -> UserModel:
+        """
+        Создание юзера одной транзакцией: юзер, его состояние, стартовые предприятия и вся реферальная цепочка.\n
+        total_capacity считается агрегатом по стартовым предприятиям прямо в INSERT состояния,
+        путь пригласивших (referral_path) - путь пригласившего с ним самим в начале,
+        записи рефералов всех уровней - одним INSERT ... SELECT из этого пути
+        """
+        user_data = user.model_dump(exclude_unset=True)
+        user_data['referrer_id'] = owner.id if owner else None
+        user_data['referral_path'] = [owner.id, *owner.referral_path][:MAX_REFERRAL_LEVEL] if owner else []
+        db_user = await UserDAO.add(ses, user_data)
+        user_state = enterprises = None
+        if db_user is not None:
+            user_state = await UserStateDAO.add(ses, dict(
+                user_id=db_user.id,
+                total_capacity=(
+                    select(func.coalesce(func.sum(EnterpriseModel.capacity), 0))
+                    .where(EnterpriseModel.id.in_(STARTER_ENTERPRISE_IDS))
+                    .scalar_subquery()
+                ),
+            ))
+        if user_state is not None:
+            # INSERT ... RETURNING не подгружает связи, состояние прикрепляется вручную
+            set_committed_value(db_user, 'state', user_state)
+            enterprises = await UserEnterpriseDAO.add_bulk(ses, [
+                dict(tg_id=db_user.tg_id, enterprise_id=enterprise_id)
+                for enterprise_id in STARTER_ENTERPRISE_IDS
+            ])
+        if enterprises is None:
+            await ses.rollback()
+            exception_and_log(
+                cfg.debug,
+                status.HTTP_500_INTERNAL_SERVER_ERROR,
+                f"Cannot create user {user.tg_id}"
+            )
+
+        if db_user.referral_path:
+            # Многоуровневая реферальная система: пригласивший - 1 уровень,
+            # его пригласивший - 2 уровень и т.д. вверх по цепочке
+            path = func.unnest(UserModel.referral_path).table_valued('owner_id', with_ordinality='level')
+            await ses.execute(
+                insert(ReferralModel).from_select(
+                    ['owner_id', 'referral_id', 'level_id'],
+                    select(path.c.owner_id, UserModel.id, path.c.level)
+                    .join_from(UserModel, path, true())
+                    .where(UserModel.id == db_user.id)
+                )
+            )
+            await cls._update_referral_counts(ses, db_user.id, 1)
+
+        await ses.commit()
+        SIGNUPS.labels(str(owner is not None).lower()).inc()
+        return db_user
+
+    @classmethod
+    async def _update_referral_counts(cls, ses, user_id: uuid.UUID, delta: int) -> None:
+        """
+        Прибавляет delta к счетчикам рефералов всех пригласивших юзера (по его referral_path).\n
+        Строки счетчиков блокируются в порядке (owner_id, level), поэтому параллельные
+        регистрации с общими пригласившими не приводят к взаимоблокировкам
+        """
+        path = func.unnest(UserModel.referral_path).table_valued('owner_id', with_ordinality='level')
+        stmt = pg_insert(ReferralCountModel).from_select(
+            ['owner_id', 'level', 'count'],
+            select(path.c.owner_id, path.c.level, literal(delta))
+            .join_from(UserModel, path, true())
+            .where(UserModel.id == user_id)
+            .order_by(path.c.owner_id, path.c.level)
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ReferralCountModel.owner_id, ReferralCountModel.level],
+            set_=dict(count=ReferralCountModel.count + stmt.excluded.count),
+        )
+        await ses.execute(stmt)
+
     @classmethod
     async def get_users(
             cls,
@@ -158,6 +187,60 @@ class UserService:
 
     @classmethod
     async def get_user_by_telegram_id(cls, tg_id: str) -> dict[str, Any]:
+        profile = await cls._get_profile_snapshot(tg_id)
+        catalog = await CatalogService.get()
+        country = catalog.countries.get(profile['country_id'])
+        region = catalog.regions.get(profile['region_id'])
+        rating_positions = await LeaderboardService.get_positions(profile['id'])
+        energy, _ = restored_energy(
+            profile['energy'],
+            datetime.fromisoformat(profile['last_energy_update']),
+            profile['timezone'],
+        )
+        game_balance = profile['game_balance'] + passive_income(
+            profile['total_capacity'],
+            datetime.fromisoformat(profile['last_accrued_at']),
+        )
+
+        output_dict: dict[str, Any] = {
+            'id': profile['id'],
+            'tg_id': profile['tg_id'],
+            'username': profile['username'],
+            'first_name': profile['first_name'],
+            'last_name': profile['last_name'],
+            'country': cls._country_dict(country) if country else None,
+            'region': cls._region_dict(region) if region else None,
+            'total_capacity': profile['total_capacity'],
+            'total_boost_value': profile['total_boost_value'],
+            'user_rating_position': rating_positions[RatingType.gdp],
+            'capacity_rating_position': rating_positions[RatingType.capacity],
+            'energy': energy,
+            'game_balance': game_balance,
+            'enterprises_slots': profile['enterprises_slots'],
+            'can_open_case': profile['can_open_case'],
+            'referrer_id': str(profile['referrer_id']),
+        }
+
+        if cfg.tap_write_behind:
+            # несброшенные тапы юзера еще лежат в redis
+            tap_state = await TapService.get_state(tg_id)
+            if tap_state:
+                output_dict.update(tap_state)
+
+        return output_dict
+
+    @classmethod
+    async def _get_profile_snapshot(cls, tg_id: str) -> dict[str, Any]:
+        """
+        Снимок профиля из кэша, при промахе - из базы с записью в кэш.
+        Страна и регион берутся из справочников при чтении.
+        Поколение профиля запоминается до чтения из базы: если профиль за это время
+        инвалидировали, прочитанный снимок мог устареть и в кэш не пишется
+        """
+        profile, version = await ProfileCacheService.get(tg_id)
+        if profile is not None:
+            return profile
+
         async with db.session_factory() as ses:
             db_user = await UserDAO.find_one_or_none(ses, tg_id=tg_id)
             if db_user is None:
@@ -167,52 +250,53 @@ class UserService:
                     f"User by tg_id {tg_id} not found"
                 )
 
-            country = await CountryDAO.find_first(ses, id=db_user.country_id)
-            region = await RegionDAO.find_first(ses, id=db_user.region_id)
-            user_rating_gdp = await GdpUserRatingDAO.find_one_or_none(ses, user_id=db_user.id)
-            user_rating_capacity = await CapacityUserRatingDAO.find_one_or_none(ses, user_id=db_user.id)
-
-            rating_position = user_rating_gdp.id if user_rating_gdp else None
-            capacity_rating_position = user_rating_capacity.id if user_rating_capacity else None
-
-            output_dict: dict[str, Any] = {
-                'id': str(db_user.id),
-                'tg_id': db_user.tg_id,
-                'username': db_user.username,
-                'first_name': db_user.first_name,
-                'last_name': db_user.last_name,
-                'country': None,
-                'region': None,
-                'total_capacity': db_user.total_capacity,
-                'total_boost_value': db_user.total_boost_value,
-                'user_rating_position': rating_position,
-                'capacity_rating_position': capacity_rating_position,
-                'energy': db_user.energy,
-                'game_balance': db_user.game_balance,
-                'enterprises_slots': db_user.enterprises_slots,
-                'can_open_case': db_user.can_open_case,
-                'referrer_id': str(db_user.referrer_id),
-            }
-
-            if country:
-                country_dict = dict(
-                    id=country.id,
-                    name=country.name,
-                    description=country.description,
-                    image_url=country.image_url,
-                    total_gdp=country.total_gdp,
-                )
-                output_dict['country'] = country_dict
+        profile = cls._profile_snapshot(db_user)
+        await ProfileCacheService.set(tg_id, profile, version)
+        return profile
 
-            if region:
-                region_dict = dict(
-                    id=region.id,
-                    name=region.name,
-                    country_id=region.country_id,
-                )
-                output_dict['region'] = region_dict
+    @classmethod
+    def _profile_snapshot(cls, db_user: UserModel) -> dict[str, Any]:
+        profile: dict[str, Any] = {
+            'id': str(db_user.id),
+            'tg_id': db_user.tg_id,
+            'username': db_user.username,
+            'first_name': db_user.first_name,
+            'last_name': db_user.last_name,
+            'tg_url': db_user.tg_url,
+            'tg_chat_id': db_user.tg_chat_id,
+            'is_bot': db_user.is_bot,
+            'country_id': db_user.country_id,
+            'region_id': db_user.region_id,
+            'total_capacity': db_user.total_capacity,
+            'total_boost_value': db_user.total_boost_value,
+            'energy': db_user.energy,
+            'last_energy_update': db_user.last_energy_update.isoformat(),
+            'timezone': db_user.timezone,
+            'game_balance': db_user.game_balance,
+            'last_accrued_at': db_user.last_accrued_at.isoformat(),
+            'enterprises_slots': db_user.enterprises_slots,
+            'can_open_case': db_user.can_open_case,
+            'referrer_id': str(db_user.referrer_id) if db_user.referrer_id else None,
+        }
+        return profile
 
-            return output_dict
+    @classmethod
+    def _country_dict(cls, country: CountryModel) -> dict[str, Any]:
+        return dict(
+            id=country.id,
+            name=country.name,
+            description=country.description,
+            image_url=country.image_url,
+            total_gdp=country.total_gdp,
+        )
+
+    @classmethod
+    def _region_dict(cls, region: RegionModel) -> dict[str, Any]:
+        return dict(
+            id=region.id,
+            name=region.name,
+            country_id=region.country_id,
+        )
 
 
 
@@ -222,10 +306,13 @@ class UserService:
             tg_id: str,
             user_update: UserUpdate,
     ) -> Any:
+        # баланс в postgres должен включать тапы, накопленные в redis, до его изменения ниже
+        await TapService.invalidate(tg_id)
         async with db.session_factory() as ses:
             db_user = await UserDAO.find_one_or_none(ses, tg_id=tg_id)
 
             output_dict = {}
+            catalog = await CatalogService.get()
 
             if db_user is None:
                 exception_and_log(
@@ -234,6 +321,7 @@ class UserService:
                     f"User by tg_id {tg_id} not found"
                 )
             else:
+                old_country_id, old_balance = db_user.country_id, cls._effective_balance(db_user)
                 # if user_update.username is not None:
                 #     db_user.username = user_update.username
                 #     output_dict['username'] = db_user.username
@@ -247,7 +335,7 @@ class UserService:
                     db_user.tg_url = user_update.tg_url
                     output_dict['tg_url'] = db_user.tg_url
                 if user_update.country_id is not None:
-                    country = await CountryDAO.find_first(ses, id=user_update.country_id)
+                    country = catalog.countries.get(user_update.country_id)
                     if country is None:
                         exception_and_log(
                             cfg.debug,
@@ -256,18 +344,13 @@ class UserService:
                         )
 
                     if user_update.country_id != db_user.country_id:
+                        cls._accrue_passive_income(db_user)
                         db_user.game_balance = int(db_user.game_balance / 2)
 
                     db_user.country_id = user_update.country_id
                     db_user.region_id = None
 
-                    output_dict['country'] = dict(
-                        id=country.id,
-                        name=country.name,
-                        description=country.description,
-                        image_url=country.image_url,
-                        total_gdp=country.total_gdp,
-                    )
+                    output_dict['country'] = cls._country_dict(country)
 
                 if user_update.region_id is not None:
                     # region = await RegionDAO.find_first(ses, id=user_update.region_id)
@@ -278,11 +361,7 @@ class UserService:
                             "You cannot update the region_id while the country_id is None"
                         )
 
-                    region = await RegionDAO.find_first(
-                        ses,
-                        id=user_update.region_id,
-                        country_id=db_user.country_id
-                    )
+                    region = catalog.region(user_update.region_id, country_id=db_user.country_id)
                     if region is None:
                         exception_and_log(
                             cfg.debug,
@@ -291,80 +370,204 @@ class UserService:
                         )
 
                     if user_update.country_id is None and db_user.country_id == 1 and user_update.region_id != db_user.region_id:
+                        cls._accrue_passive_income(db_user)
                         db_user.game_balance = int(db_user.game_balance / 2)
 
                     db_user.region_id = user_update.region_id
 
-                    output_dict['region'] = dict(
-                        id=region.id,
-                        name=region.name,
-                        country_id=region.country_id,
-                    )
+                    output_dict['region'] = cls._region_dict(region)
+
+                if user_update.timezone is not None:
+                    cls._check_timezone(user_update.timezone)
+                    db_user.timezone = user_update.timezone
+                    output_dict['timezone'] = db_user.timezone
 
+                await CountryRatingService.apply_user_change(
+                    ses, old_country_id, old_balance, db_user.country_id, cls._effective_balance(db_user))
                 await ses.commit()
+                await TapService.invalidate(tg_id)
+                await ProfileCacheService.invalidate(tg_id)
+                await cls._update_leaderboards(ses, db_user)
                 return output_dict
 
 
 
+    @classmethod
+    def _check_timezone(cls, tz_name: str) -> None:
+        if not is_known_zone(tz_name):
+            exception_and_log(
+                cfg.debug,
+                status.HTTP_400_BAD_REQUEST,
+                f"Unknown timezone {tz_name}"
+            )
+
+    @classmethod
+    async def _update_leaderboards(cls, ses, db_user: UserModel) -> None:
+        """
+        Обновляет очки и данные юзера в рейтингах после изменения в базе
+        """
+        catalog = await CatalogService.get()
+        country = catalog.countries.get(db_user.country_id)
+
+        await LeaderboardService.update_user(
+            db_user.id,
+            game_balance=cls._effective_balance(db_user),
+            total_capacity=db_user.total_capacity,
+            profile=rating_profile(db_user, country.image_url if country else None),
+        )
+
+    @classmethod
+    def _effective_balance(cls, db_user: UserModel) -> int:
+        """
+        ВВП юзера с учетом еще не начисленного пассивного дохода
+        """
+        return db_user.game_balance + passive_income(db_user.total_capacity, db_user.last_accrued_at)
+
+    @classmethod
+    def _accrue_passive_income(cls, db_user: UserModel) -> None:
+        """
+        Начисляет накопленный пассивный доход перед изменением game_balance в python
+        """
+        now = datetime.now(timezone.utc)
+        db_user.game_balance += passive_income(db_user.total_capacity, db_user.last_accrued_at, now)
+        db_user.last_accrued_at = now
+
     @classmethod
     async def update_game_balance(
             cls,
             tg_id: str,
             new_tap_count: int,
     ) -> dict:
+        if cfg.tap_write_behind:
+            return await TapService.update_game_balance(tg_id, new_tap_count)
+
         async with db.session_factory() as ses:
-            db_user = await UserDAO.find_one_or_none(ses, tg_id=tg_id)
-            if db_user is None:
-                exception_and_log(
-                    cfg.debug,
-                    status.HTTP_404_NOT_FOUND,
-                    f"User by tg_id {tg_id} not found"
-                )
-            else:
+            result = await ses.execute(cls._settle_taps_stmt(tg_id, new_tap_count))
+            settlement = result.one_or_none()
+            await ses.commit()
+
+        if settlement is None:
+            exception_and_log(
+                cfg.debug,
+                status.HTTP_404_NOT_FOUND,
+                f"User by tg_id {tg_id} not found"
+            )
 
-                if db_user.energy == 0:
-                    return dict(
-                        message="The energy is gone",
-                        balance=db_user.game_balance
-                    )
+        if settlement.new_balance is not None:
+            await ProfileCacheService.invalidate(tg_id)
+            await LeaderboardService.update_user(settlement.id, game_balance=settlement.new_balance)
+            TAP_SETTLEMENTS.labels('sql', 'settled').inc()
+            return dict(
+                message="Balance successfully updated",
+                balance=settlement.new_balance
+            )
 
-                current_tap_count = (cfg.energy_limit - db_user.energy)
+        if settlement.energy == 0:
+            TAP_SETTLEMENTS.labels('sql', 'energy_exhausted').inc()
+            return dict(
+                message="The energy is gone",
+                balance=settlement.game_balance
+            )
 
-                if new_tap_count < current_tap_count or new_tap_count < 0:
-                    return dict(
-                        message="""Вы не можете передать кол-во кликов меньше 0 или меньше,
-                         чем уже сделали за сегодня""",
-                        balance=db_user.game_balance
-                    )
+        current_tap_count = (cfg.energy_limit - settlement.energy)
 
-                if new_tap_count == 0:
-                    return dict(
-                        message="Make taps before update your balance",
-                        balance=db_user.game_balance
-                    )
+        if new_tap_count < current_tap_count or new_tap_count < 0:
+            TAP_SETTLEMENTS.labels('sql', 'rejected').inc()
+            return dict(
+                message="""Вы не можете передать кол-во кликов меньше 0 или меньше,
+                         чем уже сделали за сегодня""",
+                balance=settlement.game_balance
+            )
 
-                new_tap_count = new_tap_count - current_tap_count
+        if new_tap_count == 0:
+            TAP_SETTLEMENTS.labels('sql', 'no_taps').inc()
+            return dict(
+                message="Make taps before update your balance",
+                balance=settlement.game_balance
+            )
 
-                total_boost = db_user.total_boost_value if db_user.total_boost_value != 0 else 1
-                composition = total_boost * db_user.total_capacity
-                additional_value = composition / 100 if composition != 0 else 0
+        # новых тапов нет, начислять нечего
+        TAP_SETTLEMENTS.labels('sql', 'no_new_taps').inc()
+        return dict(
+            message="Balance successfully updated",
+            balance=settlement.game_balance
+        )
 
-                if db_user.energy >= new_tap_count:
-                    db_user.game_balance += ((db_user.total_capacity + additional_value) * 2) * new_tap_count
-                    db_user.energy -= new_tap_count
-                    await ses.commit()
-                    return dict(
-                        message="Balance successfully updated",
-                        balance=db_user.game_balance
-                    )
-                else:
-                    db_user.game_balance += ((db_user.total_capacity + additional_value) * 2) * db_user.energy
-                    db_user.energy = 0
-                    await ses.commit()
-                    return dict(
-                        message="Balance successfully updated",
-                        balance=db_user.game_balance
-                    )
+    @classmethod
+    def _settle_taps_stmt(cls, tg_id: str, new_tap_count: int):
+        """
+        Расчет тапов за один запрос к базе.\n
+        cur - состояние юзера до начисления (строка user_state заблокирована FOR UPDATE, поэтому параллельные
+        начисления по одному юзеру выполняются по очереди), settled - начисление,
+        которое выполняется только если есть энергия и новые тапы.
+        Если settled пустой, по значениям из cur определяется причина отказа.\n
+        Энергия восстанавливается лениво: если наступило время восстановления,
+        расчет идет от полной энергии и время восстановления обновляется.
+        Вместе с тапами начисляется накопленный пассивный доход, а начисленное за тапы
+        записывается в изменения ВВП страны (country_rating_deltas) тем же запросом
+        """
+        state = UserStateModel
+        restore_due = energy_restore_due_sql(state.last_energy_update, UserModel.timezone)
+        energy = case((restore_due, cfg.energy_limit), else_=state.energy)
+        game_balance = state.game_balance + passive_income_sql(state.total_capacity, state.last_accrued_at)
+
+        cur = (
+            select(
+                UserModel.id,
+                UserModel.country_id,
+                energy.label('energy'),
+                game_balance.label('game_balance'),
+                restore_due.label('restore_due'),
+                state.total_capacity,
+                state.total_boost_value,
+            )
+            .join(UserModel.state)
+            .where(UserModel.tg_id == tg_id)
+            .with_for_update(of=state)
+            .cte('cur')
+        )
+
+        current_tap_count = cfg.energy_limit - cur.c.energy
+        taps = func.least(cur.c.energy, new_tap_count - current_tap_count)
+        settled = (
+            update(state)
+            .where(
+                state.user_id == cur.c.id,
+                cur.c.energy > 0,
+                current_tap_count < new_tap_count,
+            )
+            .values(
+                game_balance=cur.c.game_balance + tap_reward_sql(
+                    cur.c.total_capacity, cur.c.total_boost_value, taps),
+                last_accrued_at=func.now(),
+                energy=cur.c.energy - taps,
+                last_energy_update=case((cur.c.restore_due, func.now()), else_=state.last_energy_update),
+            )
+            .returning(state.game_balance)
+            .cte('settled')
+        )
+        country_delta = (
+            insert(country_rating_deltas)
+            .from_select(
+                ['country_id', 'delta'],
+                select(cur.c.country_id, settled.c.game_balance - cur.c.game_balance)
+                .select_from(cur.join(settled, true()))
+                .where(cur.c.country_id.is_not(None))
+            )
+            .cte('country_delta')
+        )
+
+        return (
+            select(
+                cur.c.id,
+                cur.c.country_id,
+                cur.c.energy,
+                cur.c.game_balance,
+                settled.c.game_balance.label('new_balance'),
+            )
+            .select_from(cur.outerjoin(settled, true()))
+            .add_cte(country_delta)
+        )
 
 
     @classmethod
@@ -384,6 +587,7 @@ class UserService:
                 if db_user.enterprises_slots < cfg.enterprises_max_slots:
                     db_user.enterprises_slots += 1
                     await session.commit()
+                    await ProfileCacheService.invalidate(tg_id)
                     if cfg.debug:
                         log.success("Слот успешно добавлен")
                     return dict(
@@ -401,28 +605,27 @@ class UserService:
             cls,
             tg_id: str,
     ) -> dict[str, Any]:
+        # счетчики по уровням ведутся при регистрации (см. _update_referral_counts),
+        # outer join отличает юзера без рефералов от несуществующего
         async with db.session_factory() as ses:
-            db_user = await UserDAO.find_one_or_none(ses, tg_id=tg_id)
-            if db_user is None:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"User by tg_id {tg_id} not found"
-                )
-
             stmt = (
-                select(ReferralModel.level_id, func.count(ReferralModel.id))
-                .filter(ReferralModel.owner_id == db_user.id)
-                .group_by(ReferralModel.level_id)
+                select(UserModel.id, ReferralCountModel.level, ReferralCountModel.count)
+                .outerjoin(ReferralCountModel, and_(
+                    ReferralCountModel.owner_id == UserModel.id,
+                    ReferralCountModel.count > 0,
+                ))
+                .where(UserModel.tg_id == tg_id)
+                .order_by(ReferralCountModel.level)
             )
             res = await ses.execute(stmt)
             refferal_counts = res.all()
-            if refferal_counts is None:
+            if not refferal_counts:
                 raise HTTPException(
                     status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"Referrals not found"
+                    detail=f"User by tg_id {tg_id} not found"
                 )
 
-            referral_stats = {item[0]: item[1] for item in refferal_counts}
+            referral_stats = {level: count for _, level, count in refferal_counts if level is not None}
             return dict(
                 total_referrals=sum(referral_stats.values()),
                 level_stats=referral_stats
@@ -432,27 +635,33 @@ class UserService:
     @classmethod
     async def get_referrals(
             cls,
-            offset: int,
-            limit: int,
-            order_by: Optional[str],
+            tg_id: str,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            order_by: str = 'id',
             sort_type: str = SortType.ASC,
-    ) -> list[UserReferral]:
-        async with db.session_factory() as session:
-            referrals = await UserReferralDAO.find_all(
-                session,
-                offset=offset,
+    ) -> Page[UserReferral]:
+        async with db.session_factory() as ses:
+            db_user = await UserDAO.find_one_or_none(ses, tg_id=tg_id)
+            if db_user is None:
+                exception_and_log(
+                    cfg.debug,
+                    status.HTTP_404_NOT_FOUND,
+                    f"User by tg_id {tg_id} not found"
+                )
+
+            referrals, next_cursor = await UserReferralDAO.find_page(
+                ses,
+                cursor=cursor,
                 limit=limit,
                 order_by=order_by,
                 sort_type=sort_type,
+                owner_id=db_user.id,
+            )
+            return Page[UserReferral](
+                items=[UserReferral.model_validate(ref) for ref in referrals],
+                next_cursor=next_cursor,
             )
-            if referrals is None:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"Referrals not found"
-                )
-            return [ref for ref in referrals]
-
-
 
     @classmethod
     async def create_or_update_user_by_telegram_id(cls, message, payload: Any):
@@ -493,70 +702,10 @@ class UserService:
                         region_id=None,
                         referrer_id=str(owner_user.id) if owner_user else None
                     )
-                    new_user = await UserDAO.add(
-                        ses,
-                        user_obj
-                    )
-
-                    total_capacity = 0
-
-                    for i in range(1, 4):  # Добавляем 3 начальных предприятия юзеру
-                        added_ents = await UserEnterpriseDAO.add(
-                            ses,
-                            UserEnterpriseCreate(
-                                tg_id=new_user.tg_id,
-                                enterprise_id=i,
-                            )
-                        )
-                        current_ent = await EnterpriseDAO.find_one_or_none(ses, id=i)
-                        total_capacity += current_ent.capacity
-                        await ses.commit()
-
-                    new_user.total_capacity = total_capacity
-                    await ses.commit()
-
-                    if owner_user:
-                        # log.info(f'Owner:{owner_user}')
-                        level = 1
-                        current_referrer_id = owner_user.referrer_id
-
-                        # Реализация многоуровневой реферальной системы
-                        # Идем вверх по цепочке, пока не достигнем 10 уровня или юзера, которого никто не приглашал
-                        while level <= 10:
-
-                            # если такой юзер найден, добавляем одну запись и выходим из цикла
-                            if current_referrer_id is None:
-                                ref_obj = UserReferralCreate(
-                                    owner_id=owner_user.id,
-                                    referral_id=new_user.id,
-                                    level_id=1
-                                )
-                                log.success(f'Юзер найден. Добавляем одну запись:{ref_obj}')
-                                new_ref = await UserReferralDAO.add(ses, obj_in=ref_obj)
-                                await ses.commit()
-                                break
-                            else:  # если нет, добавляем записи (рефералов) для каждого юзера вверх по цепочке
-                                log.warning(f'Юзер не найден. Идем вверх по цепочке')
-                                next_owner = await UserDAO.find_one_or_none(ses, id=current_referrer_id)
-                                if next_owner is None:
-                                    log.warning(f'Next owner не найден')
-                                    break
-
-                                level += 1
-                                ref_for_next_owner = UserReferralCreate(
-                                    owner_id=next_owner.id,
-                                    referral_id=new_user.id,
-                                    level_id=level
-                                )
-                                new_ref = await UserReferralDAO.add(ses, obj_in=ref_for_next_owner)
-                                await ses.commit()
-                                current_referrer_id = next_owner.referrer_id
-                        else:
-                            log.warning(f"Owner by uuid: {owner_user.referrer_id} not found")
-
+                    new_user = await cls._onboard_user(ses, user_obj, owner_user)
+                    await cls._update_leaderboards(ses, new_user)
 
                     if new_user is not None:
-                        await ses.commit()
                         if cfg.debug:
                             log.success(f'Новый пользователь успешно создан: {new_user}')
                     else:
@@ -565,6 +714,8 @@ class UserService:
 
                 else:
                     log.info(f'Пользователь уже создан: \n{exist_user}\nОбновление данных пользователя...')
+                    # юзер снова пишет боту, значит разблокировал его
+                    exist_user.bot_blocked_at = None
                     user_obj = UserUpdate(
                         # username=str(message.from_user.username),
                         first_name=str(message.from_user.first_name),
@@ -602,6 +753,8 @@ class UserService:
             current_user.tg_url = user_update.tg_url
 
         await session.commit()
+        await ProfileCacheService.invalidate(current_user.tg_id)
+        await cls._update_leaderboards(session, current_user)
         return user_update
 
 
@@ -609,49 +762,48 @@ class UserService:
     async def get_gdp_rating(
             cls,
             offset: int = 0,
+            cursor: Optional[str] = None,
             limit: int = 100,
-    ) -> list[UserRating]:
-        async with db.session_factory() as ses:
-            stmt = (
-                select(GdpUserRatingModel)
-                .offset(offset)
-                .limit(limit)
-                .order_by(desc(text('total')))
-            )
-
-            result = await ses.execute(stmt)
-            users = result.scalars().all()
-
-            if users is None:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"Users gdp rating not found"
-                )
-            return [user for user in users]
+    ) -> Page[UserRating]:
+        items, next_cursor = await LeaderboardService.get_page(
+            RatingType.gdp, offset=offset, cursor=cursor, limit=limit)
+        return Page[UserRating](items=items, next_cursor=next_cursor)
 
     @classmethod
     async def get_capacity_rating(
             cls,
             offset: int = 0,
+            cursor: Optional[str] = None,
             limit: int = 100,
-    ) -> list[UserRating]:
-        async with db.session_factory() as ses:
-            stmt = (
-                select(CapacityUserRatingModel)
-                .offset(offset)
-                .limit(limit)
-                .order_by(desc(text('total')))
-            )
-
-            result = await ses.execute(stmt)
-            users = result.scalars().all()
+    ) -> Page[UserRating]:
+        items, next_cursor = await LeaderboardService.get_page(
+            RatingType.capacity, offset=offset, cursor=cursor, limit=limit)
+        return Page[UserRating](items=items, next_cursor=next_cursor)
 
-            if users is None:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"Users capacity rating not found"
+    @classmethod
+    async def get_rating_around(
+            cls,
+            tg_id: str,
+            rating_type: RatingType,
+            size: int = 10,
+    ) -> UserRatingWindow:
+        async with db.session_factory() as ses:
+            db_user = await UserDAO.find_one_or_none(ses, tg_id=tg_id)
+            if db_user is None:
+                exception_and_log(
+                    cfg.debug,
+                    status.HTTP_404_NOT_FOUND,
+                    f"User by tg_id {tg_id} not found"
                 )
-            return [user for user in users]
+
+        window = await LeaderboardService.get_around(rating_type, db_user.id, size=size)
+        if window is None:
+            exception_and_log(
+                cfg.debug,
+                status.HTTP_404_NOT_FOUND,
+                f"User by tg_id {tg_id} not found in {rating_type.value} rating"
+            )
+        return window
 
 
     # @classmethod
@@ -680,13 +832,23 @@ class UserService:
                     status.HTTP_404_NOT_FOUND,
                     f"User by user_id {user_id} not found"
                 )
+            if user.timezone is not None:
+                cls._check_timezone(user.timezone)
+            await TapService.invalidate(db_user.tg_id)
+            await session.refresh(db_user)
 
+            old_country_id, old_balance = db_user.country_id, cls._effective_balance(db_user)
             user_update = await UserDAO.update(
                 session,
                 UserModel.id == user_id,
                 obj_in=user)
 
+            await CountryRatingService.apply_user_change(
+                session, old_country_id, old_balance, user_update.country_id, cls._effective_balance(user_update))
             await session.commit()
+            await TapService.invalidate(user_update.tg_id)
+            await ProfileCacheService.invalidate(user_update.tg_id)
+            await cls._update_leaderboards(session, user_update)
             return user_update
 
     @classmethod
@@ -701,8 +863,14 @@ class UserService:
                 )
             else:
                 try:
+                    await cls._update_referral_counts(session, user_id, -1)
+                    await CountryRatingService.apply_user_change(
+                        session, db_user.country_id, cls._effective_balance(db_user), None, 0)
                     await UserDAO.delete(session, UserModel.id == user_id)
                     await session.commit()
+                    await TapService.invalidate(db_user.tg_id)
+                    await ProfileCacheService.invalidate(db_user.tg_id)
+                    await LeaderboardService.remove_user(user_id)
                 except Exception as e:
                     log.error(f"Error deleting user: {e}")
 
@@ -1,4 +1,4 @@
-from requests import JSONDecodeError
+import asyncio
 from typing_extensions import Any, Annotated
 
 
@@ -7,7 +7,6 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
 
-from fastapi_utilities import add_timer_middleware
 # from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from src.game_api.routes.user_routes import user_router
@@ -16,6 +15,13 @@ from src.game_api.routes.stars_payment_routes import stars_payment_router
 from src.game_api.routes.country_routes import country_router
 from src.game_api.routes.boost_routes import boost_router
 from src.game_api.routes.case_routes import case_router
+from src.game_api.services.tap_service import TapService
+from src.game_api.services.leaderboard_service import LeaderboardService
+from src.game_api.services.catalog_service import CatalogService
+from src.game_api.services.country_rating_service import CountryRatingService
+from src.game_api.services.commission_service import CommissionService
+from src.core.metrics import MetricsMiddleware, metrics_response, mark_process_dead
+from src.core.query_profiler import QueryProfilerMiddleware
 
 from src.redis_queue import queue
 from src.settings import get_settings
@@ -26,8 +32,8 @@ redis = queue.get_redis()
 # scheduler = AsyncIOScheduler()
 
 if cfg.run_type != 'dev':
-    from src.telegram.bot import bot, dp, start_telegram, end_telegram
-    from aiogram.types import Update
+    from src.telegram.bot import start_telegram, end_telegram
+    from src.telegram.update_stream import publish_update
 
 
 @asynccontextmanager
@@ -39,13 +45,60 @@ async def lifespan(application: FastAPI):
         log.info("🚀 Telegram bot starting")
         await start_telegram()
 
+    # справочники в памяти воркера, брокер уже слушает канал инвалидации
+    await CatalogService.load()
+
+    # рейтинги в redis собираются из postgres при холодном старте
+    leaderboards_build = asyncio.create_task(LeaderboardService.ensure_built())
+    # и периодически пересобираются, чтобы подтянуть пассивный доход неактивных юзеров
+    leaderboards_rebuilder = asyncio.create_task(LeaderboardService.run_rebuilder())
+
+    # изменения ВВП стран копятся в country_rating_deltas и периодически применяются к рейтингу,
+    # раз в час рейтинг стран пересчитывается целиком
+    country_rating_flusher = asyncio.create_task(CountryRatingService.run_flusher())
+    country_rating_reconciler = asyncio.create_task(CountryRatingService.run_reconciler())
+
+    # реферальные комиссии раз в сутки
+    commissions_scheduler = asyncio.create_task(CommissionService.run_scheduler())
+
+    tap_flusher = None
+    if cfg.tap_write_behind:
+        log.info("🚀 Tap flusher starting")
+        tap_flusher = asyncio.create_task(TapService.run_flusher())
+
     yield
 
+    if tap_flusher is not None:
+        log.info("⛔ Tap flusher stopping")
+        tap_flusher.cancel()
+        try:
+            await tap_flusher
+        except asyncio.CancelledError:
+            pass
+        await TapService.flush_all()
+
+    for task in (commissions_scheduler, country_rating_reconciler, country_rating_flusher):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    await CountryRatingService.flush()
+
+    if not leaderboards_build.done():
+        leaderboards_build.cancel()
+    leaderboards_rebuilder.cancel()
+    try:
+        await leaderboards_rebuilder
+    except asyncio.CancelledError:
+        pass
+
     await queue.get_broker().close()
     if cfg.run_type != 'dev':
         log.info("⛔ Telegram bot stopping")
         await end_telegram()
 
+    mark_process_dead()
     log.info("⛔ Stopping FastAPI application")
 
 
@@ -58,7 +111,8 @@ app = FastAPI(
     # redoc_url="/redoc",
     # openapi_url="/openapi.json"
 )
-add_timer_middleware(app, show_avg=True)
+app.add_middleware(QueryProfilerMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -76,6 +130,7 @@ app.add_middleware(
         "Access-Control-Allow-Origin",
         "Authorization"
     ],
+    expose_headers=["X-Next-Cursor"],
 )
 # app.mount("/static", StaticFiles(directory="./web/static"), name="static")
 # templates = Jinja2Templates(directory="./web/templates")
@@ -92,12 +147,21 @@ def root():
     return 'Hello World!'
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return metrics_response()
+
+
 @app.post(cfg.webhook_path)
 async def bot_webhook(
         request: Request,
         x_telegram_bot_api_secret_token: Annotated[str | None, Header()] = None
 ) -> dict:
-    """ Register webhook endpoint for telegram bot"""
+    """
+    Register webhook endpoint for telegram bot.\n
+    Обновление не обрабатывается здесь: оно кладется в redis stream и сразу подтверждается,
+    обработку выполняет воркер (python -m src.telegram.worker)
+    """
     try:
         payload = await request.body()
         if not payload:
@@ -108,11 +172,8 @@ async def bot_webhook(
                 log.error(f"Wrong secret token ! : {x_telegram_bot_api_secret_token}")
             return {"status": "error", "message": "Wrong secret token!"}
 
-        update = Update.model_validate(await request.json(), context={"bot": bot})
-        await dp.feed_update(bot, update)
+        await publish_update(payload)
         return {'status': 'ok'}
-    except JSONDecodeError:
-        return {'status': 'error', 'message': 'Invalid JSON'}
     except HTTPException as e:
         if cfg.debug:
             log.error(f"Ошибка вебхука: {e.detail}")
@@ -1,7 +1,10 @@
-from typing import final
+import asyncio
+import uuid
+from typing import Any, Awaitable, Callable, Optional, final
 from faststream import FastStream
 from faststream.redis import RedisBroker, RedisMessage, Redis
 
+from src.game_api.utils import log
 from src.settings import get_settings
 
 cfg = get_settings()
@@ -30,3 +33,128 @@ class Queue:
 
 
 queue = Queue(redis_broker_url=cfg.redis_broker_url, redis_url=cfg.aioredis_url)
+
+# Снимает блокировку KEYS[1] (и удаляет KEYS[2..]), только если она еще принадлежит владельцу ARGV[1]
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', unpack(KEYS))
+end
+return 0
+"""
+
+# Продлевает блокировку KEYS[1] на ARGV[2] сек, только если она еще принадлежит владельцу ARGV[1]
+_EXTEND_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class RedisLock:
+    """
+    Блокировка SET NX EX со случайным токеном владельца.\n
+    Продлевается и снимается только владельцем: если блокировка истекла и ее взял
+    другой процесс, чужая блокировка не продлевается и не удаляется
+    """
+    _release = queue.get_redis().register_script(_RELEASE_LUA)
+    _extend = queue.get_redis().register_script(_EXTEND_LUA)
+
+    def __init__(self, key: str, ttl: int) -> None:
+        self.key = key
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+
+    async def acquire(self) -> bool:
+        return bool(await queue.get_redis().set(self.key, self.token, nx=True, ex=self.ttl))
+
+    async def extend(self) -> bool:
+        """
+        False - блокировка истекла, работу под ней нужно прервать
+        """
+        return bool(await self._extend(keys=[self.key], args=[self.token, self.ttl]))
+
+    async def release(self, *also_delete: str) -> None:
+        """
+        also_delete - ключи, которые удаляются вместе с блокировкой, если она еще принадлежит владельцу
+        """
+        await self._release(keys=[self.key, *also_delete], args=[self.token])
+
+
+async def reclaim_pending(
+        stream: str,
+        group: str,
+        consumer: str,
+        handler: Callable[[bytes], Awaitable[Any]],
+        dead_letter_stream: str,
+        dead_letter_handler: Optional[Callable[[bytes], Awaitable[Any]]] = None,
+) -> int:
+    """
+    Повторно обрабатывает записи stream, зависшие в pending группы дольше cfg.stream_pending_idle мс
+    (потребитель упал или обработка завершилась ошибкой). Записи забираются XAUTOCLAIM на consumer,
+    handler получает тело сообщения faststream. После cfg.stream_max_deliveries доставок запись
+    переносится в dead_letter_stream, dead_letter_handler (если задан) получает ее тело.
+    Возвращает кол-во подтвержденных записей
+    """
+    from faststream.redis.parser import RawMessage
+
+    redis = queue.get_redis()
+    acked = 0
+    start_id = '0-0'
+    while True:
+        start_id, entries, *_ = await redis.xautoclaim(
+            stream, group, consumer, min_idle_time=cfg.stream_pending_idle, start_id=start_id, count=100)
+        deliveries = {}
+        if entries:
+            pending = await redis.xpending_range(
+                stream, group, min=entries[0][0], max=entries[-1][0], count=len(entries), consumername=consumer)
+            deliveries = {entry['message_id']: entry['times_delivered'] for entry in pending}
+
+        for message_id, fields in entries:
+            data = (fields or {}).get(b'__data__')
+            if data is None:
+                # запись уже удалена из stream (maxlen)
+                pass
+            elif deliveries.get(message_id, 0) > cfg.stream_max_deliveries:
+                log.error(f'{stream} entry {message_id} moved to {dead_letter_stream} '
+                          f'after {cfg.stream_max_deliveries} deliveries')
+                await redis.xadd(dead_letter_stream, {'__data__': data, 'source_id': message_id})
+                if dead_letter_handler is not None:
+                    try:
+                        body, _ = RawMessage.parse(data)
+                        await dead_letter_handler(body)
+                    except Exception as e:
+                        log.error(f'{stream} entry {message_id} dead letter handler failed: {e}')
+            else:
+                try:
+                    body, _ = RawMessage.parse(data)
+                    await handler(body)
+                except Exception as e:
+                    log.error(f'{stream} entry {message_id} failed again: {e}')
+                    continue
+            await redis.xack(stream, group, message_id)
+            acked += 1
+
+        if start_id in (b'0-0', '0-0'):
+            return acked
+
+
+async def run_periodic(name: str, interval: Optional[int], job: Callable[[], Awaitable[Any]]) -> None:
+    """
+    Запускает job раз в interval секунд на весь кластер: каждый процесс раз в cfg.periodic_tasks_tick
+    пытается занять слот schedule:<name> (SET NX EX interval), job выполняет тот, кому это удалось.
+    interval None - задача не запускается
+    """
+    if not interval:
+        return
+    redis = queue.get_redis()
+    while True:
+        try:
+            if await redis.set(f'schedule:{name}', 1, nx=True, ex=interval):
+                log.info(f'Periodic task {name} started')
+                await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f'Periodic task {name} error: {e}')
+        await asyncio.sleep(cfg.periodic_tasks_tick)
@@ -2,6 +2,8 @@ from functools import lru_cache
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import final, Optional
 
+from src.core.enums import EnergyRestorePolicy
+
 
 @final
 class Settings(BaseSettings):
@@ -52,12 +54,82 @@ class Settings(BaseSettings):
     webapp_url: str = f'https://{domain}'
     # Дополнительный токен безопасности для webhook (можно придумать самому)
     tg_secret_token: str = '111'
+    # вебхук кладет обновления в redis stream, обрабатывает их воркер (src.telegram.worker)
+    tg_updates_stream: str = 'telegram:updates'
+    tg_updates_maxlen: int = 100000
+    tg_update_workers: int = 16  # обновлений в обработке одновременно на процесс воркера
+    tg_update_dedup_ttl: int = 24 * 3600  # сек, telegram повторяет доставку не дольше суток
+    tg_updates_dead_letter_stream: str = 'telegram:updates:dead'
+    # записи redis stream, не подтвержденные дольше stream_pending_idle мс, обрабатываются повторно
+    stream_pending_idle: int = 60000
+    stream_max_deliveries: int = 5
+    stream_reclaim_interval: float = 30.0  # сек
+    # рассылки (src.telegram.broadcast), отправляет тот же воркер
+    broadcast_stream: str = 'broadcast:sends'
+    # отправки, которые не удалось обработать за stream_max_deliveries попыток
+    broadcast_dead_letter_stream: str = 'broadcast:sends:dead'
+    broadcast_rate: float = 25.0  # сообщений в секунду на все процессы, telegram допускает около 30
+    broadcast_burst: int = 25
+    broadcast_chunk_size: int = 1000  # получателей на один запрос к users
+    broadcast_workers: int = 8  # отправок одновременно на процесс воркера
+    broadcast_max_attempts: int = 5  # попыток отправки при сетевых ошибках и 5xx, с растущей паузой
+    broadcast_retry_backoff: float = 1.0  # сек, пауза перед второй попыткой, дальше удваивается
+    broadcast_ttl: int = 7 * 24 * 3600  # сек, сколько хранится состояние рассылки после последней отправки
+    # http-сессия бота (src.telegram.session), таймауты в секундах
+    bot_api_pool_size: int = 100
+    bot_api_keepalive: float = 30.0
+    bot_api_concurrency: int = 50  # запросов к Bot API одновременно на процесс
+    bot_api_timeout: float = 10.0
+    bot_api_method_timeouts: dict[str, float] = {
+        'getMe': 5.0,
+        'createInvoiceLink': 5.0,
+        'getStarTransactions': 15.0,
+        'refundStarPayment': 15.0,
+    }
+    bot_api_max_timeout: float = 30.0  # верхняя граница для request_timeout из кода и запросов клиента
+    bot_api_breaker_threshold: int = 5  # ошибок подряд до размыкания
+    bot_api_breaker_reset: float = 30.0
 
     # game config
     energy_limit: int = 500
+    energy_restore_policy: EnergyRestorePolicy = EnergyRestorePolicy.midnight
+    energy_restore_interval_hours: int = 24
     enterprises_min_slots: int = 10
     enterprises_max_slots: int = 15
 
+    # tap write-behind: тапы копятся в redis и периодически сбрасываются в postgres
+    tap_write_behind: bool = False
+    tap_flush_interval: float = 2.0  # сек
+    tap_flush_batch_size: int = 1000
+    tap_state_ttl: int = 3600  # сек, должно быть сильно больше tap_flush_interval
+
+    # read-through кэш профиля юзера (/user/me, /user/check) в redis
+    profile_cache_enabled: bool = True
+    profile_cache_ttl: int = 300  # сек
+
+    # начисление реферальных комиссий, юзеров за одну транзакцию
+    commission_chunk_size: int = 5000
+    commission_interval: Optional[int] = 24 * 3600  # сек, None - не запускать в воркерах api
+
+    # профилирование SQL по HTTP-запросам: запрос одного вида, выполненный за один
+    # HTTP-запрос не меньше sql_n_plus_one_threshold раз, считается вероятным N+1
+    sql_profiling_enabled: bool = True
+    sql_n_plus_one_threshold: int = 5
+
+    # метрики prometheus: при нескольких воркерах uvicorn - общая директория для файлов метрик,
+    # перед запуском воркеров ее нужно очищать
+    metrics_multiproc_dir: Optional[str] = None
+    # воркер telegram (src.telegram.worker) отдает свои метрики на этом порту, None - не отдает
+    worker_metrics_port: Optional[int] = 9101
+
+    # периодические задачи в воркерах api (src.redis_queue.run_periodic), None - не запускать
+    periodic_tasks_tick: float = 60.0  # сек, как часто процесс проверяет, не пора ли запустить задачу
+    leaderboard_rebuild_interval: Optional[int] = 3600  # сек
+
+    # рейтинг стран: как часто накопленные в country_rating_deltas изменения ВВП применяются к рейтингу
+    country_rating_flush_interval: float = 10.0  # сек
+    country_rating_reconcile_interval: Optional[int] = 3600  # сек, None - не запускать в воркерах api
+
 
 @lru_cache()  # get it from memory
 def get_settings() -> Settings:
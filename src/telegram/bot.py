@@ -1,6 +1,8 @@
 import asyncio
+import hashlib
 import json
 import sys
+import uuid
 
 from aiogram import Bot, Dispatcher
 
@@ -8,8 +10,10 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.types import BotCommand
 
+from src.redis_queue import queue
 from src.settings import get_settings, Settings
 from src.telegram.handlers import register_handlers
+from src.telegram.session import BotApiSession
 
 import logging as log
 
@@ -17,9 +21,22 @@ from src.telegram.handlers.commands import base_router
 from src.telegram.handlers.payments import payment_router
 
 cfg: Settings = get_settings()
+redis = queue.get_redis()
+
+SETUP_LOCK_KEY = 'telegram:setup_lock'
+WEBHOOK_CONFIG_KEY = 'telegram:webhook_config'
+
+# Снимает лок, только если он еще наш: при долгой настройке он мог истечь и достаться другому воркеру
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_release_lock = redis.register_script(_RELEASE_LUA)
 
 dp = Dispatcher()
-bot = Bot(cfg.bot_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+bot = Bot(cfg.bot_token, session=BotApiSession(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp.include_router(base_router)
 dp.include_router(payment_router)
 
@@ -32,38 +49,71 @@ dp.include_router(payment_router)
 #     return
 
 
-async def start_telegram() -> None:
-    # webapp_info = WebAppInfo(url=cfg.webapp_url)
-    webhook_info = await bot.get_webhook_info()
+def _commands() -> list[BotCommand]:
+    return [
+        BotCommand(command="/id", description="👋 Get my ID"),
+        BotCommand(command="/get_referral_link", description="Get referral link"),
+        BotCommand(command="/test_pay", description="Test payment"),
+        BotCommand(command="/refund_pay", description="Test refund"),
+        BotCommand(command="/paysupport", description="refund FAQ"),
+    ]
+
 
-    # if webhook_info.url != cfg.webhook_url:
-    await bot.set_webhook(url='')
-    await bot.set_webhook(
+def _webhook_params() -> dict:
+    return dict(
         url=cfg.webhook_url,
         secret_token=cfg.tg_secret_token,
-        allowed_updates=dp.resolve_used_update_types(),
-        drop_pending_updates=True,
+        allowed_updates=sorted(dp.resolve_used_update_types()),
         max_connections=40 if cfg.debug else 100,
     )
 
-    # Назначаем действие для кнопки меню (запускаем webapp)
-    # menu_button = MenuButtonWebApp(text='Play', web_app=webapp_info)
-    # await bot.set_chat_menu_button(menu_button=menu_button)
 
-    # Задаем список команд
-    commands = [
-        BotCommand(command="/id", description="👋 Get my ID"),
-        BotCommand(command="/get_referral_link", description="Get referral link"),
-        BotCommand(command="/test_pay", description="Test payment"),
-        BotCommand(command="/refund_pay", description="Test refund"),
-        BotCommand(command="/paysupport", description="refund FAQ"),
-    ]
-    await bot.set_my_commands(commands)
+def _fingerprint(params: dict) -> str:
+    # secret_token в get_webhook_info не возвращается, поэтому сравниваем с тем, что ставили сами
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+async def start_telegram() -> None:
+    """
+    Настройка вебхука и команд бота. Выполняет один воркер (лидер, взявший лок в redis),
+    остальные сразу начинают обслуживать запросы: вебхук общий для всех воркеров и реплик.
+    Если вебхук уже настроен так же, он не переустанавливается и ожидающие обновления не теряются
+    """
+    lock_token = uuid.uuid4().hex
+    if not await redis.set(SETUP_LOCK_KEY, lock_token, nx=True, ex=60):
+        log.info('Telegram webhook is configured by another worker')
+        return
+    try:
+        params = _webhook_params()
+        fingerprint = _fingerprint(params)
+        webhook_info = await bot.get_webhook_info()
+        if (
+            webhook_info.url != params['url']
+            or sorted(webhook_info.allowed_updates or []) != params['allowed_updates']
+            or webhook_info.max_connections != params['max_connections']
+            or await redis.get(WEBHOOK_CONFIG_KEY) != fingerprint.encode()
+        ):
+            await bot.set_webhook(**params)
+            await redis.set(WEBHOOK_CONFIG_KEY, fingerprint)
+            log.info(f'Telegram webhook set to {params["url"]}')
+
+        # Назначаем действие для кнопки меню (запускаем webapp)
+        # webapp_info = WebAppInfo(url=cfg.webapp_url)
+        # menu_button = MenuButtonWebApp(text='Play', web_app=webapp_info)
+        # await bot.set_chat_menu_button(menu_button=menu_button)
+
+        # Задаем список команд
+        commands = _commands()
+        current = [(command.command.lstrip('/'), command.description) for command in await bot.get_my_commands()]
+        if current != [(command.command.lstrip('/'), command.description) for command in commands]:
+            await bot.set_my_commands(commands)
+    finally:
+        await _release_lock(keys=[SETUP_LOCK_KEY], args=[lock_token])
 
 
 async def end_telegram():
-    await bot.set_webhook(url='')
-    await bot.close()
+    # вебхук не снимаем: остальные воркеры и реплики продолжают принимать обновления
+    await bot.session.close()
 
 
 dp.startup.register(start_telegram)
@@ -0,0 +1,304 @@
+"""
+Рассылка сообщения всем юзерам бота.
+
+    python -m src.telegram.broadcast start "Текст рассылки"
+    python -m src.telegram.broadcast progress <broadcast_id>
+    python -m src.telegram.broadcast cancel <broadcast_id>
+
+start порциями читает получателей из users (активные, не заблокировавшие бота, с tg_chat_id) и кладет отправки
+в redis stream cfg.broadcast_stream, отправляет их воркер (src.telegram.worker).
+Все процессы воркера берут токены из одного token bucket в redis (cfg.broadcast_rate
+сообщений в секунду, telegram допускает около 30), получатель у каждого сообщения свой,
+поэтому лимит на один чат не достигается.
+Подтвержденные записи удаляются из stream (BroadcastService.trim_stream), состояние рассылки
+хранится cfg.broadcast_ttl секунд после последней отправки.
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from typing import Any, Optional
+
+from faststream.redis.parser import RawMessage
+from redis.exceptions import ResponseError
+from sqlalchemy import select, update, func
+
+from src.core.database import db_helper as db
+from src.core.metrics import BROADCAST_MESSAGES
+from src.core.models import UserModel
+from src.redis_queue import queue
+
+from src.game_api.utils import log
+from src.settings import get_settings
+
+cfg = get_settings()
+
+SENDS_GROUP = 'broadcast-workers'
+BROADCAST_KEY_PREFIX = 'broadcast:'
+BUCKET_KEY = 'broadcast:bucket'
+PAUSE_KEY = 'broadcast:pause_until'
+
+RESULTS = ('sent', 'failed', 'blocked', 'skipped')
+
+# Token bucket: возвращает 0, если токен взят, иначе сколько мс ждать следующего.
+# Пока действует пауза после RetryAfter, токены не выдаются никому
+_ACQUIRE_LUA = """
+local now = redis.call('TIME')
+local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local pause_until = tonumber(redis.call('GET', KEYS[2]) or '0')
+if pause_until > now_ms then
+    return pause_until - now_ms
+end
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now_ms
+tokens = math.min(capacity, tokens + (now_ms - ts) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now_ms)
+redis.call('PEXPIRE', KEYS[1], 60000)
+return wait
+"""
+
+# Пауза всех отправок на ARGV[1] секунд (telegram ответил RetryAfter)
+_PAUSE_LUA = """
+local now = redis.call('TIME')
+local until_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000) + tonumber(ARGV[1]) * 1000
+if until_ms > tonumber(redis.call('GET', KEYS[1]) or '0') then
+    redis.call('SET', KEYS[1], until_ms, 'PX', tonumber(ARGV[1]) * 1000)
+end
+return until_ms
+"""
+
+# Учитывает результат отправки (ARGV[1], пусто - только проверка) и завершает рассылку,
+# когда все поставленные в очередь отправки обработаны. Состояние истекает через ARGV[3] сек
+# после последней записи, истекшую рассылку не воссоздает
+_RECORD_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+if ARGV[1] ~= '' then
+    redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+end
+local state = redis.call('HMGET', KEYS[1], 'status', 'enqueued', 'producer_done', 'sent', 'failed', 'blocked', 'skipped')
+if state[1] == 'running' and state[3] == '1' then
+    local processed = tonumber(state[4]) + tonumber(state[5]) + tonumber(state[6]) + tonumber(state[7])
+    if processed >= tonumber(state[2]) then
+        redis.call('HSET', KEYS[1], 'status', 'finished', 'finished_at', ARGV[2])
+    end
+end
+return 1
+"""
+
+
+def _broadcast_key(broadcast_id: str) -> str:
+    return f'{BROADCAST_KEY_PREFIX}{broadcast_id}'
+
+
+def _stream_id(entry_id: bytes | str) -> tuple[int, int]:
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    ms, seq = entry_id.split('-')
+    return int(ms), int(seq)
+
+
+class BroadcastService:
+    """
+    Рассылки: постановка в очередь, ограничение скорости, учет результатов.\n
+    Состояние рассылки - hash broadcast:<id> (текст, статус, счетчики sent/failed/blocked/skipped).
+    При RetryAfter все воркеры останавливаются на указанное время и повторяют отправку,
+    юзерам, заблокировавшим бота, проставляется bot_blocked_at, и до следующего /start
+    они в рассылки не попадают
+    """
+    _redis = queue.get_redis()
+    _acquire = _redis.register_script(_ACQUIRE_LUA)
+    _pause = _redis.register_script(_PAUSE_LUA)
+    _record = _redis.register_script(_RECORD_LUA)
+
+    @staticmethod
+    def _recipients_filter() -> tuple:
+        return (
+            UserModel.is_active.is_(True),
+            UserModel.bot_blocked_at.is_(None),
+            UserModel.tg_chat_id.is_not(None),
+        )
+
+    @classmethod
+    async def start(cls, text: str) -> str:
+        broadcast_id = uuid.uuid4().hex
+        async with db.session_factory() as ses:
+            total = await ses.scalar(select(func.count()).select_from(UserModel).where(*cls._recipients_filter()))
+        key = _broadcast_key(broadcast_id)
+        await cls._redis.hset(key, mapping=dict(
+            text=text,
+            status='running',
+            total=total,
+            enqueued=0,
+            producer_done=0,
+            started_at=time.time(),
+            **{result: 0 for result in RESULTS},
+        ))
+        await cls._redis.expire(key, cfg.broadcast_ttl)
+        log.info(f'Broadcast {broadcast_id} started for {total} users')
+        return broadcast_id
+
+    @classmethod
+    async def enqueue_recipients(cls, broadcast_id: str) -> int:
+        """
+        Ставит отправки в очередь порциями по cfg.broadcast_chunk_size получателей (keyset по id)
+        """
+        key = _broadcast_key(broadcast_id)
+        enqueued = 0
+        last_id = None
+        while True:
+            stmt = (
+                select(UserModel.id, UserModel.tg_chat_id)
+                .where(*cls._recipients_filter())
+                .order_by(UserModel.id)
+                .limit(cfg.broadcast_chunk_size)
+            )
+            if last_id is not None:
+                stmt = stmt.where(UserModel.id > last_id)
+            async with db.session_factory() as ses:
+                rows = (await ses.execute(stmt)).all()
+            if not rows or await cls._redis.hget(key, 'status') != b'running':
+                break
+
+            # вся порция - один запрос к redis: записи в формате сообщений faststream,
+            # как их пишет broker.publish (их читают подписчики воркера), и счетчик поставленных в очередь
+            pipe = cls._redis.pipeline(transaction=False)
+            for user_id, chat_id in rows:
+                pipe.xadd(cfg.broadcast_stream, {'__data__': RawMessage.encode(
+                    message=dict(broadcast_id=broadcast_id, user_id=str(user_id), chat_id=chat_id),
+                    reply_to=None,
+                    headers=None,
+                    correlation_id=uuid.uuid4().hex,
+                )})
+            pipe.hincrby(key, 'enqueued', len(rows))
+            await pipe.execute()
+            enqueued += len(rows)
+            last_id = rows[-1].id
+
+        await cls._redis.hset(key, 'producer_done', 1)
+        await cls._record(keys=[key], args=['', time.time(), cfg.broadcast_ttl])
+        log.info(f'Broadcast {broadcast_id}: {enqueued} messages enqueued')
+        return enqueued
+
+    @classmethod
+    async def cancel(cls, broadcast_id: str) -> None:
+        key = _broadcast_key(broadcast_id)
+        if await cls._redis.exists(key):
+            await cls._redis.hset(key, 'status', 'cancelled')
+            await cls._redis.expire(key, cfg.broadcast_ttl)
+
+    @classmethod
+    async def progress(cls, broadcast_id: str) -> Optional[dict[str, Any]]:
+        state = await cls._redis.hgetall(_broadcast_key(broadcast_id))
+        if not state:
+            return None
+        state = {key.decode(): value.decode() for key, value in state.items()}
+        counts = {result: int(state[result]) for result in RESULTS}
+        processed = sum(counts.values())
+        started_at = float(state['started_at'])
+        elapsed = float(state.get('finished_at') or time.time()) - started_at
+        total = int(state['total'])
+        return dict(
+            broadcast_id=broadcast_id,
+            status=state['status'],
+            total=total,
+            enqueued=int(state['enqueued']),
+            processed=processed,
+            **counts,
+            progress_pct=round(processed / total * 100, 2) if total else 100.0,
+            elapsed_sec=round(elapsed, 1),
+            messages_per_sec=round(processed / elapsed, 2) if elapsed > 0 else 0.0,
+        )
+
+    @classmethod
+    async def acquire(cls) -> None:
+        """
+        Ждет токен общего для всех процессов token bucket
+        """
+        while True:
+            wait_ms = await cls._acquire(
+                keys=[BUCKET_KEY, PAUSE_KEY], args=[cfg.broadcast_rate, cfg.broadcast_burst])
+            if not wait_ms:
+                return
+            await asyncio.sleep(wait_ms / 1000)
+
+    @classmethod
+    async def pause(cls, seconds: int) -> None:
+        await cls._pause(keys=[PAUSE_KEY], args=[seconds])
+
+    @classmethod
+    async def record(cls, broadcast_id: str, result: str) -> None:
+        BROADCAST_MESSAGES.labels(result).inc()
+        await cls._record(keys=[_broadcast_key(broadcast_id)], args=[result, time.time(), cfg.broadcast_ttl])
+
+    @classmethod
+    async def mark_bot_blocked(cls, user_id: str) -> None:
+        async with db.session_factory() as ses:
+            await ses.execute(
+                update(UserModel).where(UserModel.id == uuid.UUID(user_id)).values(bot_blocked_at=func.now()))
+            await ses.commit()
+
+    @classmethod
+    async def trim_stream(cls) -> int:
+        """
+        Удаляет из stream отправок записи, уже подтвержденные всеми группами потребителей:
+        все, что раньше самой старой неподтвержденной записи (или последней выданной, если таких нет)
+        """
+        try:
+            groups = await cls._redis.xinfo_groups(cfg.broadcast_stream)
+        except ResponseError:
+            # stream еще не создан
+            return 0
+        boundary = None
+        for group in groups:
+            pending = await cls._redis.xpending(cfg.broadcast_stream, group['name'])
+            group_boundary = pending['min'] if pending['pending'] else group['last-delivered-id']
+            if boundary is None or _stream_id(group_boundary) < _stream_id(boundary):
+                boundary = group_boundary
+        if boundary is None:
+            return 0
+        return await cls._redis.xtrim(cfg.broadcast_stream, minid=boundary, approximate=False)
+
+    @classmethod
+    async def broadcast_text(cls, broadcast_id: str) -> Optional[str]:
+        """
+        Текст рассылки, None - рассылка отменена или удалена
+        """
+        status, text = await cls._redis.hmget(_broadcast_key(broadcast_id), 'status', 'text')
+        if status != b'running' or text is None:
+            return None
+        return text.decode()
+
+
+async def main(command: str, argument: str) -> None:
+    try:
+        if command == 'start':
+            broadcast_id = await BroadcastService.start(argument)
+            print(broadcast_id)
+            await BroadcastService.enqueue_recipients(broadcast_id)
+        elif command == 'cancel':
+            await BroadcastService.cancel(argument)
+        else:
+            print(json.dumps(await BroadcastService.progress(argument), indent=2))
+    finally:
+        await db.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Рассылка сообщения всем юзерам бота')
+    parser.add_argument('command', choices=('start', 'progress', 'cancel'))
+    parser.add_argument('argument', help='текст рассылки для start, иначе id рассылки')
+    args = parser.parse_args()
+    asyncio.run(main(args.command, args.argument))
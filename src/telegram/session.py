@@ -0,0 +1,93 @@
+"""
+HTTP-сессия бота для запросов к Bot API.
+
+Пул соединений и keep-alive настраиваются (cfg.bot_api_pool_size, cfg.bot_api_keepalive),
+одновременных запросов на процесс не больше cfg.bot_api_concurrency. Таймаут берется по методу
+(cfg.bot_api_method_timeouts, иначе cfg.bot_api_timeout), переданный вызывающим кодом request_timeout
+ограничен cfg.bot_api_max_timeout. После cfg.bot_api_breaker_threshold подряд сетевых ошибок,
+таймаутов или 5xx запросы на cfg.bot_api_breaker_reset секунд сразу завершаются ошибкой,
+не дожидаясь telegram. Потом запросы снова отправляются, но до первого успешного
+любая такая ошибка опять размыкает цепь.
+"""
+import asyncio
+import time
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramServerError
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from src.core.metrics import BOT_API_CIRCUIT_OPENED, BOT_API_REQUEST_DURATION, BOT_API_REQUESTS_IN_FLIGHT
+from src.settings import get_settings
+
+cfg = get_settings()
+
+# у long polling таймаут запроса больше таймаута самого getUpdates, его не ограничиваем
+LONG_POLL_METHODS = frozenset({'getUpdates'})
+
+
+class BotApiSession(AiohttpSession):
+    def __init__(self, **kwargs) -> None:
+        super().__init__(limit=cfg.bot_api_pool_size, timeout=cfg.bot_api_timeout, **kwargs)
+        self._connector_init['keepalive_timeout'] = cfg.bot_api_keepalive
+        self._semaphore = asyncio.Semaphore(cfg.bot_api_concurrency)
+        self._failures = 0
+        self._open_until = 0.0
+
+    def _timeout(self, api_method: str, timeout: Optional[float]) -> float:
+        if timeout is None:
+            return cfg.bot_api_method_timeouts.get(api_method, cfg.bot_api_timeout)
+        if api_method in LONG_POLL_METHODS:
+            return timeout
+        return min(timeout, cfg.bot_api_max_timeout)
+
+    def _record_failure(self) -> None:
+        self._failures += 1
+        if self._failures >= cfg.bot_api_breaker_threshold:
+            if self._open_until <= time.monotonic():
+                BOT_API_CIRCUIT_OPENED.inc()
+            self._open_until = time.monotonic() + cfg.bot_api_breaker_reset
+
+    async def make_request(
+            self,
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+            timeout: Optional[int] = None,
+    ) -> TelegramType:
+        api_method = method.__api_method__
+        if self._open_until > time.monotonic():
+            BOT_API_REQUEST_DURATION.labels(api_method, 'circuit_open').observe(0)
+            raise TelegramNetworkError(method, 'Bot API circuit is open')
+
+        timeout = self._timeout(api_method, timeout)
+        started = time.perf_counter()
+        result = 'error'
+        BOT_API_REQUESTS_IN_FLIGHT.inc()
+        try:
+            # ожидание свободного слота входит в тот же таймаут
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout)
+            except asyncio.TimeoutError:
+                result = 'saturated'
+                raise TelegramNetworkError(method, 'Bot API concurrency limit wait timeout')
+            try:
+                response = await super().make_request(bot, method, timeout=timeout - (time.perf_counter() - started))
+            finally:
+                self._semaphore.release()
+            self._failures = 0
+            result = 'ok'
+            return response
+        except (TelegramNetworkError, TelegramServerError):
+            if result != 'saturated':
+                result = 'unavailable'
+                self._record_failure()
+            raise
+        except TelegramAPIError:
+            # telegram ответил (неверный запрос, flood control и т.п.), с доступностью API все в порядке
+            self._failures = 0
+            raise
+        finally:
+            BOT_API_REQUESTS_IN_FLIGHT.dec()
+            BOT_API_REQUEST_DURATION.labels(api_method, result).observe(time.perf_counter() - started)
@@ -0,0 +1,61 @@
+from src.core.metrics import TELEGRAM_DUPLICATE_UPDATES
+from src.redis_queue import queue
+from src.settings import get_settings
+
+cfg = get_settings()
+broker = queue.get_broker()
+
+# группа потребителей redis stream, все воркеры обновлений читают в одной группе
+UPDATES_GROUP = 'telegram-workers'
+
+SEEN_KEY_PREFIX = 'telegram:update:'
+
+# Принимает обновление в обработку. Обновление, которое обрабатывается ('processing'),
+# повторно выдается только для записи, забранной из pending (ARGV[2] == '1'): прошлая попытка
+# упала, а новая доставка того же update_id от telegram - дубль
+_CLAIM_LUA = """
+if redis.call('SET', KEYS[1], 'processing', 'NX', 'EX', ARGV[1]) then
+    return 1
+end
+if ARGV[2] == '1' and redis.call('GET', KEYS[1]) == 'processing' then
+    return 1
+end
+return 0
+"""
+
+
+async def publish_update(payload: bytes) -> None:
+    """
+    Кладет сырое обновление telegram в redis stream для воркеров (src.telegram.worker),
+    stream ограничен cfg.tg_updates_maxlen записями
+    """
+    await broker.publish(payload, stream=cfg.tg_updates_stream, maxlen=cfg.tg_updates_maxlen)
+
+
+class UpdateDedup:
+    """
+    Отсев повторных доставок обновлений telegram по update_id.\n
+    Telegram повторяет обновление, если вебхук не ответил вовремя, update_id при этом тот же.
+    Принятые update_id хранятся cfg.tg_update_dedup_ttl секунд, повторы не доходят
+    до Dispatcher и считаются в метрике telegram_duplicate_updates.
+    Пока обработка не завершена (done), повторить ее может только повторная обработка той же записи stream
+    """
+    _redis = queue.get_redis()
+    _claim = _redis.register_script(_CLAIM_LUA)
+
+    @classmethod
+    async def claim(cls, update_id: int, reclaimed: bool = False) -> bool:
+        """
+        True - обновление нужно обработать: пришло впервые или это повтор упавшей обработки (reclaimed)
+        """
+        claimed = await cls._claim(
+            keys=[f'{SEEN_KEY_PREFIX}{update_id}'],
+            args=[cfg.tg_update_dedup_ttl, int(reclaimed)],
+        )
+        if not claimed:
+            TELEGRAM_DUPLICATE_UPDATES.inc()
+        return bool(claimed)
+
+    @classmethod
+    async def done(cls, update_id: int) -> None:
+        await cls._redis.set(f'{SEEN_KEY_PREFIX}{update_id}', 'done', ex=cfg.tg_update_dedup_ttl)
@@ -0,0 +1,213 @@
+"""
+Воркер обновлений telegram: читает redis stream, в который их кладет вебхук, и передает в Dispatcher.
+
+    python -m src.telegram.worker
+
+Обновления обрабатываются одновременно не больше cfg.tg_update_workers: столько потребителей
+группы UPDATES_GROUP (каждый обрабатывает по одному обновлению) регистрирует воркер.
+Имена потребителей постоянные для хоста, обновление подтверждается (XACK) после обработки.
+Если обработка упала, запись остается в pending: раз в cfg.stream_reclaim_interval воркер забирает
+зависшие записи (и записи упавших воркеров) и обрабатывает их снова, после cfg.stream_max_deliveries
+доставок запись уходит в cfg.tg_updates_dead_letter_stream.
+Повторные доставки одного update_id отбрасываются до обработки (см. UpdateDedup).
+Здесь же отправляются сообщения рассылок (src.telegram.broadcast), cfg.broadcast_workers потребителей.
+Зависшие отправки забираются и повторяются так же, после cfg.stream_max_deliveries доставок
+отправка уходит в cfg.broadcast_dead_letter_stream и учитывается в рассылке как failed.
+Из stream рассылок удаляются подтвержденные записи.
+"""
+import asyncio
+import json
+import socket
+
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+from aiogram.types import Update
+from faststream.redis import StreamSub
+
+from src.core.database import db_helper as db
+from src.core.metrics import mark_process_dead, start_metrics_server
+from src.game_api.services.catalog_service import CatalogService
+from src.redis_queue import queue, reclaim_pending
+from src.telegram.bot import bot, dp
+from src.telegram.broadcast import BroadcastService, SENDS_GROUP
+from src.telegram.update_stream import UPDATES_GROUP, UpdateDedup
+
+from src.game_api.utils import log
+from src.settings import get_settings
+
+cfg = get_settings()
+broker = queue.get_broker()
+app = queue.get_stream()
+background_tasks: list[asyncio.Task] = []
+
+
+async def process_update(body: bytes, reclaimed: bool = False) -> None:
+    try:
+        update = Update.model_validate_json(body, context={"bot": bot})
+    except ValueError as e:
+        log.error(f'Invalid telegram update skipped: {e}')
+        return
+    if not await UpdateDedup.claim(update.update_id, reclaimed):
+        if cfg.debug:
+            log.warning(f'Duplicate telegram update {update.update_id} skipped')
+        return
+    # ошибка не перехватывается: запись остается неподтвержденной и будет обработана повторно
+    await dp.feed_update(bot, update)
+    await UpdateDedup.done(update.update_id)
+
+
+async def handle_update(body: bytes) -> None:
+    await process_update(body)
+
+
+async def process_reclaimed_update(body: bytes) -> None:
+    await process_update(body, reclaimed=True)
+
+
+async def reclaim_updates() -> None:
+    """
+    Фоновая задача: повторная обработка зависших обновлений, первый проход сразу при запуске
+    """
+    while True:
+        try:
+            reclaimed = await reclaim_pending(
+                cfg.tg_updates_stream,
+                UPDATES_GROUP,
+                f'{socket.gethostname()}-reclaim',
+                process_reclaimed_update,
+                cfg.tg_updates_dead_letter_stream,
+            )
+            if reclaimed:
+                log.info(f'{reclaimed} pending telegram updates reprocessed')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f'Telegram updates reclaim error: {e}')
+        await asyncio.sleep(cfg.stream_reclaim_interval)
+
+
+async def process_reclaimed_send(body: bytes) -> None:
+    await handle_broadcast_send(json.loads(body))
+
+
+async def fail_dead_send(body: bytes) -> None:
+    # рассылка должна дойти до finished и без этой отправки
+    await BroadcastService.record(json.loads(body)['broadcast_id'], 'failed')
+
+
+async def reclaim_broadcasts() -> None:
+    """
+    Фоновая задача: повторная отправка зависших сообщений рассылок (ошибка redis или базы
+    во время отправки, падение воркера), иначе они навсегда остаются в pending, stream перестает
+    очищаться, а рассылка не завершается
+    """
+    while True:
+        try:
+            reclaimed = await reclaim_pending(
+                cfg.broadcast_stream,
+                SENDS_GROUP,
+                f'{socket.gethostname()}-reclaim',
+                process_reclaimed_send,
+                cfg.broadcast_dead_letter_stream,
+                fail_dead_send,
+            )
+            if reclaimed:
+                log.info(f'{reclaimed} pending broadcast sends reprocessed')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f'Broadcast sends reclaim error: {e}')
+        await asyncio.sleep(cfg.stream_reclaim_interval)
+
+
+async def trim_broadcasts() -> None:
+    """
+    Фоновая задача: удаление подтвержденных отправок из stream рассылок
+    """
+    while True:
+        try:
+            await BroadcastService.trim_stream()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f'Broadcast stream trim error: {e}')
+        await asyncio.sleep(cfg.stream_reclaim_interval)
+
+
+_handler = handle_update
+for i in range(cfg.tg_update_workers):
+    _handler = broker.subscriber(
+        stream=StreamSub(cfg.tg_updates_stream, group=UPDATES_GROUP, consumer=f'{socket.gethostname()}-{i}'),
+    )(_handler)
+
+
+async def handle_broadcast_send(body: dict) -> None:
+    broadcast_id = body['broadcast_id']
+    text = await BroadcastService.broadcast_text(broadcast_id)
+    if text is None:
+        await BroadcastService.record(broadcast_id, 'skipped')
+        return
+    attempt = 0
+    while True:
+        await BroadcastService.acquire()
+        try:
+            await bot.send_message(body['chat_id'], text)
+            result = 'sent'
+        except TelegramRetryAfter as e:
+            # лимит общий для бота, поэтому пауза для всех воркеров
+            log.warning(f'Broadcast {broadcast_id}: flood control, retry after {e.retry_after} sec')
+            await BroadcastService.pause(e.retry_after)
+            continue
+        except TelegramForbiddenError:
+            # бот заблокирован или юзер удален, не пишем ему до следующего /start
+            await BroadcastService.mark_bot_blocked(body['user_id'])
+            result = 'blocked'
+        except (TelegramNetworkError, TelegramServerError) as e:
+            # сеть, 5xx или разомкнутая цепь BotApiSession: повтор с растущей паузой,
+            # чтобы не списывать получателей, пока Bot API недоступен
+            attempt += 1
+            if attempt < cfg.broadcast_max_attempts:
+                await asyncio.sleep(cfg.broadcast_retry_backoff * 2 ** (attempt - 1))
+                continue
+            log.error(f'Broadcast {broadcast_id}: send to {body["chat_id"]} failed after {attempt} attempts: {e}')
+            result = 'failed'
+        except TelegramAPIError as e:
+            log.error(f'Broadcast {broadcast_id}: send to {body["chat_id"]} failed: {e}')
+            result = 'failed'
+        break
+    await BroadcastService.record(broadcast_id, result)
+
+
+_handler = handle_broadcast_send
+for i in range(cfg.broadcast_workers):
+    _handler = broker.subscriber(
+        stream=StreamSub(cfg.broadcast_stream, group=SENDS_GROUP, consumer=f'{socket.gethostname()}-{i}'),
+    )(_handler)
+
+
+@app.after_startup
+async def on_startup() -> None:
+    await CatalogService.load()
+    if cfg.worker_metrics_port:
+        start_metrics_server(cfg.worker_metrics_port)
+    background_tasks.append(asyncio.create_task(reclaim_updates()))
+    background_tasks.append(asyncio.create_task(reclaim_broadcasts()))
+    background_tasks.append(asyncio.create_task(trim_broadcasts()))
+    log.info(f'🚀 Telegram update worker started, {cfg.tg_update_workers} update consumers, '
+             f'{cfg.broadcast_workers} broadcast consumers')
+
+
+@app.after_shutdown
+async def on_shutdown() -> None:
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await bot.session.close()
+    await db.dispose()
+    mark_process_dead()
+    log.info('⛔ Telegram update worker stopped')
+
+
+if __name__ == '__main__':
+    asyncio.run(app.run())